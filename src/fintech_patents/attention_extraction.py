@@ -0,0 +1,242 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Capture only the attention needed for highlight instead of keeping attentions of all layers and heads."""
+
+import io
+import sys
+import time
+import weakref
+import argparse
+import threading
+import configparser
+from model_registry import get_model_tokenizer, model_pickle_path_from_config
+from settings import CONFIG_FILE, SAMPLE_ABSTRACT
+
+# Attention modes:
+#   `cls_head`: attention of first token from one head of one layer.
+#   `cls_mean`: attention of first token averaged over all heads of one layer.
+#   `none`: no attention. Fast path for bulk scoring.
+ATTENTION_MODES = ['cls_head', 'cls_mean', 'none']
+
+# Model -> lock held while an `AttentionCapture` has hooks on it.
+_MODEL_LOCKS = weakref.WeakKeyDictionary()
+_MODEL_LOCKS_LOCK = threading.Lock()
+
+
+def attention_modules(model):
+    r"""
+    Self attention modules of a transformers model in layer order.
+
+    DistilBERT uses `MultiHeadSelfAttention`, BERT and RoBERTa use `BertSelfAttention` and
+    `RobertaSelfAttention`. Models that are not PyTorch modules, like ONNX models, have none.
+    """
+
+    if not hasattr(model, 'named_modules'):
+        return []
+
+    return [module for _, module in model.named_modules() if type(module).__name__.endswith('SelfAttention')]
+
+
+def model_lock(model):
+    r"""
+    Lock of a model shared by all threads, like models of `model_registry.MODEL_REGISTRY`.
+    """
+
+    with _MODEL_LOCKS_LOCK:
+        return _MODEL_LOCKS.setdefault(model, threading.Lock())
+
+
+class AttentionCapture(object):
+    r"""
+    Context manager that keeps the first token attention of one layer and drops attentions of all other layers
+    as soon as each layer is done.
+
+    Model needs to be called with `output_attentions=True` so layers compute attention weights. Forward hooks
+    replace each layer's weights with None, so the model outputs no attention tensors.
+
+    Hooks are on the model itself, so a capture holds the lock of the model from registering its hooks until
+    they are removed. Threads sharing a model never record each other's attention.
+
+    Arguments:
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model used.
+
+        layer (:obj:`int`, `optional`, defaults to :obj:`-1`):
+            Index of layer captured. Negative values count from last layer.
+
+        head (:obj:`int`, `optional`, defaults to :obj:`0`):
+            Head captured in `cls_head` mode.
+
+        mode (:obj:`str`, `optional`, defaults to :obj:`cls_head`):
+            One of `cls_head` or `cls_mean`.
+    """
+
+    def __init__(self, model, layer=-1, head=0, mode='cls_head'):
+
+        self.model = model
+        self.modules = attention_modules(model)
+        self.layer = layer % len(self.modules) if self.modules else None
+        self.head = head
+        self.mode = mode
+        # Captured weights of shape [batch size, sequence length].
+        self.weights = None
+        self._handles = []
+
+    def _hook(self, layer):
+        def hook(module, inputs, output):
+            # Layers return weights second only when attentions are asked for.
+            if not isinstance(output, tuple) or len(output) < 2 or output[1] is None:
+                return None
+            if layer == self.layer:
+                weights = output[1][:, :, 0, :]
+                self.weights = weights[:, self.head, :] if self.mode == 'cls_head' else weights.mean(dim=1)
+            # Drop weights of this layer.
+            return (output[0], None) + tuple(output[2:])
+
+        return hook
+
+    def __enter__(self):
+        self._lock = model_lock(self.model)
+        self._lock.acquire()
+        self.weights = None
+        self._handles = [module.register_forward_hook(self._hook(layer))
+                         for layer, module in enumerate(self.modules)]
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            for handle in self._handles:
+                handle.remove()
+            self._handles = []
+        finally:
+            self._lock.release()
+
+
+def forward_with_attention(model, inputs, attention_mode='cls_head', attention_layer=-1, attention_head=0):
+    r"""
+    Forward pass that returns logits and only the attention needed.
+
+    Arguments:
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model used.
+
+        inputs (:obj:`dict`):
+            Tokenizer outputs as tensors.
+
+        attention_mode (:obj:`str`, `optional`, defaults to :obj:`cls_head`):
+            One of `ATTENTION_MODES`.
+
+        attention_layer (:obj:`int`, `optional`, defaults to :obj:`-1`):
+            Layer captured.
+
+        attention_head (:obj:`int`, `optional`, defaults to :obj:`0`):
+            Head captured in `cls_head` mode.
+
+    Returns:
+
+        :obj:`tuple`: Logits as array of shape [batch size, number of labels] and attentions as array of shape
+        [batch size, sequence length], or None when there is no attention.
+    """
+
+    # Imported on first forward pass so modules using this one start without loading PyTorch.
+    import torch
+
+    if attention_mode not in ATTENTION_MODES:
+        raise ValueError(f'Unknown attention mode `{attention_mode}`! Use one of: {ATTENTION_MODES}')
+
+    # Fast path without any attention. Also used by models without attention modules.
+    if attention_mode == 'none' or not attention_modules(model):
+        with torch.no_grad():
+            outputs = model.forward(**inputs, output_attentions=False, return_dict=True)
+        return outputs['logits'].detach().cpu().numpy(), None
+
+    with AttentionCapture(model=model, layer=attention_layer, head=attention_head, mode=attention_mode) as capture:
+        with torch.no_grad():
+            outputs = model.forward(**inputs, output_attentions=True, return_dict=True)
+
+    weights = None if capture.weights is None else capture.weights.detach().cpu().numpy()
+
+    return outputs['logits'].detach().cpu().numpy(), weights
+
+
+def benchmark_attention_modes(tokenizer, model, text, n_runs=20):
+    r"""
+    Time a forward pass and count bytes of attention kept for each attention mode, and for keeping attentions
+    of all layers like `output_attentions=True` alone does.
+
+    Returns:
+
+        :obj:`dict`: Mode and dictionary with milliseconds per request and attention bytes kept per request.
+    """
+
+    import torch
+
+    inputs = tokenizer(text=text, add_special_tokens=True, truncation=True, padding=True, return_tensors='pt')
+    report = {}
+
+    for mode in ['all_layers'] + ATTENTION_MODES:
+        start_time = time.time()
+        for _ in range(n_runs):
+            if mode == 'all_layers':
+                with torch.no_grad():
+                    outputs = model.forward(**inputs, output_attentions=True, return_dict=True)
+                attention_bytes = sum(attentions.numel() * attentions.element_size()
+                                      for attentions in outputs['attentions'])
+            else:
+                _, weights = forward_with_attention(model=model, inputs=inputs, attention_mode=mode)
+                attention_bytes = 0 if weights is None else weights.nbytes
+        report[mode] = {'ms_per_request': round(1000 * (time.time() - start_time) / n_runs, 3),
+                        'attention_bytes': int(attention_bytes)}
+
+    return report
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Benchmark attention extraction modes.')
+
+    # Model used
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+
+    # Path of config file with pickled models
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Number of runs
+    parser.add_argument('--n_runs', help='Number of forward passes timed for each mode.', type=int, default=20)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    model_tokenizer, model_ = get_model_tokenizer(model_pickle_path_from_config(config, args.model))
+    sample_abstract = io.open(SAMPLE_ABSTRACT, mode='r', encoding='utf-8').read()
+
+    for attention_mode, mode_report in benchmark_attention_modes(tokenizer=model_tokenizer, model=model_,
+                                                                 text=sample_abstract, n_runs=args.n_runs).items():
+        print(f'{attention_mode}: {mode_report}')
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
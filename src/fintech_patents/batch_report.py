@@ -0,0 +1,427 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Static report of a classified patent set: per-label aggregates and sharded pages of highlighted documents.
+
+Documents are streamed in shards. Each shard is classified, if needed, and rendered by a worker process, so only
+a few shards are in memory at a time.
+"""
+
+import os
+import sys
+import json
+import html
+import time
+import argparse
+import itertools
+import configparser
+import multiprocessing
+from collections import deque
+import numpy as np
+from classify_corpus import CORPUS_FORMATS, read_corpus
+from graphics import bar_chart_svg, html_highlight_words, svg_labels_confidence
+from inference_modeling import inference_batch
+from inference_pool import set_torch_threads
+from model_registry import get_model_tokenizer, model_pickle_path_from_config
+from settings import CONFIG_FILE, IDS_LABELS, LABELS_COLORS, MAX_BATCH_TOKENS
+
+# Folder of document pages inside report folder.
+SHARDS_FOLDER = 'shards'
+
+# Color of labels missing from `LABELS_COLORS`.
+_DEFAULT_COLOR = (128, 128, 128)
+
+_PAGE_HEAD = ('<!DOCTYPE html><html><head><meta charset="utf-8"><title>{title}</title>'
+              '<style>body{{font-family:sans-serif;max-width:1000px;margin:auto}}'
+              'section{{border-bottom:1px solid #ddd;padding:8px 0}}'
+              'table{{border-collapse:collapse}}td,th{{padding:4px 10px;text-align:right}}</style>'
+              '</head><body>')
+
+
+class ReportStats(object):
+    r"""
+    Per-label aggregates updated one batch at a time. Stats of different shards are merged.
+
+    Arguments:
+
+        labels (:obj:`list`):
+            Label names.
+
+        n_bins (:obj:`int`, `optional`, defaults to :obj:`10`):
+            Number of bins of confidence histograms from 0% to 100%.
+    """
+
+    def __init__(self, labels, n_bins=10):
+        self.labels = list(labels)
+        self.n_bins = n_bins
+        # Documents predicted as each label.
+        self.counts = np.zeros(len(self.labels), dtype=np.int64)
+        # Confidence of predicted label, by label and bin.
+        self.confidence_histograms = np.zeros((len(self.labels), n_bins), dtype=np.int64)
+        self.confidence_sums = np.zeros(len(self.labels), dtype=np.float64)
+        # Sum of percentages of every label over all documents.
+        self.percents_sums = np.zeros(len(self.labels), dtype=np.float64)
+
+    def update(self, labels, labels_percents):
+        r"""
+        Add predictions of a batch of documents.
+
+        Arguments:
+
+            labels (:obj:`list`):
+                Predicted label of each document.
+
+            labels_percents (:obj:`list`):
+                Dictionary of label and percentage of each document.
+        """
+
+        if not labels:
+            return
+
+        indexes = np.array([self.labels.index(label) for label in labels])
+        # Rows are documents, columns are labels.
+        percents = np.array([[float(percents[label]) for label in self.labels] for percents in labels_percents])
+        confidences = percents[np.arange(len(indexes)), indexes]
+        bins = np.clip((confidences / 100 * self.n_bins).astype(int), 0, self.n_bins - 1)
+
+        np.add.at(self.counts, indexes, 1)
+        np.add.at(self.confidence_histograms, (indexes, bins), 1)
+        np.add.at(self.confidence_sums, indexes, confidences)
+        self.percents_sums += percents.sum(axis=0)
+
+        return
+
+    def merge(self, other):
+        r"""
+        Add stats of another shard.
+        """
+
+        self.counts += other.counts
+        self.confidence_histograms += other.confidence_histograms
+        self.confidence_sums += other.confidence_sums
+        self.percents_sums += other.percents_sums
+
+        return
+
+    def summary(self):
+        r"""
+        Aggregates of all documents seen.
+
+        Returns:
+
+            :obj:`dict`: Number of documents, bins edges, and for each label its count, share of documents,
+            mean confidence when predicted, confidence histogram and mean percentage over all documents.
+        """
+
+        n_documents = int(self.counts.sum())
+        labels = {}
+        for index, label in enumerate(self.labels):
+            count = int(self.counts[index])
+            labels[label] = {'count': count,
+                             'share': round(100 * count / max(n_documents, 1), 2),
+                             'mean_confidence': round(float(self.confidence_sums[index]) / max(count, 1), 2),
+                             'confidence_histogram': self.confidence_histograms[index].tolist(),
+                             'mean_percent': round(float(self.percents_sums[index]) / max(n_documents, 1), 2)}
+
+        return {'n_documents': n_documents,
+                'bins_edges': [round(100 * edge / self.n_bins, 2) for edge in range(self.n_bins + 1)],
+                'labels': labels}
+
+
+def shard_file_name(shard_index):
+    r"""
+    Name of page of a shard.
+    """
+
+    return f'shard-{shard_index:05d}.html'
+
+
+def _init_report_worker(intra_op_threads):
+    # Workers run at the same time, so each one uses few threads.
+    set_torch_threads(intra_op_threads=intra_op_threads, inter_op_threads=1)
+
+    return
+
+
+def report_shard(shard_index, records, path_report, model_pickle_path=None, text_field='abstract', id_field='id',
+                 ids_labels=IDS_LABELS, max_batch_tokens=MAX_BATCH_TOKENS, intensity=1, n_bins=10):
+    r"""
+    Classify a shard of records if needed, write its page and return its stats. Runs in worker processes.
+
+    Arguments:
+
+        shard_index (:obj:`int`):
+            Index of shard, used in page name.
+
+        records (:obj:`list`):
+            Tuples of row number and record.
+
+        path_report (:obj:`str`):
+            Folder of report.
+
+        model_pickle_path (:obj:`str`, `optional`):
+            Path of pickled model and tokenizer. If not used records are predictions written by
+            `classify_corpus.py`, with `attentions` and `tokens` when they were returned.
+
+    See `build_report` for other arguments.
+
+    Returns:
+
+        :obj:`ReportStats`: Stats of shard.
+    """
+
+    texts = [record.get(text_field) or '' for _, record in records]
+
+    if model_pickle_path is not None:
+        predictions = inference_batch(model_pickle_path=model_pickle_path, texts=texts, ids_labels=ids_labels,
+                                      max_batch_tokens=max_batch_tokens, return_attentions=True)
+    else:
+        predictions = [(record['label'], record['labels_percents'], record.get('attentions'), record.get('tokens'))
+                       for _, record in records]
+
+    stats = ReportStats(labels=ids_labels.values(), n_bins=n_bins)
+    stats.update(labels=[label for label, _, _, _ in predictions],
+                 labels_percents=[labels_percents for _, labels_percents, _, _ in predictions])
+
+    path_shard = os.path.join(path_report, SHARDS_FOLDER, shard_file_name(shard_index))
+    with open(path_shard, 'w', encoding='utf-8') as shard_file:
+        shard_file.write(_PAGE_HEAD.format(title=f'Shard {shard_index}'))
+        shard_file.write(f'<p><a href="../index.html">Report</a></p>')
+
+        for (row, record), text, (label, labels_percents, attentions, tokens) in zip(records, texts, predictions):
+            percents = ' | '.join(f'{html.escape(lab)} {float(percent):.2f}%'
+                                  for lab, percent in labels_percents.items())
+            shard_file.write(f'<section><h3>{html.escape(str(record.get(id_field, row)))}: '
+                             f'{html.escape(label)}</h3><p>{percents}</p>')
+            if tokens:
+                shard_file.write(html_highlight_words(weights=attentions, tokens=tokens, text=text or None,
+                                                      color=LABELS_COLORS.get(label, _DEFAULT_COLOR),
+                                                      intensity=intensity))
+            elif text:
+                shard_file.write(f'<p>{html.escape(text)}</p>')
+            shard_file.write('</section>')
+
+        shard_file.write('</body></html>')
+
+    return stats
+
+
+def write_index(path_report, summary, n_shards):
+    r"""
+    Write `index.html` with aggregates of all documents and links to shard pages, and `summary.json`.
+    """
+
+    labels_colors = {label: LABELS_COLORS.get(label, _DEFAULT_COLOR) for label in summary['labels']}
+    edges = summary['bins_edges']
+
+    page = [_PAGE_HEAD.format(title='Patents classification report'),
+            f'<h1>Patents classification report</h1><p>{summary["n_documents"]} documents.</p>',
+            '<table><tr><th>Label</th><th>Documents</th><th>Share</th><th>Mean confidence</th>'
+            '<th>Mean percent</th></tr>']
+    for label, label_summary in summary['labels'].items():
+        page.append(f'<tr><td>{html.escape(label)}</td><td>{label_summary["count"]}</td>'
+                    f'<td>{label_summary["share"]}%</td><td>{label_summary["mean_confidence"]}%</td>'
+                    f'<td>{label_summary["mean_percent"]}%</td></tr>')
+    page.append('</table>')
+
+    page.append('<h2>Share of documents</h2>')
+    page.append(svg_labels_confidence(labels_percentages={label: label_summary['share'] for label, label_summary
+                                                          in summary['labels'].items()},
+                                      labels_coloring=labels_colors))
+
+    page.append('<h2>Confidence of predicted label</h2>')
+    for label, label_summary in summary['labels'].items():
+        if not label_summary['count']:
+            continue
+        # Share of documents of label in each confidence bin.
+        bars = tuple((f'{edges[index]:g}-{edges[index + 1]:g}%',
+                      round(100 * bin_count / label_summary['count'], 2), labels_colors[label])
+                     for index, bin_count in enumerate(label_summary['confidence_histogram']))
+        page.append(f'<h3>{html.escape(label)}</h3>{bar_chart_svg(bars)}')
+
+    page.append('<h2>Documents</h2><p>')
+    page.append(' '.join(f'<a href="{SHARDS_FOLDER}/{shard_file_name(index)}">{index}</a>'
+                         for index in range(n_shards)))
+    page.append('</p></body></html>')
+
+    with open(os.path.join(path_report, 'index.html'), 'w', encoding='utf-8') as index_file:
+        index_file.write(''.join(page))
+
+    with open(os.path.join(path_report, 'summary.json'), 'w') as summary_file:
+        json.dump(summary, summary_file, indent=2)
+
+    return
+
+
+def build_report(path_input, path_report, model_pickle_path=None, text_field='abstract', id_field='id',
+                 corpus_format=None, shard_size=500, n_workers=1, intra_op_threads=1, ids_labels=IDS_LABELS,
+                 max_batch_tokens=MAX_BATCH_TOKENS, intensity=1, n_bins=10):
+    r"""
+    Stream records, render them in shards on worker processes and write report.
+
+    At most two shards for each worker are in memory at a time. Aggregates are merged as shards finish.
+
+    Arguments:
+
+        path_input (:obj:`str`):
+            Path of corpus file, or of predictions file written by `classify_corpus.py` when
+            `model_pickle_path` is not used.
+
+        path_report (:obj:`str`):
+            Folder where report is written.
+
+        model_pickle_path (:obj:`str`, `optional`):
+            Path of pickled model and tokenizer used to classify corpus.
+
+        text_field (:obj:`str`, `optional`, defaults to :obj:`abstract`):
+            Name of field with text of document.
+
+        id_field (:obj:`str`, `optional`, defaults to :obj:`id`):
+            Name of field with document id. Row number is used when field is missing.
+
+        corpus_format (:obj:`str`, `optional`):
+            One of `jsonl`, `csv` or `parquet`. If not used it is found from file extension.
+
+        shard_size (:obj:`int`, `optional`, defaults to :obj:`500`):
+            Number of documents on each page.
+
+        n_workers (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Number of worker processes.
+
+        intra_op_threads (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Threads each worker uses inside one torch operation.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        intensity (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Multiply each attention weight by this value to show up color.
+
+        n_bins (:obj:`int`, `optional`, defaults to :obj:`10`):
+            Number of bins of confidence histograms.
+
+    Returns:
+
+        :obj:`dict`: Summary of report.
+    """
+
+    os.makedirs(os.path.join(path_report, SHARDS_FOLDER), exist_ok=True)
+
+    options = dict(path_report=path_report, model_pickle_path=model_pickle_path, text_field=text_field,
+                   id_field=id_field, ids_labels=ids_labels, max_batch_tokens=max_batch_tokens, intensity=intensity,
+                   n_bins=n_bins)
+
+    records = enumerate(read_corpus(path_corpus=path_input, corpus_format=corpus_format))
+    shards = iter(lambda: list(itertools.islice(records, shard_size)), [])
+
+    stats = ReportStats(labels=ids_labels.values(), n_bins=n_bins)
+    start_time = time.time()
+    n_shards = 0
+
+    def add_shard(shard_stats):
+        stats.merge(shard_stats)
+        print(f'Reported {int(stats.counts.sum())} records | '
+              f'{stats.counts.sum() / (time.time() - start_time):.2f} docs/sec')
+        sys.stdout.flush()
+
+    if n_workers <= 1:
+        for n_shards, shard in enumerate(shards, start=1):
+            add_shard(report_shard(shard_index=n_shards - 1, records=shard, **options))
+    else:
+        # Load model before workers are forked so they share it.
+        if model_pickle_path is not None:
+            get_model_tokenizer(model_pickle_path)
+        context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods()
+                                              else 'spawn')
+        with context.Pool(processes=n_workers, initializer=_init_report_worker,
+                          initargs=(intra_op_threads,)) as pool:
+            pending = deque()
+            for n_shards, shard in enumerate(shards, start=1):
+                pending.append(pool.apply_async(report_shard, args=(n_shards - 1, shard), kwds=options))
+                # Keep a bounded number of shards in memory.
+                if len(pending) >= 2 * n_workers:
+                    add_shard(pending.popleft().get())
+            while pending:
+                add_shard(pending.popleft().get())
+
+    summary = stats.summary()
+    write_index(path_report=path_report, summary=summary, n_shards=n_shards)
+
+    return summary
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Write a static report of a classified patent set.')
+
+    # Input
+    parser.add_argument('--path_corpus', help='Path of JSONL, CSV or Parquet corpus file to classify.', type=str,
+                        default=None)
+    parser.add_argument('--path_predictions', help='Path of JSONL predictions written by `classify_corpus.py`.',
+                        type=str, default=None)
+    parser.add_argument('--corpus_format', help='Corpus format. Found from file extension if not used.',
+                        type=str, default=None, choices=sorted(set(CORPUS_FORMATS.values())))
+    parser.add_argument('--text_field', help='Name of field with text of document.', type=str, default='abstract')
+    parser.add_argument('--id_field', help='Name of field with document id.', type=str, default='id')
+
+    # Model used with corpus
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Report
+    parser.add_argument('--path_report', help='Folder where report is written.', type=str, required=True)
+    parser.add_argument('--shard_size', help='Number of documents on each page.', type=int, default=500)
+    parser.add_argument('--intensity', help='Intensity of text color highlight.', type=int, default=1)
+
+    # Workers
+    parser.add_argument('--n_workers', help='Number of worker processes.', type=int, default=os.cpu_count())
+    parser.add_argument('--intra_op_threads', help='Threads each worker uses inside one torch operation.',
+                        type=int, default=1)
+    parser.add_argument('--max_batch_tokens', help='Maximum number of tokens in a forward pass.',
+                        type=int, default=MAX_BATCH_TOKENS)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if (args.path_corpus is None) == (args.path_predictions is None):
+        parser.error('Use one of `--path_corpus` or `--path_predictions`.')
+
+    report_model = None
+    if args.path_corpus is not None:
+        # Create config parser.
+        config = configparser.ConfigParser()
+
+        # Read config file from path.
+        config.read(args.path_config_file)
+
+        report_model = model_pickle_path_from_config(config, args.model)
+
+    report_start = time.time()
+    report_summary = build_report(path_input=args.path_corpus or args.path_predictions, path_report=args.path_report,
+                                  model_pickle_path=report_model, text_field=args.text_field,
+                                  id_field=args.id_field, corpus_format=args.corpus_format,
+                                  shard_size=args.shard_size, n_workers=args.n_workers,
+                                  intra_op_threads=args.intra_op_threads, max_batch_tokens=args.max_batch_tokens,
+                                  intensity=args.intensity)
+
+    print(f'\nFinished running `{__file__}`! Reported {report_summary["n_documents"]} documents in '
+          f'{time.time() - report_start:.2f} seconds.')
+    sys.stdout.flush()
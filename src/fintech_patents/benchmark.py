@@ -0,0 +1,381 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Benchmark each stage of a prediction with small random weights models that don't need any download."""
+
+import os
+import sys
+import json
+import time
+import pickle
+import argparse
+import resource
+import tempfile
+import subprocess
+import platform
+import numpy as np
+import torch
+import matplotlib.pyplot as plt
+from transformers import (DistilBertConfig, DistilBertForSequenceClassification, DistilBertTokenizer,
+                          DistilBertTokenizerFast)
+from attention_extraction import forward_with_attention
+from graphics import (bar_chart_svg, html_highlight_text, html_highlight_words, plot_labels_confidence,
+                      svg_labels_confidence)
+from inference_modeling import predictions_from_logits
+from model_registry import load_model_tokenizer
+from settings import IDS_LABELS, LABELS_COLORS
+
+# Stages timed in the order they run for a prediction.
+STAGES = ['load', 'tokenize', 'forward', 'forward_attention', 'postprocess', 'html_highlight_text',
+          'html_highlight_words', 'svg_labels_confidence', 'plot_labels_confidence']
+
+
+def make_vocabulary(vocab_size, seed=0):
+    r"""
+    Special tokens followed by made up lowercase words. Each word is a single token.
+    """
+
+    random_state = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    words = set()
+    while len(words) < vocab_size:
+        words.add(''.join(random_state.choice(letters, size=random_state.randint(3, 10))))
+
+    return ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + sorted(words)
+
+
+def make_standin_model(path, vocab_size=5000, n_layers=4, dim=256, n_heads=4, max_length=512, use_fast=False,
+                       seed=0):
+    r"""
+    Pickle a DistilBERT model with random weights and its tokenizer, same format as `pickle_models`.
+
+    Arguments:
+
+        path (:obj:`str`):
+            Folder where vocabulary and pickle are saved.
+
+        vocab_size (:obj:`int`, `optional`, defaults to :obj:`5000`):
+            Number of made up words in vocabulary.
+
+        n_layers (:obj:`int`, `optional`, defaults to :obj:`4`):
+            Number of transformer layers.
+
+        dim (:obj:`int`, `optional`, defaults to :obj:`256`):
+            Hidden size.
+
+        n_heads (:obj:`int`, `optional`, defaults to :obj:`4`):
+            Number of attention heads.
+
+        max_length (:obj:`int`, `optional`, defaults to :obj:`512`):
+            Maximum sequence length.
+
+        use_fast (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Use Rust tokenizer.
+
+        seed (:obj:`int`, `optional`, defaults to :obj:`0`):
+            Seed of vocabulary and weights so runs are comparable.
+
+    Returns:
+
+        :obj:`tuple`: Path of pickle and vocabulary words.
+    """
+
+    vocabulary = make_vocabulary(vocab_size=vocab_size, seed=seed)
+    vocab_file = os.path.join(path, 'vocab.txt')
+    with open(vocab_file, 'w') as handle:
+        handle.write('\n'.join(vocabulary))
+
+    tokenizer_class = DistilBertTokenizerFast if use_fast else DistilBertTokenizer
+    tokenizer = tokenizer_class(vocab_file, model_max_length=max_length)
+
+    torch.manual_seed(seed)
+    config = DistilBertConfig(vocab_size=len(vocabulary), dim=dim, n_layers=n_layers, n_heads=n_heads,
+                              hidden_dim=4 * dim, max_position_embeddings=max_length, num_labels=len(IDS_LABELS))
+    model = DistilBertForSequenceClassification(config)
+    model.eval()
+
+    model_pickle_path = os.path.join(path, 'standin.pickle')
+    with open(model_pickle_path, 'wb') as handle:
+        pickle.dump([tokenizer, model], handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    return model_pickle_path, vocabulary[5:]
+
+
+def make_texts(words, batch_size, sequence_length, seed=0):
+    r"""
+    Texts that tokenize to exactly `sequence_length` tokens, special tokens included.
+    """
+
+    random_state = np.random.RandomState(seed)
+
+    return [' '.join(random_state.choice(words, size=sequence_length - 2)) for _ in range(batch_size)]
+
+
+def peak_rss_mb():
+    r"""
+    Peak resident memory of process in MB.
+    """
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Linux reports KB, macOS reports bytes.
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 2)
+
+
+def time_stage(function, n_runs):
+    r"""
+    Run function `n_runs` times after one warm up run.
+
+    Returns:
+
+        :obj:`tuple`: Dictionary with median, 90th percentile and minimum milliseconds, and output of last run.
+    """
+
+    output = function()
+    timings = []
+    for _ in range(n_runs):
+        start_time = time.perf_counter()
+        output = function()
+        timings.append(1000 * (time.perf_counter() - start_time))
+
+    return {'median_ms': round(float(np.median(timings)), 4),
+            'p90_ms': round(float(np.percentile(timings, 90)), 4),
+            'min_ms': round(float(np.min(timings)), 4)}, output
+
+
+def benchmark_stages(model_pickle_path, words, batch_size, sequence_length, n_runs=10):
+    r"""
+    Time each stage of a prediction separately for one batch size and sequence length.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of pickled model and tokenizer.
+
+        words (:obj:`list`):
+            Words used to make texts.
+
+        batch_size (:obj:`int`):
+            Number of texts in batch.
+
+        sequence_length (:obj:`int`):
+            Number of tokens of each text.
+
+        n_runs (:obj:`int`, `optional`, defaults to :obj:`10`):
+            Number of timed runs of each stage.
+
+    Returns:
+
+        :obj:`dict`: Stage and its timings.
+    """
+
+    texts = make_texts(words=words, batch_size=batch_size, sequence_length=sequence_length)
+    stages = {}
+
+    stages['load'], (tokenizer, model) = time_stage(lambda: load_model_tokenizer(model_pickle_path), n_runs)
+
+    stages['tokenize'], inputs = time_stage(lambda: tokenizer(text=texts, add_special_tokens=True, truncation=True,
+                                                              padding=True, return_tensors='pt'), n_runs)
+
+    stages['forward'], (logits, _) = time_stage(
+        lambda: forward_with_attention(model=model, inputs=inputs, attention_mode='none'), n_runs)
+
+    stages['forward_attention'], (_, weights) = time_stage(
+        lambda: forward_with_attention(model=model, inputs=inputs, attention_mode='cls_head'), n_runs)
+
+    stages['postprocess'], predictions = time_stage(lambda: predictions_from_logits(logits, IDS_LABELS), n_runs)
+
+    # Graphics are made for one document at a time.
+    tokens = tokenizer.convert_ids_to_tokens(inputs['input_ids'][0])
+    stages['html_highlight_text'], _ = time_stage(
+        lambda: html_highlight_text(weights=list(weights[0]), tokens=tokens), n_runs)
+    stages['html_highlight_words'], _ = time_stage(
+        lambda: html_highlight_words(weights=weights[0], tokens=tokens), n_runs)
+
+    def svg():
+        # Time a render, not a cache hit.
+        bar_chart_svg.cache_clear()
+        svg_labels_confidence(labels_percentages=predictions[0][1], labels_coloring=LABELS_COLORS)
+
+    stages['svg_labels_confidence'], _ = time_stage(svg, n_runs)
+
+    def plot():
+        figure = plot_labels_confidence(labels_percentages=predictions[0][1], labels_coloring=LABELS_COLORS)
+        plt.close(figure)
+
+    stages['plot_labels_confidence'], _ = time_stage(plot, n_runs)
+
+    return stages
+
+
+def benchmark_stages_process(model_pickle_path, words, batch_size, sequence_length, n_runs=10):
+    r"""
+    Run `benchmark_stages` in a new process, so peak resident memory is of one batch size and sequence length and
+    not of all runs before it.
+
+    Returns:
+
+        :obj:`tuple`: Stage and its timings, and peak resident memory in MB of the process.
+    """
+
+    code = ('import sys, json; from benchmark import benchmark_stages, peak_rss_mb; '
+            'stages = benchmark_stages(sys.argv[1], json.load(sys.stdin), *map(int, sys.argv[2:])); '
+            'print(json.dumps({"stages": stages, "peak_rss_mb": peak_rss_mb()}))')
+    output = subprocess.check_output([sys.executable, '-c', code, os.path.abspath(model_pickle_path),
+                                      str(batch_size), str(sequence_length), str(n_runs)],
+                                     input=json.dumps(words).encode(),
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+    result = json.loads(output.decode().strip().splitlines()[-1])
+
+    return result['stages'], result['peak_rss_mb']
+
+
+def run_benchmark(batch_sizes=(1, 8, 32), sequence_lengths=(32, 128, 512), n_runs=10, use_fast=False,
+                  n_layers=4, dim=256):
+    r"""
+    Sweep batch sizes and sequence lengths with a stand-in model. Each batch size and sequence length runs in its
+    own process.
+
+    Returns:
+
+        :obj:`dict`: Environment, model settings and one result for each batch size and sequence length.
+    """
+
+    results = []
+
+    with tempfile.TemporaryDirectory() as path:
+        model_pickle_path, words = make_standin_model(path=path, n_layers=n_layers, dim=dim,
+                                                      max_length=max(sequence_lengths), use_fast=use_fast)
+
+        for batch_size in batch_sizes:
+            for sequence_length in sequence_lengths:
+                stages, peak_rss = benchmark_stages_process(model_pickle_path=model_pickle_path, words=words,
+                                                            batch_size=batch_size, sequence_length=sequence_length,
+                                                            n_runs=n_runs)
+                results.append({'batch_size': batch_size,
+                                'sequence_length': sequence_length,
+                                'stages': stages,
+                                'peak_rss_mb': peak_rss})
+
+                print(f'batch_size={batch_size} sequence_length={sequence_length}: ' +
+                      ', '.join(f'{stage}={timing["median_ms"]}ms' for stage, timing in stages.items()))
+                sys.stdout.flush()
+
+    return {'environment': {'python': platform.python_version(),
+                            'torch': torch.__version__,
+                            'platform': platform.platform(),
+                            'torch_threads': torch.get_num_threads()},
+            'model': {'n_layers': n_layers, 'dim': dim, 'use_fast': use_fast},
+            'n_runs': n_runs,
+            'results': results}
+
+
+def compare_baseline(report, baseline, tolerance=0.1):
+    r"""
+    Compare median timings against a baseline report.
+
+    Arguments:
+
+        report (:obj:`dict`):
+            Output of `run_benchmark`.
+
+        baseline (:obj:`dict`):
+            Output of `run_benchmark` stored earlier.
+
+        tolerance (:obj:`float`, `optional`, defaults to :obj:`0.1`):
+            Relative slowdown allowed before a stage counts as a regression.
+
+    Returns:
+
+        :obj:`list`: Dictionaries with batch size, sequence length, stage, baseline and current median
+        milliseconds, ratio and if it is a regression. Only stages found in both reports are compared.
+    """
+
+    baseline_results = {(result['batch_size'], result['sequence_length']): result['stages']
+                        for result in baseline['results']}
+    comparisons = []
+
+    for result in report['results']:
+        baseline_stages = baseline_results.get((result['batch_size'], result['sequence_length']))
+        if baseline_stages is None:
+            continue
+        for stage, timing in result['stages'].items():
+            if stage not in baseline_stages:
+                continue
+            baseline_ms = baseline_stages[stage]['median_ms']
+            ratio = timing['median_ms'] / baseline_ms if baseline_ms > 0 else 1.0
+            comparisons.append({'batch_size': result['batch_size'],
+                                'sequence_length': result['sequence_length'],
+                                'stage': stage,
+                                'baseline_ms': baseline_ms,
+                                'current_ms': timing['median_ms'],
+                                'ratio': round(ratio, 3),
+                                'regression': ratio > 1 + tolerance})
+
+    return comparisons
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Benchmark prediction stages with random weights models.')
+
+    # Sweep
+    parser.add_argument('--batch_sizes', help='Batch sizes used.', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--sequence_lengths', help='Sequence lengths used.', type=int, nargs='+',
+                        default=[32, 128, 512])
+    parser.add_argument('--n_runs', help='Number of timed runs of each stage.', type=int, default=10)
+
+    # Stand-in model
+    parser.add_argument('--n_layers', help='Number of layers of stand-in model.', type=int, default=4)
+    parser.add_argument('--dim', help='Hidden size of stand-in model.', type=int, default=256)
+    parser.add_argument('--use_fast', help='Use Rust tokenizer.', action='store_true')
+
+    # Results
+    parser.add_argument('--path_output', help='JSON file where results are written.', type=str,
+                        default='benchmark_results.json')
+    parser.add_argument('--path_baseline', help='JSON file of earlier results to compare against.', type=str,
+                        default=None)
+    parser.add_argument('--tolerance', help='Relative slowdown allowed before a stage counts as a regression.',
+                        type=float, default=0.1)
+    parser.add_argument('--fail_on_regression', help='Exit with error code if any stage regressed.',
+                        action='store_true')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    benchmark_report = run_benchmark(batch_sizes=args.batch_sizes, sequence_lengths=args.sequence_lengths,
+                                     n_runs=args.n_runs, use_fast=args.use_fast, n_layers=args.n_layers,
+                                     dim=args.dim)
+
+    if args.path_baseline is not None:
+        with open(args.path_baseline, 'r') as baseline_file:
+            benchmark_report['comparison'] = compare_baseline(report=benchmark_report,
+                                                              baseline=json.load(baseline_file),
+                                                              tolerance=args.tolerance)
+        regressions = [comparison for comparison in benchmark_report['comparison'] if comparison['regression']]
+        print(f'{len(regressions)} regressions against `{args.path_baseline}`:')
+        for comparison in regressions:
+            print(f'  {comparison}')
+
+    with open(args.path_output, 'w') as output_file:
+        json.dump(benchmark_report, output_file, indent=2)
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
+
+    if args.fail_on_regression and any(comparison['regression'] for comparison in
+                                       benchmark_report.get('comparison', [])):
+        sys.exit(1)
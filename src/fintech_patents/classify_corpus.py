@@ -0,0 +1,417 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run this script to classify a large corpus of patent abstracts from a JSONL, CSV or Parquet file."""
+
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import itertools
+import configparser
+from inference_modeling import inference_batch
+from inference_pool import InferencePool
+from model_registry import model_pickle_path_from_config
+from settings import CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS, PREFILTER_THRESHOLD
+
+# Formats that can be read from file extension.
+CORPUS_FORMATS = {'.jsonl': 'jsonl', '.json': 'jsonl', '.csv': 'csv', '.parquet': 'parquet'}
+
+
+def read_corpus(path_corpus, corpus_format=None, batch_size=1024):
+    r"""
+    Stream records from a JSONL, CSV or Parquet file one at a time.
+
+    Arguments:
+
+        path_corpus (:obj:`str`):
+            Path of corpus file.
+
+        corpus_format (:obj:`str`, `optional`):
+            One of `jsonl`, `csv` or `parquet`. If not used it is found from file extension.
+
+        batch_size (:obj:`int`, `optional`, defaults to :obj:`1024`):
+            Number of rows read at once from Parquet files.
+
+    Returns:
+
+        :obj:`generator`: Dictionary of each record.
+    """
+
+    if corpus_format is None:
+        corpus_format = CORPUS_FORMATS.get(os.path.splitext(path_corpus)[1].lower())
+
+    if corpus_format == 'jsonl':
+        with open(path_corpus, 'r', encoding='utf-8') as corpus_file:
+            for line in corpus_file:
+                # Skip empty lines.
+                if line.strip():
+                    yield json.loads(line)
+
+    elif corpus_format == 'csv':
+        # Patent abstracts can be longer than default csv field limit.
+        csv.field_size_limit(sys.maxsize)
+        with open(path_corpus, 'r', encoding='utf-8', newline='') as corpus_file:
+            for record in csv.DictReader(corpus_file):
+                yield record
+
+    elif corpus_format == 'parquet':
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('Reading Parquet files needs `pyarrow`. Install it with `pip install pyarrow`.')
+        # Read only a batch of rows in memory at a time.
+        for record_batch in pq.ParquetFile(path_corpus).iter_batches(batch_size=batch_size):
+            for record in record_batch.to_pylist():
+                yield record
+
+    else:
+        raise ValueError(f'Unknown corpus format `{corpus_format}`! Use one of: {set(CORPUS_FORMATS.values())}')
+
+
+def read_checkpoint(path_checkpoint):
+    r"""
+    Read number of records and output bytes already written. Return zeros if there is no checkpoint.
+    """
+
+    if not os.path.isfile(path_checkpoint):
+        return 0, 0
+
+    with open(path_checkpoint, 'r') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+
+    return checkpoint['offset'], checkpoint['output_bytes']
+
+
+def write_checkpoint(path_checkpoint, offset, output_bytes):
+    r"""
+    Save number of records and output bytes written. File is replaced at once so a crash never leaves it
+    half written.
+    """
+
+    path_temporary = f'{path_checkpoint}.tmp'
+
+    with open(path_temporary, 'w') as checkpoint_file:
+        json.dump({'offset': offset, 'output_bytes': output_bytes}, checkpoint_file)
+
+    os.replace(path_temporary, path_checkpoint)
+
+    return
+
+
+def classify_texts(texts, model_pickle_path, ids_labels=IDS_LABELS, max_batch_tokens=MAX_BATCH_TOKENS,
+                   return_attentions=False, pool=None, prefilter=None, prefilter_threshold=PREFILTER_THRESHOLD,
+                   early_exit=False):
+    r"""
+    Classify a chunk of texts with the model, a pool of workers or the cascade.
+
+    See `classify_corpus` for arguments. `pool` is an `inference_pool.InferencePool` and `prefilter` a loaded
+    `prefilter_cascade.HashedNgramModel`.
+
+    Returns:
+
+        :obj:`tuple`: Predictions of each text, and boolean array of texts settled by first stage or None if
+        there is no first stage.
+    """
+
+    def predict(batch_texts):
+        if pool is None:
+            return inference_batch(model_pickle_path=model_pickle_path, texts=batch_texts, ids_labels=ids_labels,
+                                   max_batch_tokens=max_batch_tokens, return_attentions=return_attentions,
+                                   early_exit=early_exit)
+        return pool.map(texts=batch_texts, ids_labels=ids_labels, return_attentions=return_attentions,
+                        early_exit=early_exit)
+
+    if prefilter is None:
+        return predict(texts), None
+
+    from prefilter_cascade import cascade_batch
+
+    return cascade_batch(prefilter=prefilter, texts=texts, predict=predict, ids_labels=ids_labels,
+                         threshold=prefilter_threshold)
+
+
+def result_record(record_id, prediction, return_attentions=False, settled=None):
+    r"""
+    Output record of one document.
+
+    Arguments:
+
+        record_id (:obj:`object`):
+            Id of document.
+
+        prediction (:obj:`tuple`):
+            Label, labels percentages, attentions and tokens.
+
+        return_attentions (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Add attentions and tokens when the model returned them.
+
+        settled (:obj:`bool`, `optional`):
+            Whether first stage of cascade settled the document. No `cascade` field if not used.
+
+    Returns:
+
+        :obj:`dict`: Record written in JSONL output.
+    """
+
+    label, labels_percents, attentions, tokens = prediction
+    result = {'id': record_id,
+              'label': label,
+              'labels_percents': {lab: float(percent) for lab, percent in labels_percents.items()}}
+    if return_attentions and tokens is not None:
+        result['attentions'] = [round(float(weight), 6) for weight in attentions]
+        result['tokens'] = tokens
+    if settled is not None:
+        result['cascade'] = 'prefilter' if settled else 'transformer'
+
+    return result
+
+
+def classify_corpus(model_pickle_path, path_corpus, path_output, text_field='abstract', id_field='id',
+                    corpus_format=None, chunk_size=1024, max_batch_tokens=MAX_BATCH_TOKENS,
+                    return_attentions=False, resume=False, n_workers=1, ids_labels=IDS_LABELS, path_prefilter=None,
+                    prefilter_threshold=PREFILTER_THRESHOLD, path_store=None, early_exit=False):
+    r"""
+    Classify corpus in chunks and append predictions to a JSONL output file.
+
+    Only `chunk_size` records are in memory at a time. After each chunk is written a checkpoint file
+    `<path_output>.checkpoint` keeps the number of records done so a crashed run can resume.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of pickled model and tokenizer.
+
+        path_corpus (:obj:`str`):
+            Path of corpus file.
+
+        path_output (:obj:`str`):
+            Path of JSONL file where predictions are written.
+
+        text_field (:obj:`str`, `optional`, defaults to :obj:`abstract`):
+            Name of field with text to classify.
+
+        id_field (:obj:`str`, `optional`, defaults to :obj:`id`):
+            Name of field with document id. Row number is used when field is missing.
+
+        corpus_format (:obj:`str`, `optional`):
+            One of `jsonl`, `csv` or `parquet`. If not used it is found from file extension.
+
+        chunk_size (:obj:`int`, `optional`, defaults to :obj:`1024`):
+            Number of records classified and written at once.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        return_attentions (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Write attentions and tokens of each document.
+
+        resume (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Continue from checkpoint of a previous run.
+
+        n_workers (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Number of worker processes. More than one uses `inference_pool.InferencePool`.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        path_prefilter (:obj:`str`, `optional`):
+            First stage saved by `prefilter_cascade.py`. Documents it settles as `non-fintech` skip the model and
+            are written with `"cascade": "prefilter"`.
+
+        prefilter_threshold (:obj:`float`, `optional`, defaults to :obj:`settings.PREFILTER_THRESHOLD`):
+            Probability of `non-fintech` needed to settle a document in first stage.
+
+        path_store (:obj:`str`, `optional`):
+            Folder of `result_store.ResultStore` where predictions are also written. Can't be used with `resume`.
+
+        early_exit (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Stop each document at the first confident layer if the model has heads trained by `early_exit.py`.
+            Not used with `return_attentions`.
+
+    Returns:
+
+        :obj:`int`: Total number of records classified.
+    """
+
+    path_checkpoint = f'{path_output}.checkpoint'
+
+    # Start from checkpoint only if resuming.
+    offset, output_bytes = read_checkpoint(path_checkpoint) if resume else (0, 0)
+
+    if offset:
+        print(f'Resume from record {offset}.')
+        sys.stdout.flush()
+
+    records = read_corpus(path_corpus=path_corpus, corpus_format=corpus_format)
+    # Skip records already classified.
+    records = itertools.islice(records, offset, None)
+
+    prefilter = None
+    if path_prefilter is not None:
+        from prefilter_cascade import HashedNgramModel
+        prefilter = HashedNgramModel.load(path_prefilter)
+
+    start_time = time.time()
+    n_done = 0
+    n_settled = 0
+
+    store = None
+    if path_store is not None:
+        if resume:
+            raise ValueError('Result store can\'t be resumed! Write it from the JSONL output with `result_store.py`.')
+        from result_store import ResultStoreWriter
+        store = ResultStoreWriter(path_store=path_store, ids_labels=ids_labels)
+
+    # Worker processes share one copy of the model weights.
+    pool = InferencePool(model_pickle_path=model_pickle_path, n_workers=n_workers,
+                         max_batch_tokens=max_batch_tokens) if n_workers > 1 else None
+
+    try:
+        # Use `r+` to keep output when resuming.
+        with open(path_output, 'r+' if offset else 'w', encoding='utf-8') as output_file:
+            # Drop any output written after last checkpoint.
+            output_file.seek(output_bytes)
+            output_file.truncate()
+
+            while True:
+                chunk = list(itertools.islice(records, chunk_size))
+                if not chunk:
+                    break
+
+                texts = [record.get(text_field) or '' for record in chunk]
+                predictions, settled = classify_texts(texts=texts, model_pickle_path=model_pickle_path,
+                                                      ids_labels=ids_labels, max_batch_tokens=max_batch_tokens,
+                                                      return_attentions=return_attentions, pool=pool,
+                                                      prefilter=prefilter, prefilter_threshold=prefilter_threshold,
+                                                      early_exit=early_exit)
+                if settled is not None:
+                    n_settled += int(settled.sum())
+
+                for row, (record, prediction) in enumerate(zip(chunk, predictions)):
+                    result = result_record(record_id=record.get(id_field, offset + n_done + row), prediction=prediction,
+                                           return_attentions=return_attentions,
+                                           settled=None if settled is None else bool(settled[row]))
+                    output_file.write(json.dumps(result) + '\n')
+                    if store is not None:
+                        store.add(record_id=result['id'], prediction=prediction)
+
+                # Make sure chunk is on disk before checkpoint is moved.
+                output_file.flush()
+                os.fsync(output_file.fileno())
+                n_done += len(chunk)
+                write_checkpoint(path_checkpoint=path_checkpoint, offset=offset + n_done,
+                                 output_bytes=output_file.tell())
+
+                elapsed_time = time.time() - start_time
+                print(f'Classified {offset + n_done} records | {n_done / elapsed_time:.2f} docs/sec' +
+                      (f' | {n_settled} settled by first stage' if prefilter is not None else ''))
+                sys.stdout.flush()
+
+    finally:
+        # Stop workers even if a chunk failed.
+        if pool is not None:
+            pool.close()
+
+    if store is not None:
+        store.close()
+
+    return offset + n_done
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Classify a corpus of patent abstracts.')
+
+    # Path of corpus
+    parser.add_argument('--path_corpus', help='Path of JSONL, CSV or Parquet corpus file.', type=str, required=True)
+
+    # Path of output
+    parser.add_argument('--path_output', help='Path of JSONL file where predictions are written.',
+                        type=str, required=True)
+
+    # Model used
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+
+    # Path of config file with pickled models
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Corpus format
+    parser.add_argument('--corpus_format', help='Corpus format. Found from file extension if not used.',
+                        type=str, default=None, choices=['jsonl', 'csv', 'parquet'])
+
+    # Name of text field
+    parser.add_argument('--text_field', help='Name of field with text to classify.', type=str, default='abstract')
+
+    # Name of id field
+    parser.add_argument('--id_field', help='Name of field with document id.', type=str, default='id')
+
+    # Chunk size
+    parser.add_argument('--chunk_size', help='Number of records classified and written at once.',
+                        type=int, default=1024)
+
+    # Maximum batch tokens
+    parser.add_argument('--max_batch_tokens', help='Maximum number of tokens in a forward pass.',
+                        type=int, default=MAX_BATCH_TOKENS)
+
+    # Write attentions
+    parser.add_argument('--return_attentions', help='Write attentions and tokens of each document.',
+                        action='store_true')
+
+    # Resume from checkpoint
+    parser.add_argument('--resume', help='Continue from checkpoint of a previous run.', action='store_true')
+
+    # Number of worker processes
+    parser.add_argument('--n_workers', help='Number of worker processes sharing the model.', type=int, default=1)
+
+    # Cascade first stage
+    parser.add_argument('--path_prefilter', help='First stage saved by `prefilter_cascade.py`.', type=str,
+                        default=None)
+    parser.add_argument('--prefilter_threshold', help='Probability of non-fintech needed to skip the model.',
+                        type=float, default=PREFILTER_THRESHOLD)
+
+    # Compact store of predictions, attentions and tokens
+    parser.add_argument('--path_store', help='Folder where predictions are also written as a result store. See '
+                                             '`result_store.py`.', type=str, default=None)
+
+    # Early exit heads trained by `early_exit.py`
+    parser.add_argument('--early_exit', help='Stop documents at first confident layer if model has early exit heads.',
+                        action='store_true')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    total = classify_corpus(model_pickle_path=model_pickle_path_from_config(config, args.model),
+                            path_corpus=args.path_corpus, path_output=args.path_output,
+                            text_field=args.text_field, id_field=args.id_field, corpus_format=args.corpus_format,
+                            chunk_size=args.chunk_size, max_batch_tokens=args.max_batch_tokens,
+                            return_attentions=args.return_attentions, resume=args.resume,
+                            n_workers=args.n_workers, path_prefilter=args.path_prefilter,
+                            prefilter_threshold=args.prefilter_threshold, path_store=args.path_store,
+                            early_exit=args.early_exit)
+
+    print(f'\nFinished running `{__file__}`! Classified {total} records.')
+    sys.stdout.flush()
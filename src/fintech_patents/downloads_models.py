@@ -15,19 +15,237 @@
 """Download files and read configuration file"""
 
 import configparser
-import streamlit as st
-import gdown
 import os
+import re
 import sys
+import json
+import shutil
+import hashlib
 import zipfile
 import argparse
+import http.cookiejar
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from settings import CONFIG_FILE
 
+# Size of chunks read from network and from zip archives.
+CHUNK_SIZE = 1024 * 1024
 
-def download_from_config(path_config_file, path_downloaded_models, use_streamlit=False):
+
+def file_sha256(file_name):
+    r"""
+    Hash object with sha256 of a file read in chunks.
+    """
+
+    hasher = hashlib.sha256()
+
+    with open(file_name, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(CHUNK_SIZE), b''):
+            hasher.update(chunk)
+
+    return hasher
+
+
+def _open_url(opener, cookie_jar, url, start_byte=0, confirmed=False):
+    # Ask only for bytes we don't have yet.
+    request = urllib.request.Request(url, headers={'Range': f'bytes={start_byte}-'} if start_byte else {})
+    response = opener.open(request)
+
+    # Google Drive asks to confirm download of large files it can't scan for viruses.
+    if 'text/html' in response.headers.get('Content-Type', ''):
+        page = response.read().decode('utf-8', errors='ignore')
+        confirm = [cookie.value for cookie in cookie_jar if cookie.name.startswith('download_warning')]
+        confirm = confirm or re.findall(r'confirm=([0-9A-Za-z_-]+)', page)
+        # Confirm only once. A page after confirming is not a file.
+        if not confirm or confirmed:
+            raise ValueError(f'Url returned a web page instead of a file: {url}')
+        return _open_url(opener, cookie_jar, f'{url}&confirm={confirm[0]}', start_byte, confirmed=True)
+
+    return response
+
+
+def download_file(url, file_name):
+    r"""
+    Download file and resume from a partial download if one exists.
+
+    Bytes are written to `<file_name>.part` which is renamed when download is complete. If the server does not
+    support range requests the download starts over. A partial file the server says is already complete is
+    renamed, and its sha256 is returned so it is still checked.
+
+    Arguments:
+
+        url (:obj:`str`):
+            Url of file.
+
+        file_name (:obj:`str`):
+            Path where file is saved.
+
+    Returns:
+
+        :obj:`str`: sha256 of downloaded file, calculated while it is downloaded.
+    """
+
+    part_file_name = f'{file_name}.part'
+    start_byte = os.path.getsize(part_file_name) if os.path.isfile(part_file_name) else 0
+
+    # Keep cookies used by Google Drive confirm page.
+    cookie_jar = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookie_jar))
+
+    try:
+        response = _open_url(opener, cookie_jar, url, start_byte)
+    except urllib.error.HTTPError as error:
+        # Status 416 means partial file already has all bytes: a previous run stopped before renaming it.
+        if not (start_byte and error.code == 416):
+            raise
+        os.replace(part_file_name, file_name)
+        return file_sha256(file_name).hexdigest()
+
+    # Status 206 means server sends only the rest of the file.
+    if start_byte and response.status == 206:
+        hasher = file_sha256(part_file_name)
+        mode = 'ab'
+        print(f'Resume `{file_name}` from byte {start_byte}.')
+        sys.stdout.flush()
+    else:
+        hasher = hashlib.sha256()
+        mode = 'wb'
+
+    with response, open(part_file_name, mode) as part_file:
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), b''):
+            part_file.write(chunk)
+            hasher.update(chunk)
+
+    os.replace(part_file_name, file_name)
+
+    return hasher.hexdigest()
+
+
+def extract_zip(file_name, path):
+    r"""
+    Extract zip archive one member at a time reading it in chunks.
+
+    Arguments:
+
+        file_name (:obj:`str`):
+            Path of .zip file.
+
+        path (:obj:`str`):
+            Folder where archive is extracted.
+
+    Returns:
+
+        :obj:`str`: Name of main folder of archive or None if archive does not start with a folder.
+    """
+
+    path = os.path.abspath(path)
+
+    with zipfile.ZipFile(file_name, "r") as zip_ref:
+
+        # Get info of zip.
+        zip_info = zip_ref.infolist()
+
+        # Get folder name if first is a folder.
+        folder_name = os.path.normpath(zip_info[0].filename) if zip_info and zip_info[0].is_dir() else None
+
+        for member in zip_info:
+            member_path = os.path.abspath(os.path.join(path, member.filename))
+
+            # Never write outside of extract folder.
+            if os.path.commonpath([path, member_path]) != path:
+                raise ValueError(f'Zip member outside of extract folder: {member.filename}')
+
+            if member.is_dir():
+                os.makedirs(member_path, exist_ok=True)
+                continue
+
+            os.makedirs(os.path.dirname(member_path), exist_ok=True)
+            with zip_ref.open(member) as source, open(member_path, 'wb') as target:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+    return folder_name
+
+
+def marker_file(path_downloaded_models, section):
+    r"""
+    Path of file that records checksum and folder of the last archive extracted for a section.
+    """
+
+    return os.path.join(path_downloaded_models, f'.{section}.json')
+
+
+def download_section(section, download_link, path_downloaded_models, checksum=None):
+    r"""
+    Download and extract the model of one config section. Skip it if the same archive was already extracted.
+
+    Arguments:
+
+        section (:obj:`str`):
+            Name of config section.
+
+        download_link (:obj:`str`):
+            Url of .zip archive.
+
+        path_downloaded_models (:obj:`str`):
+            Where archive is extracted.
+
+        checksum (:obj:`str`, `optional`):
+            Expected sha256 of archive. Not verified if not used.
+
+    Returns:
+
+        :obj:`tuple`: Path of model folder, or None if archive has no folder, sha256 of archive and True if the
+        download was skipped.
+    """
+
+    # Check if same archive was already extracted.
+    path_marker = marker_file(path_downloaded_models, section)
+    if os.path.isfile(path_marker):
+        with open(path_marker, 'r') as marker:
+            extracted = json.load(marker)
+        model_path = os.path.join(path_downloaded_models, extracted['folder_name'])
+        if os.path.isdir(model_path) and checksum in [None, extracted['sha256']]:
+            return model_path, extracted['sha256'], True
+
+    # Get file name with path to .zip - where we will save the archive.
+    file_name = os.path.join(path_downloaded_models, f'{section}.zip')
+
+    # Download the .zip.
+    sha256 = download_file(url=download_link, file_name=file_name)
+
+    if checksum is not None and sha256 != checksum:
+        os.remove(file_name)
+        raise ValueError(f'Checksum of `{section}` archive is {sha256} but {checksum} was expected!')
+
+    # File .zip exists. Let's unzip it
+    folder_name = extract_zip(file_name=file_name, path=path_downloaded_models)
+
+    # Remove .zip to keep memory clean
+    try:
+        os.remove(file_name)
+    except OSError as e:
+        print("Error: %s : %s" % (file_name, e.strerror))
+        sys.stdout.flush()
+
+    if folder_name is None:
+        return None, sha256, False
+
+    # Remember what was extracted.
+    with open(path_marker, 'w') as marker:
+        json.dump({'sha256': sha256, 'folder_name': folder_name}, marker)
+
+    return os.path.join(path_downloaded_models, folder_name), sha256, False
+
+
+def download_from_config(path_config_file, path_downloaded_models, use_streamlit=False, max_workers=4,
+                         record_checksums=False):
     r"""
     Download all pretrained models using config file and updating the config file with each model's path.
 
+    Sections are downloaded at the same time. Partial downloads are resumed, archives are checked against the
+    `sha256` of their section when it is set and models already extracted from the same archive are skipped.
+
     Arguments:
 
         path_config_file:
@@ -35,51 +253,53 @@ def download_from_config(path_config_file, path_downloaded_models, use_streamlit
         path_downloaded_models:
             this is where we download all models
 
+        use_streamlit:
+            Show progress in streamlit app.
+
+        max_workers:
+            Number of sections downloaded at the same time.
+
+        record_checksums:
+            Write sha256 of each archive in `path_config_file` for sections that don't have one.
+
 
     """
 
+    # Streamlit is only needed to show progress in the app.
+    if use_streamlit:
+        import streamlit as st
+
     # Create config parser.
     config = configparser.ConfigParser()
 
     # Read config file from path.
     config.read(path_config_file)
 
-    # Parse each section in the config file.
-    for section in config.sections():
-
-        # Streamlit info
-        if use_streamlit:
-            st.write(f'  `{section}`')
-
-        # Get the Google Drive download link
-        download_link = config.get(section, 'google_drive_zip_link', fallback=None)
+    checksums_added = False
 
-        # Get file name with path to .zip - where we will save the archive.
-        file_name = os.path.join(path_downloaded_models, f'{section}.zip')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        # Parse each section in the config file.
+        futures = {executor.submit(download_section, section=section,
+                                   download_link=config.get(section, 'google_drive_zip_link', fallback=None),
+                                   path_downloaded_models=path_downloaded_models,
+                                   checksum=config.get(section, 'sha256', fallback=None)): section
+                   for section in config.sections()}
 
-        # Download the .zip from Google Drive.
-        gdown.download(url=download_link, output=file_name, quiet=False)
+        # Streamlit can only write from main thread.
+        for future in as_completed(futures):
+            section = futures[future]
+            model_path, sha256, skipped = future.result()
 
-        # Check if file actually exists
-        if os.path.isfile(file_name):
-
-            # File .zip exists. Let's unzip it
-            with zipfile.ZipFile(file_name, "r") as zip_ref:
-
-                # Get info of zip.
-                zip_info = zip_ref.infolist()
-
-                # Get folder name if first is a folder.
-                folder_name = zip_info[0].filename if zip_info[0].is_dir() else None
-
-                # Normalize folder name
-                folder_name = os.path.normpath(folder_name)
+            # Streamlit info
+            if use_streamlit:
+                st.write(f'  `{section}`')
 
-                # Extract all zip components.
-                zip_ref.extractall(path=path_downloaded_models)
+            if not config.has_option(section, 'sha256'):
+                config.set(section, 'sha256', sha256)
+                checksums_added = True
 
             # Find out name of new folder
-            if folder_name is None:
+            if model_path is None:
 
                 # .zip does not have a main folder. Skip this section of config file.
                 print('Zip does not have folder!')
@@ -87,26 +307,29 @@ def download_from_config(path_config_file, path_downloaded_models, use_streamlit
                 continue
 
             # Add model path to section.
-            config.set(section, 'model_path', os.path.join(path_downloaded_models, folder_name))
+            config.set(section, 'model_path', model_path)
 
             # Print info of model path.
-            print(f'Unzip to: {os.path.join(path_downloaded_models, folder_name)}')
+            print(f'{"Up to date" if skipped else "Unzip to"}: {model_path}')
             sys.stdout.flush()
 
             # Streamlit info
             if use_streamlit:
-                st.write(f'  Unzip to: `{os.path.join(path_downloaded_models, folder_name)}`')
+                st.write(f'  {"Up to date" if skipped else "Unzip to"}: `{model_path}`')
 
-            # Remove .zip to keep memory clean
-            try:
-                os.remove(file_name)
-            except OSError as e:
-                print("Error: %s : %s" % (file_name, e.strerror))
-                sys.stdout.flush()
+            # Separation line.
+            print('--------------------------------------------------------------------------------------')
+            sys.stdout.flush()
 
-        # Separation line.
-        print('--------------------------------------------------------------------------------------')
-        sys.stdout.flush()
+    # Record checksums of archives downloaded for the first time.
+    if record_checksums and checksums_added:
+        models_config = configparser.ConfigParser()
+        models_config.read(path_config_file)
+        for section in models_config.sections():
+            if not models_config.has_option(section, 'sha256'):
+                models_config.set(section, 'sha256', config.get(section, 'sha256'))
+        with open(path_config_file, 'w') as configfile:
+            models_config.write(configfile)
 
     # Writing updated configuration file with `model_path` added.
     with open(CONFIG_FILE, 'w') as configfile:
@@ -129,6 +352,13 @@ if __name__ == '__main__':
     parser.add_argument('--path_models', help='Path where all pretrained models are stored pickled.',
                         type=str, default='pretrained_models')
 
+    # Number of parallel downloads
+    parser.add_argument('--max_workers', help='Number of models downloaded at the same time.', type=int, default=4)
+
+    # Record checksums
+    parser.add_argument('--record_checksums', help='Write sha256 of downloaded archives in config file.',
+                        action='store_true')
+
     # Parse arguments
     args = parser.parse_args()
 
@@ -136,7 +366,8 @@ if __name__ == '__main__':
     os.mkdir(args.path_models) if not os.path.isdir(args.path_models) else None
 
     # Download all pretrained models and updated config file
-    download_from_config(args.path_config_file, args.path_models)
+    download_from_config(args.path_config_file, args.path_models, max_workers=args.max_workers,
+                         record_checksums=args.record_checksums)
 
     print(f'\nFinished running `{__file__}`!')
     sys.stdout.flush()
@@ -0,0 +1,536 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Early exit: small classification heads on intermediate layers let easy documents skip the last layers.
+
+A linear head is trained on the first token of each layer but the last. Each head has a confidence threshold for
+each label, calibrated on held out documents. At inference a document leaves the batch at the first layer whose
+head is confident enough, the rest of the batch keeps going.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import configparser
+import numpy as np
+from classify_corpus import CORPUS_FORMATS, read_corpus
+from inference_modeling import length_buckets, predict_batch, predictions_from_logits, softmax
+from model_registry import get_model_tokenizer, model_pickle_path_from_config
+from tokenization import encode_batch
+from metrics import increment, timer
+from settings import CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS
+
+
+class DistilBertAdapter(object):
+    r"""
+    Run a `DistilBertForSequenceClassification` one layer at a time.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.layers = list(model.distilbert.transformer.layer)
+
+    def embed(self, input_ids):
+        return self.model.distilbert.embeddings(input_ids)
+
+    def run_layer(self, layer, hidden_states, attention_mask):
+        # Last output of a block is its hidden states.
+        return layer(hidden_states, attention_mask, None, False)[-1]
+
+    def classify(self, hidden_states):
+        import torch
+
+        pooled = torch.relu(self.model.pre_classifier(hidden_states[:, 0]))
+
+        return self.model.classifier(pooled)
+
+
+class RobertaAdapter(object):
+    r"""
+    Run a `RobertaForSequenceClassification` one layer at a time. Works for `BertLayer` based RoBERTa models like
+    DistilRoBERTa.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.layers = list(model.roberta.encoder.layer)
+
+    def embed(self, input_ids):
+        return self.model.roberta.embeddings(input_ids=input_ids)
+
+    def run_layer(self, layer, hidden_states, attention_mask):
+        # Padding gets a large negative score before softmax.
+        extended_mask = (1.0 - attention_mask[:, None, None, :].to(hidden_states.dtype)) * -10000.0
+
+        return layer(hidden_states, attention_mask=extended_mask)[0]
+
+    def classify(self, hidden_states):
+        return self.model.classifier(hidden_states)
+
+
+# Adapter of each `model_type` of transformers config.
+MODEL_ADAPTERS = {'distilbert': DistilBertAdapter, 'roberta': RobertaAdapter}
+
+
+def model_adapter(model):
+    r"""
+    Adapter that runs model one layer at a time.
+    """
+
+    model_type = getattr(getattr(model, 'config', None), 'model_type', None)
+    if model_type not in MODEL_ADAPTERS:
+        raise ValueError(f'Early exit does not support model type `{model_type}`! Use one of: '
+                         f'{list(MODEL_ADAPTERS)}')
+
+    return MODEL_ADAPTERS[model_type](model)
+
+
+class EarlyExitHeads(object):
+    r"""
+    Linear heads of all layers but the last, and their confidence thresholds.
+
+    Arguments:
+
+        weights (:obj:`np.ndarray`):
+            Weights of shape [number of heads, number of labels, hidden size].
+
+        biases (:obj:`np.ndarray`):
+            Biases of shape [number of heads, number of labels].
+
+        thresholds (:obj:`np.ndarray`):
+            Confidence from 0 to 1 a head needs to exit with a label, of shape [number of heads, number of labels].
+            Infinite when a head never exits with a label.
+    """
+
+    def __init__(self, weights, biases, thresholds):
+        self.weights = np.asarray(weights, dtype=np.float32)
+        self.biases = np.asarray(biases, dtype=np.float32)
+        self.thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    def save(self, path):
+        r"""
+        Save heads to a `.npz` file.
+        """
+
+        np.savez_compressed(path, weights=self.weights, biases=self.biases, thresholds=self.thresholds)
+
+        return
+
+    @classmethod
+    def load(cls, path):
+        r"""
+        Load heads saved with `save`.
+        """
+
+        data = np.load(path)
+
+        return cls(weights=data['weights'], biases=data['biases'], thresholds=data['thresholds'])
+
+
+def heads_path(model_pickle_path):
+    r"""
+    Default path of heads of a model, next to its pickle.
+    """
+
+    return f'{os.path.splitext(model_pickle_path)[0]}_early_exit.npz'
+
+
+# Path of heads -> modification time and loaded heads.
+_LOADED_HEADS = {}
+
+
+def load_model_heads(model_pickle_path):
+    r"""
+    Heads saved next to a model at `heads_path`, or None if the model has none. Heads are loaded once, and again
+    only if their file changes.
+    """
+
+    path = heads_path(model_pickle_path)
+    if not os.path.isfile(path):
+        return None
+
+    modified = os.stat(path).st_mtime_ns
+    if path not in _LOADED_HEADS or _LOADED_HEADS[path][0] != modified:
+        _LOADED_HEADS[path] = (modified, EarlyExitHeads.load(path))
+
+    return _LOADED_HEADS[path][1]
+
+
+def layers_first_tokens(adapter, inputs):
+    r"""
+    Run all layers and keep first token of each layer.
+
+    Returns:
+
+        :obj:`tuple`: Array of first token hidden states of shape [number of layers, batch size, hidden size] and
+        logits of full model of shape [batch size, number of labels].
+    """
+
+    import torch
+
+    first_tokens = []
+    with torch.no_grad():
+        hidden_states = adapter.embed(inputs['input_ids'])
+        for layer in adapter.layers:
+            hidden_states = adapter.run_layer(layer, hidden_states, inputs['attention_mask'])
+            first_tokens.append(hidden_states[:, 0].cpu().numpy())
+        logits = adapter.classify(hidden_states).cpu().numpy()
+
+    return np.stack(first_tokens), logits
+
+
+def early_exit_forward(adapter, heads, inputs):
+    r"""
+    Forward pass where each document stops at the first head confident in its label.
+
+    Documents that exit leave the batch, and padding no remaining document needs is cut, so later layers run on
+    fewer and shorter rows.
+
+    Returns:
+
+        :obj:`tuple`: Logits of shape [batch size, number of labels], from the head each document exited at or from
+        the model classifier, and number of layers run for each document.
+    """
+
+    import torch
+
+    n_layers = len(adapter.layers)
+    weights = torch.from_numpy(heads.weights)
+    biases = torch.from_numpy(heads.biases)
+    thresholds = torch.from_numpy(heads.thresholds)
+
+    attention_mask = inputs['attention_mask']
+    batch_size = attention_mask.shape[0]
+    logits = np.zeros((batch_size, weights.shape[1]), dtype=np.float32)
+    layers_run = np.full(batch_size, n_layers)
+    # Rows of batch still running.
+    active = np.arange(batch_size)
+
+    with torch.no_grad():
+        hidden_states = adapter.embed(inputs['input_ids'])
+
+        for index, layer in enumerate(adapter.layers):
+            hidden_states = adapter.run_layer(layer, hidden_states, attention_mask)
+
+            if index == n_layers - 1:
+                logits[active] = adapter.classify(hidden_states).cpu().numpy()
+                break
+
+            head_logits = hidden_states[:, 0] @ weights[index].T + biases[index]
+            confidences, labels = torch.softmax(head_logits, dim=-1).max(dim=-1)
+            exits = (confidences >= thresholds[index][labels]).numpy()
+            if not exits.any():
+                continue
+
+            logits[active[exits]] = head_logits[torch.from_numpy(exits)].numpy()
+            layers_run[active[exits]] = index + 1
+            keep = torch.from_numpy(~exits)
+            active = active[~exits]
+            if not len(active):
+                break
+
+            # Padding is on the right, so columns past longest remaining document can go.
+            attention_mask = attention_mask[keep]
+            length = int(attention_mask.sum(dim=1).max())
+            attention_mask = attention_mask[:, :length]
+            hidden_states = hidden_states[keep][:, :length]
+
+    return logits, layers_run
+
+
+def early_exit_batch(tokenizer, model, texts, heads, ids_labels=IDS_LABELS, max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Predict multiple documents with early exit using length bucketed batches, like `predict_batch`.
+
+    Returns:
+
+        :obj:`tuple`: Tuples of label, labels percentages, attentions and tokens in same order as `texts`, and
+        array with number of layers run for each document. Attentions and tokens are None.
+    """
+
+    adapter = model_adapter(model)
+    texts = list(texts)
+    encodings, _ = encode_batch(tokenizer=tokenizer, texts=texts)
+    lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+
+    results = [None] * len(texts)
+    layers_run = np.zeros(len(texts), dtype=np.int64)
+
+    for batch in length_buckets(lengths=lengths, max_batch_tokens=max_batch_tokens):
+        inputs = tokenizer.pad({key: [values[index] for index in batch] for key, values in encodings.items()},
+                               padding=True, return_tensors='pt')
+
+        with timer('forward_early_exit'):
+            logits, batch_layers = early_exit_forward(adapter=adapter, heads=heads, inputs=inputs)
+        increment('forward_passes_total')
+
+        for index, prediction, n_layers in zip(batch, predictions_from_logits(logits, ids_labels), batch_layers):
+            results[index] = prediction + (None, None)
+            layers_run[index] = n_layers
+
+    increment('early_exit_layers_total', int(layers_run.sum()))
+
+    return results, layers_run
+
+
+def calibrate_thresholds(probabilities, references, target_accuracy=0.99, min_support=5):
+    r"""
+    Lowest confidence for each label where predictions of a head at least that confident are right often enough.
+
+    Arguments:
+
+        probabilities (:obj:`np.ndarray`):
+            Head probabilities of shape [number of documents, number of labels].
+
+        references (:obj:`np.ndarray`):
+            Reference label id of each document.
+
+        target_accuracy (:obj:`float`, `optional`, defaults to :obj:`0.99`):
+            Share of exits that need to match the reference.
+
+        min_support (:obj:`int`, `optional`, defaults to :obj:`5`):
+            Fewest documents needed to set a threshold for a label.
+
+    Returns:
+
+        :obj:`np.ndarray`: Threshold of each label. Infinite for labels head never exits with.
+    """
+
+    predicted = probabilities.argmax(axis=-1)
+    confidences = probabilities.max(axis=-1)
+    thresholds = np.full(probabilities.shape[1], np.inf)
+
+    for label_id in range(probabilities.shape[1]):
+        label_rows = np.flatnonzero(predicted == label_id)
+        # Most confident first.
+        label_rows = label_rows[np.argsort(-confidences[label_rows], kind='stable')]
+        correct = np.cumsum(references[label_rows] == label_id)
+        accuracies = correct / np.arange(1, len(label_rows) + 1)
+        passing = np.flatnonzero((accuracies >= target_accuracy) & (np.arange(1, len(label_rows) + 1) >= min_support))
+        if len(passing):
+            thresholds[label_id] = confidences[label_rows[passing[-1]]]
+
+    return thresholds
+
+
+def train_heads(tokenizer, model, texts, label_ids=None, calibration_share=0.3, target_accuracy=0.99,
+                max_batch_tokens=MAX_BATCH_TOKENS, l2=1e-3, seed=0):
+    r"""
+    Train a linear head on first token of each layer but the last and calibrate its thresholds.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model.
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model with frozen weights.
+
+        texts (:obj:`list`):
+            Text of each document of sample.
+
+        label_ids (:obj:`list`, `optional`):
+            Label id of each document. Labels of the full model are used if not given, so heads learn to agree
+            with it.
+
+        calibration_share (:obj:`float`, `optional`, defaults to :obj:`0.3`):
+            Share of documents held out to calibrate thresholds.
+
+        target_accuracy (:obj:`float`, `optional`, defaults to :obj:`0.99`):
+            Share of exits of each label that need to match reference labels on held out documents.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        l2 (:obj:`float`, `optional`, defaults to :obj:`1e-3`):
+            L2 regularization of heads.
+
+        seed (:obj:`int`, `optional`, defaults to :obj:`0`):
+            Seed of held out split.
+
+    Returns:
+
+        :obj:`EarlyExitHeads`: Trained heads.
+    """
+
+    import torch
+
+    adapter = model_adapter(model)
+    texts = list(texts)
+    encodings, _ = encode_batch(tokenizer=tokenizer, texts=texts)
+    lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+
+    features, full_logits = None, None
+    for batch in length_buckets(lengths=lengths, max_batch_tokens=max_batch_tokens):
+        inputs = tokenizer.pad({key: [values[index] for index in batch] for key, values in encodings.items()},
+                               padding=True, return_tensors='pt')
+        batch_features, batch_logits = layers_first_tokens(adapter=adapter, inputs=inputs)
+        if features is None:
+            features = np.zeros((batch_features.shape[0], len(texts), batch_features.shape[2]), dtype=np.float32)
+            full_logits = np.zeros((len(texts), batch_logits.shape[1]), dtype=np.float32)
+        features[:, batch] = batch_features
+        full_logits[batch] = batch_logits
+
+    references = full_logits.argmax(axis=-1) if label_ids is None else np.asarray(label_ids)
+    n_labels = full_logits.shape[1]
+
+    order = np.random.RandomState(seed).permutation(len(texts))
+    n_calibration = int(round(calibration_share * len(texts)))
+    calibration_rows, train_rows = order[:n_calibration], order[n_calibration:]
+
+    # Last layer already has the model classifier.
+    n_heads = features.shape[0] - 1
+    weights = np.zeros((n_heads, n_labels, features.shape[2]), dtype=np.float32)
+    biases = np.zeros((n_heads, n_labels), dtype=np.float32)
+    thresholds = np.full((n_heads, n_labels), np.inf)
+    targets = torch.from_numpy(references[train_rows]).long()
+
+    for head in range(n_heads):
+        inputs = torch.from_numpy(features[head, train_rows])
+        linear = torch.nn.Linear(features.shape[2], n_labels)
+        optimizer = torch.optim.LBFGS(linear.parameters(), max_iter=100)
+
+        def closure():
+            optimizer.zero_grad()
+            loss = torch.nn.functional.cross_entropy(linear(inputs), targets) + l2 * linear.weight.pow(2).sum()
+            loss.backward()
+            return loss
+
+        optimizer.step(closure)
+
+        weights[head] = linear.weight.detach().numpy()
+        biases[head] = linear.bias.detach().numpy()
+        calibration_logits = features[head, calibration_rows] @ weights[head].T + biases[head]
+        thresholds[head] = calibrate_thresholds(probabilities=softmax(vector=calibration_logits),
+                                                references=references[calibration_rows],
+                                                target_accuracy=target_accuracy)
+
+    return EarlyExitHeads(weights=weights, biases=biases, thresholds=thresholds)
+
+
+def early_exit_report(tokenizer, model, texts, heads, ids_labels=IDS_LABELS, max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Compare early exit against the full-depth model on the same documents.
+
+    Returns:
+
+        :obj:`dict`: Average layers run, share of documents exiting at each layer, label agreement with full model,
+        seconds of both and speedup.
+    """
+
+    # Run once first so only predictions are timed.
+    predict_batch(tokenizer=tokenizer, model=model, texts=texts[:1], ids_labels=ids_labels)
+
+    start_time = time.time()
+    full_predictions = predict_batch(tokenizer=tokenizer, model=model, texts=texts, ids_labels=ids_labels,
+                                     max_batch_tokens=max_batch_tokens)
+    full_seconds = time.time() - start_time
+
+    start_time = time.time()
+    predictions, layers_run = early_exit_batch(tokenizer=tokenizer, model=model, texts=texts, heads=heads,
+                                               ids_labels=ids_labels, max_batch_tokens=max_batch_tokens)
+    early_exit_seconds = time.time() - start_time
+
+    n_layers = heads.weights.shape[0] + 1
+    agreement = np.mean([label == full_label for (label, _, _, _), (full_label, _, _, _) in
+                         zip(predictions, full_predictions)])
+
+    return {'n_documents': len(texts),
+            'n_layers': n_layers,
+            'average_layers': round(float(layers_run.mean()), 3),
+            'exit_share': {layer: round(100 * float(np.mean(layers_run == layer)), 2)
+                           for layer in range(1, n_layers + 1)},
+            'label_agreement': round(100 * float(agreement), 2),
+            'full_seconds': round(full_seconds, 3),
+            'early_exit_seconds': round(early_exit_seconds, 3),
+            'speedup': round(full_seconds / early_exit_seconds, 2)}
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Train early exit heads of a model and compare them against the '
+                                                 'full-depth model.')
+
+    # Labeled sample
+    parser.add_argument('--path_corpus', help='Path of JSONL, CSV or Parquet corpus file.', type=str, required=True)
+    parser.add_argument('--corpus_format', help='Corpus format. Found from file extension if not used.',
+                        type=str, default=None, choices=sorted(set(CORPUS_FORMATS.values())))
+    parser.add_argument('--text_field', help='Name of field with text.', type=str, default='abstract')
+    parser.add_argument('--label_field', help='Name of field with label name. Labels of full model are used if '
+                                              'not set.', type=str, default=None)
+    parser.add_argument('--n_train', help='Number of documents used to train and calibrate heads.', type=int,
+                        default=5000)
+    parser.add_argument('--n_eval', help='Number of next documents used in report.', type=int, default=1000)
+
+    # Model
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Heads
+    parser.add_argument('--target_accuracy', help='Share of exits that need to match reference labels.',
+                        type=float, default=0.99)
+    parser.add_argument('--path_heads', help='File where heads are saved. Next to model pickle if not used.',
+                        type=str, default=None)
+    parser.add_argument('--path_output', help='JSON file where report is written.', type=str, default=None)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    model_path = model_pickle_path_from_config(config, args.model)
+    model_tokenizer, model_loaded = get_model_tokenizer(model_path)
+
+    records = list(itertools.islice(read_corpus(path_corpus=args.path_corpus, corpus_format=args.corpus_format),
+                                    args.n_train + args.n_eval))
+    corpus_texts = [record.get(args.text_field) or '' for record in records]
+    labels_ids = {label: label_id for label_id, label in IDS_LABELS.items()}
+    sample_labels = None if args.label_field is None else [labels_ids[record[args.label_field]]
+                                                           for record in records[:args.n_train]]
+
+    start = time.time()
+    exit_heads = train_heads(tokenizer=model_tokenizer, model=model_loaded, texts=corpus_texts[:args.n_train],
+                             label_ids=sample_labels, target_accuracy=args.target_accuracy)
+    path_heads = args.path_heads or heads_path(model_path)
+    exit_heads.save(path_heads)
+    print(f'Trained {exit_heads.weights.shape[0]} heads in {time.time() - start:.2f} seconds. '
+          f'Saved to `{path_heads}`.')
+    sys.stdout.flush()
+
+    if corpus_texts[args.n_train:]:
+        report = early_exit_report(tokenizer=model_tokenizer, model=model_loaded, texts=corpus_texts[args.n_train:],
+                                   heads=exit_heads)
+        print(f'Average layers {report["average_layers"]} of {report["n_layers"]} | agreement with full model '
+              f'{report["label_agreement"]}% | {report["full_seconds"]} -> {report["early_exit_seconds"]} seconds '
+              f'({report["speedup"]}x)')
+        print(f'Exits at each layer (%): {report["exit_share"]}')
+        sys.stdout.flush()
+
+        if args.path_output is not None:
+            with open(args.path_output, 'w') as output_file:
+                json.dump(report, output_file, indent=2)
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
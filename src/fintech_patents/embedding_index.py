@@ -0,0 +1,456 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Index of patent embeddings for similar patents search.
+
+An index is a folder with:
+    embeddings.f32    Normalized float32 embeddings, one row per patent, read memory mapped.
+    ids.jsonl         Id and predicted label of each row.
+    index.json        Embedding size, number of rows and model used.
+
+New patents are appended at the end without rebuilding anything.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+import configparser
+import numpy as np
+from classify_corpus import CORPUS_FORMATS, read_corpus
+from inference_modeling import length_buckets, predictions_from_logits
+from model_registry import get_model_tokenizer, model_pickle_path_from_config
+from tokenization import encode_batch
+from metrics import timer
+from settings import CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS
+
+# Files of an index folder.
+EMBEDDINGS_FILE = 'embeddings.f32'
+IDS_FILE = 'ids.jsonl'
+INDEX_META_FILE = 'index.json'
+
+
+def embed_batch(tokenizer, model, texts, ids_labels=IDS_LABELS, max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Predict labels and embed documents in the same forward pass.
+
+    Embedding of a document is the mean of last layer hidden states over its tokens, normalized to length 1 so dot
+    products are cosine similarities.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model.
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model used. Needs to be a PyTorch model.
+
+        texts (:obj:`list`):
+            Text of each document.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+    Returns:
+
+        :obj:`tuple`: Embeddings as float32 array of shape [number of documents, hidden size] and predicted label of
+        each document.
+    """
+
+    if not hasattr(model, 'base_model'):
+        raise ValueError('Embeddings need a PyTorch transformers model. ONNX models only return logits.')
+
+    encodings, _ = encode_batch(tokenizer=tokenizer, texts=texts)
+    lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+
+    import torch
+
+    embeddings = [None] * len(lengths)
+    labels = [None] * len(lengths)
+
+    for batch in length_buckets(lengths=lengths, max_batch_tokens=max_batch_tokens):
+        inputs = tokenizer.pad({key: [values[index] for index in batch] for key, values in encodings.items()},
+                               padding=True, return_tensors='pt')
+
+        with timer('embed'):
+            # Last hidden states are output of base model, returned by this call only. Model is shared by threads,
+            # so nothing is hooked on it.
+            with torch.no_grad():
+                outputs = model.forward(**inputs, output_attentions=False, output_hidden_states=True,
+                                        return_dict=True)
+            logits = outputs['logits'].detach().cpu().numpy()
+            states = outputs['hidden_states'][-1].detach().cpu().numpy()
+
+            # Mean over tokens without padding.
+            mask = inputs['attention_mask'].cpu().numpy()[:, :, None].astype(np.float32)
+            pooled = (states * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1)
+            pooled /= np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+
+        for row, (index, (label, _)) in enumerate(zip(batch, predictions_from_logits(logits, ids_labels))):
+            embeddings[index] = pooled[row]
+            labels[index] = label
+
+    return np.array(embeddings, dtype=np.float32).reshape(len(lengths), -1), labels
+
+
+class EmbeddingIndex(object):
+    r"""
+    Exact nearest neighbours search over memory mapped embeddings.
+
+    Embeddings are never loaded in memory all at once. Search goes through them in chunks with one matrix product
+    each and keeps only the best `k` of each chunk.
+
+    Arguments:
+
+        path_index (:obj:`str`):
+            Folder of index. Created if it does not exist.
+
+        model_pickle_path (:obj:`str`, `optional`):
+            Model used to embed patents. Needed only to create a new index.
+    """
+
+    def __init__(self, path_index, model_pickle_path=None):
+
+        self.path_index = path_index
+        self._embeddings = None
+
+        path_meta = os.path.join(path_index, INDEX_META_FILE)
+        if os.path.isfile(path_meta):
+            with open(path_meta, 'r') as meta_file:
+                self.meta = json.load(meta_file)
+        else:
+            if model_pickle_path is None:
+                raise ValueError(f'No index in `{path_index}`! Use `model_pickle_path` to create one.')
+            os.makedirs(path_index, exist_ok=True)
+            self.meta = {'model_pickle_path': model_pickle_path, 'dim': None, 'count': 0}
+
+        # Rows appended after a crash, before index.json was updated, are dropped.
+        self._ids = self._read_ids()
+        if len(self._ids) > len(self):
+            self._truncate()
+
+    def __len__(self):
+        return self.meta['count']
+
+    @property
+    def model_pickle_path(self):
+        return self.meta['model_pickle_path']
+
+    def _path(self, file_name):
+        return os.path.join(self.path_index, file_name)
+
+    def _read_ids(self):
+        if not os.path.isfile(self._path(IDS_FILE)):
+            return []
+        with open(self._path(IDS_FILE), 'r', encoding='utf-8') as ids_file:
+            return [json.loads(line) for line in ids_file]
+
+    def _truncate(self):
+        # Keep only rows counted in index.json.
+        self._ids = self._ids[:len(self)]
+        with open(self._path(IDS_FILE), 'w', encoding='utf-8') as ids_file:
+            ids_file.writelines(json.dumps(entry) + '\n' for entry in self._ids)
+        if self.meta['dim'] is not None:
+            with open(self._path(EMBEDDINGS_FILE), 'r+b') as embeddings_file:
+                embeddings_file.truncate(len(self) * self.meta['dim'] * 4)
+
+        return
+
+    def embeddings(self):
+        r"""
+        Memory mapped embeddings of shape [number of rows, hidden size].
+        """
+
+        if self._embeddings is None or len(self._embeddings) != len(self):
+            self._embeddings = np.memmap(self._path(EMBEDDINGS_FILE), dtype=np.float32, mode='r',
+                                         shape=(len(self), self.meta['dim'])) if len(self) else \
+                np.zeros((0, self.meta['dim'] or 0), dtype=np.float32)
+
+        return self._embeddings
+
+    def ids(self):
+        r"""
+        Set of ids already in index.
+        """
+
+        return set(entry['id'] for entry in self._ids)
+
+    def append(self, ids, embeddings, labels):
+        r"""
+        Add new rows at the end of index.
+
+        Arguments:
+
+            ids (:obj:`list`):
+                Id of each patent.
+
+            embeddings (:obj:`np.ndarray`):
+                Normalized embeddings of shape [number of patents, hidden size].
+
+            labels (:obj:`list`):
+                Predicted label of each patent.
+        """
+
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+
+        if self.meta['dim'] is None:
+            self.meta['dim'] = int(embeddings.shape[1])
+        elif embeddings.shape[1] != self.meta['dim']:
+            raise ValueError(f'Embeddings have size {embeddings.shape[1]} but index uses {self.meta["dim"]}!')
+
+        new_ids = [{'id': patent_id, 'label': label} for patent_id, label in zip(ids, labels)]
+
+        # Embeddings written past the rows counted by a crashed append are dropped.
+        if self.meta['dim'] is not None and os.path.isfile(self._path(EMBEDDINGS_FILE)) and \
+                os.path.getsize(self._path(EMBEDDINGS_FILE)) != len(self) * self.meta['dim'] * 4:
+            self._truncate()
+
+        with open(self._path(EMBEDDINGS_FILE), 'ab') as embeddings_file:
+            embeddings_file.write(embeddings.tobytes())
+        with open(self._path(IDS_FILE), 'a', encoding='utf-8') as ids_file:
+            ids_file.writelines(json.dumps(entry) + '\n' for entry in new_ids)
+
+        # Rows count only once index.json says so.
+        self.meta['count'] += len(new_ids)
+        path_meta = self._path(INDEX_META_FILE)
+        with open(f'{path_meta}.tmp', 'w') as meta_file:
+            json.dump(self.meta, meta_file)
+        os.replace(f'{path_meta}.tmp', path_meta)
+
+        self._ids.extend(new_ids)
+
+        return
+
+    def search(self, query_embeddings, k=10, chunk_size=65536):
+        r"""
+        Find the `k` most similar rows of each query.
+
+        Arguments:
+
+            query_embeddings (:obj:`np.ndarray`):
+                Normalized embeddings of shape [number of queries, hidden size].
+
+            k (:obj:`int`, `optional`, defaults to :obj:`10`):
+                Number of neighbours of each query.
+
+            chunk_size (:obj:`int`, `optional`, defaults to :obj:`65536`):
+                Rows compared at once.
+
+        Returns:
+
+            :obj:`list`: For each query a list of dictionaries with id, label and cosine similarity, most similar
+            first.
+        """
+
+        queries = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+        embeddings = self.embeddings()
+        k = min(k, len(embeddings))
+
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+
+        for start in range(0, len(embeddings), chunk_size):
+            scores = queries @ np.asarray(embeddings[start:start + chunk_size]).T
+            # Best rows of chunk, not sorted.
+            chunk_k = min(k, scores.shape[1])
+            rows = np.argpartition(-scores, chunk_k - 1, axis=1)[:, :chunk_k]
+            best_scores = np.concatenate([best_scores, np.take_along_axis(scores, rows, axis=1)], axis=1)
+            best_rows = np.concatenate([best_rows, rows + start], axis=1)
+
+            # Keep only best `k` found so far.
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+
+        order = np.argsort(-best_scores, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+
+        return [[{'id': self._ids[row]['id'], 'label': self._ids[row]['label'], 'score': round(float(score), 4)}
+                 for row, score in zip(rows, scores)] for rows, scores in zip(best_rows, best_scores)]
+
+
+# Folder of index -> modification time of its meta file and opened index. Kept across app reruns.
+_OPEN_INDEXES = {}
+
+
+def get_embedding_index(path_index):
+    r"""
+    Open an index once per process, like models in `model_registry.MODEL_REGISTRY`. It is opened again only if
+    patents were added to it since.
+    """
+
+    path_index = os.path.abspath(path_index)
+    path_meta = os.path.join(path_index, INDEX_META_FILE)
+    modified = os.stat(path_meta).st_mtime_ns if os.path.isfile(path_meta) else None
+
+    if path_index not in _OPEN_INDEXES or _OPEN_INDEXES[path_index][0] != modified:
+        _OPEN_INDEXES[path_index] = (modified, EmbeddingIndex(path_index=path_index))
+
+    return _OPEN_INDEXES[path_index][1]
+
+
+def similar_patents(index, text, k=10):
+    r"""
+    Embed a text with model of index and find the most similar patents.
+
+    Arguments:
+
+        index (:obj:`EmbeddingIndex`):
+            Index searched.
+
+        text (:obj:`str`):
+            Text of patent.
+
+        k (:obj:`int`, `optional`, defaults to :obj:`10`):
+            Number of similar patents.
+
+    Returns:
+
+        :obj:`list`: Dictionaries with id, label and cosine similarity, most similar first.
+    """
+
+    tokenizer, model = get_model_tokenizer(index.model_pickle_path)
+    embeddings, _ = embed_batch(tokenizer=tokenizer, model=model, texts=[text])
+
+    with timer('similar_search'):
+        return index.search(query_embeddings=embeddings, k=k)[0]
+
+
+def build_index(model_pickle_path, path_corpus, path_index, text_field='abstract', id_field='id',
+                corpus_format=None, chunk_size=1024, max_batch_tokens=MAX_BATCH_TOKENS, ids_labels=IDS_LABELS):
+    r"""
+    Classify and embed a corpus in one pass and add it to an index. Patents already in the index are skipped, so
+    running it again with a corpus that has new patents only appends them.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of model used. An existing index keeps using the model it was built with.
+
+        path_corpus (:obj:`str`):
+            Path of JSONL, CSV or Parquet file.
+
+        path_index (:obj:`str`):
+            Folder of index.
+
+        text_field (:obj:`str`, `optional`, defaults to :obj:`abstract`):
+            Field with text of each record.
+
+        id_field (:obj:`str`, `optional`, defaults to :obj:`id`):
+            Field with id of each record. Records without one use their row number.
+
+        corpus_format (:obj:`str`, `optional`):
+            Format of corpus. Found from file extension if not used.
+
+        chunk_size (:obj:`int`, `optional`, defaults to :obj:`1024`):
+            Number of records embedded and appended at once.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+    Returns:
+
+        :obj:`EmbeddingIndex`: Index with corpus added.
+    """
+
+    index = EmbeddingIndex(path_index=path_index, model_pickle_path=model_pickle_path)
+    tokenizer, model = get_model_tokenizer(index.model_pickle_path)
+    known_ids = index.ids()
+
+    records = ((record.get(id_field, row), record.get(text_field) or '')
+               for row, record in enumerate(read_corpus(path_corpus=path_corpus, corpus_format=corpus_format)))
+    new_records = ((patent_id, text) for patent_id, text in records if patent_id not in known_ids)
+
+    start_time = time.time()
+    n_done = 0
+
+    while True:
+        chunk = list(itertools.islice(new_records, chunk_size))
+        if not chunk:
+            break
+
+        embeddings, labels = embed_batch(tokenizer=tokenizer, model=model, texts=[text for _, text in chunk],
+                                         ids_labels=ids_labels, max_batch_tokens=max_batch_tokens)
+        index.append(ids=[patent_id for patent_id, _ in chunk], embeddings=embeddings, labels=labels)
+        n_done += len(chunk)
+
+        print(f'Added {n_done} patents to index | {n_done / (time.time() - start_time):.2f} docs/sec')
+        sys.stdout.flush()
+
+    return index
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Build an index of patent embeddings or search it.')
+
+    # Index
+    parser.add_argument('--path_index', help='Folder of index.', type=str, required=True)
+
+    # Corpus added to index
+    parser.add_argument('--path_corpus', help='JSONL, CSV or Parquet file with patents added to index.',
+                        type=str, default=None)
+    parser.add_argument('--corpus_format', help='Format of corpus.', type=str, default=None,
+                        choices=sorted(set(CORPUS_FORMATS.values())))
+    parser.add_argument('--text_field', help='Field with text of each record.', type=str, default='abstract')
+    parser.add_argument('--id_field', help='Field with id of each record.', type=str, default='id')
+    parser.add_argument('--chunk_size', help='Number of records added at once.', type=int, default=1024)
+    parser.add_argument('--max_batch_tokens', help='Maximum tokens, padding included, in a forward pass.',
+                        type=int, default=MAX_BATCH_TOKENS)
+
+    # Model used for new index
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Search
+    parser.add_argument('--query', help='Text to find similar patents for.', type=str, default=None)
+    parser.add_argument('--k', help='Number of similar patents.', type=int, default=10)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.path_corpus is not None:
+        # Create config parser.
+        config = configparser.ConfigParser()
+
+        # Read config file from path.
+        config.read(args.path_config_file)
+
+        build_index(model_pickle_path=model_pickle_path_from_config(config, args.model),
+                    path_corpus=args.path_corpus, path_index=args.path_index, text_field=args.text_field,
+                    id_field=args.id_field, corpus_format=args.corpus_format, chunk_size=args.chunk_size,
+                    max_batch_tokens=args.max_batch_tokens)
+
+    if args.query is not None:
+        start = time.time()
+        for neighbour in similar_patents(index=EmbeddingIndex(path_index=args.path_index), text=args.query, k=args.k):
+            print(neighbour)
+        print(f'Search took {1000 * (time.time() - start):.2f} ms')
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
@@ -0,0 +1,242 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run all configured models at the same time on the same input and combine their predictions."""
+
+import io
+import sys
+import time
+import argparse
+import configparser
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from inference_modeling import inference_transformer, inference_batch
+from model_registry import model_path_from_section
+from settings import CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS, SAMPLE_ABSTRACT
+
+# Ways predictions of models are combined:
+#   `weighted`: weighted average of labels percentages.
+#   `voting`: label with most weighted votes. Ties go to the label with highest average percentage.
+ENSEMBLE_METHODS = ['weighted', 'voting']
+
+
+def models_from_config(config_file):
+    r"""
+    Models of config file and their ensemble weights.
+
+    Each section can set `ensemble_weight`. Sections without it have weight 1. Sections without a model and
+    variants of other models (`variant_of`) are left out, so each model is counted once.
+
+    Returns:
+
+        :obj:`tuple`: Ordered dictionary of display name and model path, and dictionary of display name and weight.
+    """
+
+    sections = [section for section in config_file.sections()
+                if model_path_from_section(config_file, section) is not None
+                and not config_file.has_option(section, 'variant_of')]
+
+    models = OrderedDict((config_file[section]['display_name'], model_path_from_section(config_file, section))
+                         for section in sections)
+    weights = {config_file[section]['display_name']: config_file.getfloat(section, 'ensemble_weight', fallback=1.0)
+               for section in sections}
+
+    return models, weights
+
+
+def combine_predictions(models_predictions, weights=None, method='weighted'):
+    r"""
+    Combine predictions of all models for one document.
+
+    Arguments:
+
+        models_predictions (:obj:`dict`):
+            Model name and its label and labels percentages.
+
+        weights (:obj:`dict`, `optional`):
+            Model name and its weight. All models have same weight if not used.
+
+        method (:obj:`str`, `optional`, defaults to :obj:`weighted`):
+            One of `ENSEMBLE_METHODS`.
+
+    Returns:
+
+        :obj:`tuple`: Label and labels percentages of ensemble. Percentages are the weighted average of models
+        percentages for both methods.
+    """
+
+    if method not in ENSEMBLE_METHODS:
+        raise ValueError(f'Unknown ensemble method `{method}`! Use one of: {ENSEMBLE_METHODS}')
+
+    names = list(models_predictions.keys())
+    labels = list(models_predictions[names[0]][1].keys())
+    models_weights = np.array([1.0 if weights is None else weights.get(name, 1.0) for name in names])
+    models_weights = models_weights / models_weights.sum()
+
+    # Rows are models, columns are labels.
+    percents = np.array([[float(models_predictions[name][1][label]) for label in labels] for name in names])
+    average = np.around(models_weights @ percents, 2)
+
+    if method == 'weighted':
+        label = labels[int(average.argmax())]
+    else:
+        votes = np.zeros(len(labels))
+        for name, weight in zip(names, models_weights):
+            votes[labels.index(models_predictions[name][0])] += weight
+        # Sort by votes first, average percentage second.
+        label = labels[max(range(len(labels)), key=lambda index: (round(votes[index], 6), average[index]))]
+
+    return label, {lab: percent for lab, percent in zip(labels, average)}
+
+
+def ensemble_transformer(models, text_input, ids_labels=IDS_LABELS, weights=None, method='weighted', cache=None,
+                         max_workers=None):
+    r"""
+    Predict one document with all models at the same time. Used by the web app.
+
+    Each model runs on its own thread. PyTorch releases the GIL during a forward pass, so total time is close to the
+    time of the slowest model instead of the sum of all models.
+
+    Arguments:
+
+        models (:obj:`dict`):
+            Model name and model path.
+
+        text_input (:obj:`str`):
+            Text of document.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        weights (:obj:`dict`, `optional`):
+            Model name and its weight. All models have same weight if not used.
+
+        method (:obj:`str`, `optional`, defaults to :obj:`weighted`):
+            One of `ENSEMBLE_METHODS`.
+
+        cache (:obj:`prediction_cache.PredictionCache`, `optional`):
+            Cache of predictions of each model.
+
+        max_workers (:obj:`int`, `optional`):
+            Number of models run at the same time. All models if not used.
+
+    Returns:
+
+        :obj:`tuple`: Label, labels percentages, attentions and tokens of ensemble, and dictionary of model name and
+        its own label, labels percentages, attentions and tokens. Attentions and tokens are the ones of the model
+        most confident in the ensemble label.
+    """
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(models)) as executor:
+        futures = OrderedDict((name, executor.submit(inference_transformer, model_pickle_path=model_pickle_path,
+                                                     text_input=text_input, ids_labels=ids_labels, cache=cache))
+                              for name, model_pickle_path in models.items())
+        models_predictions = OrderedDict((name, future.result()) for name, future in futures.items())
+
+    label, labels_percents = combine_predictions(models_predictions=models_predictions, weights=weights,
+                                                 method=method)
+
+    # Highlight with model most confident in ensemble label.
+    highlight_name = max(models_predictions, key=lambda name: models_predictions[name][1][label])
+    _, _, attentions, tokens = models_predictions[highlight_name]
+
+    return label, labels_percents, attentions, tokens, models_predictions
+
+
+def ensemble_batch(models, texts, ids_labels=IDS_LABELS, weights=None, method='weighted',
+                   max_batch_tokens=MAX_BATCH_TOKENS, cache=None, max_workers=None):
+    r"""
+    Predict multiple documents with all models at the same time.
+
+    See `ensemble_transformer` for arguments.
+
+    Returns:
+
+        :obj:`list`: Dictionary for each document with ensemble `label`, `labels_percents` and `models`, the label
+        and labels percentages of each model.
+    """
+
+    texts = list(texts)
+
+    with ThreadPoolExecutor(max_workers=max_workers or len(models)) as executor:
+        futures = OrderedDict((name, executor.submit(inference_batch, model_pickle_path=model_pickle_path,
+                                                     texts=texts, ids_labels=ids_labels,
+                                                     max_batch_tokens=max_batch_tokens, cache=cache))
+                              for name, model_pickle_path in models.items())
+        models_results = OrderedDict((name, future.result()) for name, future in futures.items())
+
+    results = []
+    for index in range(len(texts)):
+        models_predictions = OrderedDict((name, predictions[index][:2]) for name, predictions in
+                                         models_results.items())
+        label, labels_percents = combine_predictions(models_predictions=models_predictions, weights=weights,
+                                                     method=method)
+        results.append({'label': label, 'labels_percents': labels_percents, 'models': models_predictions})
+
+    return results
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Predict sample abstract with an ensemble of all models.')
+
+    # Path of config file with pickled models
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Ensemble method
+    parser.add_argument('--method', help='How predictions of models are combined.', type=str, default='weighted',
+                        choices=ENSEMBLE_METHODS)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    ensemble_models, ensemble_weights = models_from_config(config_file=config)
+    sample_abstract = io.open(SAMPLE_ABSTRACT, mode='r', encoding='utf-8').read()
+
+    # Load and run models once first so only predictions are timed.
+    for path in ensemble_models.values():
+        inference_transformer(model_pickle_path=path, text_input=sample_abstract, ids_labels=IDS_LABELS)
+
+    # Time each model alone.
+    models_seconds = {}
+    for model_name, path in ensemble_models.items():
+        start_time = time.time()
+        inference_transformer(model_pickle_path=path, text_input=sample_abstract, ids_labels=IDS_LABELS)
+        models_seconds[model_name] = time.time() - start_time
+
+    start_time = time.time()
+    ensemble_label, ensemble_percents, _, _, predictions = ensemble_transformer(
+        models=ensemble_models, text_input=sample_abstract, weights=ensemble_weights, method=args.method)
+    ensemble_seconds = time.time() - start_time
+
+    for model_name, (model_label, model_percents, _, _) in predictions.items():
+        print(f'{model_name}: {model_label} {dict((lab, float(percent)) for lab, percent in model_percents.items())}'
+              f' | {models_seconds[model_name]:.3f} seconds alone')
+    print(f'Ensemble ({args.method}): {ensemble_label} '
+          f'{dict((lab, float(percent)) for lab, percent in ensemble_percents.items())} | '
+          f'{ensemble_seconds:.3f} seconds, sum of models {sum(models_seconds.values()):.3f} seconds')
+    sys.stdout.flush()
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
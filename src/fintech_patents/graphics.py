@@ -15,13 +15,21 @@
 """Deal with webapp graphics components."""
 
 import html
+import functools
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.backends.backend_agg import RendererAgg
-# Added fix from https://docs.streamlit.io/en/stable/deploy_streamlit_app.html
-_lock = RendererAgg.lock
+from metrics import timed
 
+# Number of highlight intensities. Each one is a CSS class, so neighbour words with same intensity share a span.
+HIGHLIGHT_LEVELS = 8
 
+# Size of confidence chart in pixels. Chart scales to width of page.
+CHART_WIDTH = 800
+CHART_BAR_HEIGHT = 36
+CHART_LABEL_WIDTH = 170
+CHART_VALUE_WIDTH = 90
+
+
+@timed('html_highlight_text')
 def html_highlight_text(weights, tokens, color=(135, 206, 250), intensity=1):
     """
     Return HTML code of highlighted tokens with different intensity color.
@@ -63,9 +71,214 @@ def html_highlight_text(weights, tokens, color=(135, 206, 250), intensity=1):
     return ' '.join(highlighted_text)
 
 
+def merge_tokens(tokens, text=None):
+    r"""
+    Merge subword tokens back into words.
+
+    With `text`, tokens are matched in order to the original text, which works when tokens are pieces of text
+    like the ones taken from offsets. Tokens with nothing but whitespace between them belong to different words,
+    tokens next to each other to the same word. Tokens not found, like `[CLS]`, must be at start or end only and
+    are not shown. Without `text`, or if tokens don't match it, tokens starting with `##` are joined to the token
+    before.
+
+    Arguments:
+
+        tokens (:obj:`list`):
+            Token strings.
+
+        text (:obj:`str`, `optional`):
+            Original text of document.
+
+    Returns:
+
+        :obj:`tuple`: List of words, list of separators put before each word, array of token index where each word
+        starts and array of token index after last word.
+    """
+
+    if text is not None:
+        words, separators, starts = [], [], []
+        cursor, word_end = 0, None
+
+        for index, token in enumerate(tokens):
+            position = text.find(token, cursor) if token else -1
+            # Token must follow previous one with only whitespace between them.
+            if position < 0 or text[cursor:position].strip():
+                if words:
+                    break
+                continue
+            if position == word_end:
+                words[-1] += token
+            else:
+                words.append(token)
+                separators.append(' ' if len(words) > 1 and position > cursor else '')
+                starts.append(index)
+            cursor = word_end = position + len(token)
+        else:
+            index = len(tokens)
+
+        # Rest of tokens are special tokens at end, or tokens don't come from text.
+        if words and all(text.find(token) < 0 for token in tokens[index:]):
+            return words, separators, np.array(starts), index
+
+    words, separators, starts = [], [], []
+    for index, token in enumerate(tokens):
+        if token.startswith('##') and words:
+            words[-1] += token[2:]
+        else:
+            words.append(token)
+            separators.append(' ' if len(words) > 1 else '')
+            starts.append(index)
+
+    return words, separators, np.array(starts, dtype=int), len(tokens)
+
+
+@timed('html_highlight_words')
+def html_highlight_words(weights, tokens, text=None, color=(135, 206, 250), intensity=1):
+    r"""
+    HTML of highlighted words, faster and smaller than `html_highlight_text` for long documents.
+
+    Subword tokens are merged into words that get the largest weight of their tokens. Weights are normalized
+    and quantized to `HIGHLIGHT_LEVELS` CSS classes, and neighbour words with the same class share one span.
+
+    Arguments:
+
+        weights (:obj:`list`):
+            Attention score of each token. None values are not highlighted.
+
+        tokens (:obj:`list`):
+            Token strings, same length as `weights`.
+
+        text (:obj:`str`, `optional`):
+            Original text of document. Used to merge tokens into words and keep punctuation next to words.
+
+        color (:obj:`tuple`, `optional`, defaults to :obj:`(135, 206, 250)`):
+            RGB color of highlight.
+
+        intensity (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Multiply each weight by this value to show up color.
+
+    Returns:
+
+        :obj:`str`: Style and html code for color highlight.
+    """
+
+    words, separators, starts, end = merge_tokens(tokens=tokens, text=text)
+    if not words:
+        return ''
+
+    # None weights become NaN and are not highlighted.
+    weights = np.array(weights[:end], dtype=np.float64)
+    # Largest weight of tokens of each word.
+    words_weights = np.nan_to_num(np.fmax.reduceat(weights, starts), nan=0.0)
+    # Normalize by largest weight shown, like `html_highlight_text`.
+    shown_weights = weights[starts[0]:]
+    max_weight = 1 if np.isnan(shown_weights).any() or not (shown_weights > 0).any() else shown_weights.max()
+    levels = np.rint(np.clip(intensity * words_weights / max_weight, 0, 1) * HIGHLIGHT_LEVELS).astype(int)
+
+    # Neighbour words with same level are one run.
+    runs_starts = np.concatenate([[0], np.flatnonzero(np.diff(levels)) + 1, [len(words)]])
+
+    class_name = 'fph-%02x%02x%02x' % tuple(int(value) for value in color)
+    style = ''.join(f'.{class_name} .h{level}{{background-color:rgba({color[0]},{color[1]},{color[2]},'
+                    f'{level / HIGHLIGHT_LEVELS:.3g})}}' for level in range(1, HIGHLIGHT_LEVELS + 1))
+    highlighted_text = [f'<style>{style}</style><div class="{class_name}">']
+
+    # Each word with separator before it.
+    pieces = [separator + word for separator, word in zip(separators, words)]
+
+    for run_start, run_end in zip(runs_starts[:-1].tolist(), runs_starts[1:].tolist()):
+        run_text = html.escape(words[run_start] + ''.join(pieces[run_start + 1:run_end]))
+        level = levels[run_start]
+        highlighted_text.append(separators[run_start])
+        highlighted_text.append(f'<span class="h{level}">{run_text}</span>' if level > 0 else run_text)
+
+    highlighted_text.append('</div>')
+
+    return ''.join(highlighted_text)
+
+
+@functools.lru_cache(maxsize=1024)
+def bar_chart_svg(bars):
+    r"""
+    SVG code of horizontal bar chart with percentages from 0 to 100.
+
+    Arguments:
+
+        bars (:obj:`tuple`):
+            Tuples of label, percentage and RGB color of each bar, from top to bottom.
+
+    Returns:
+
+        :obj:`str`: SVG code of chart. Same bars return the same cached string.
+    """
+
+    bars_width = CHART_WIDTH - CHART_LABEL_WIDTH - CHART_VALUE_WIDTH
+    height = CHART_BAR_HEIGHT * len(bars) + 10
+    elements = [f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {CHART_WIDTH} {height}" width="100%" '
+                f'font-family="sans-serif" font-size="16" role="img">']
+
+    # Vertical grid lines every 10%.
+    for percent in range(0, 110, 10):
+        x = CHART_LABEL_WIDTH + bars_width * percent / 100
+        elements.append(f'<line x1="{x:.1f}" y1="0" x2="{x:.1f}" y2="{height}" stroke="grey" '
+                        f'stroke-dasharray="4 2" stroke-width="0.5" stroke-opacity="0.4"/>')
+
+    for index, (label, percent, color) in enumerate(bars):
+        y = 5 + index * CHART_BAR_HEIGHT
+        width = bars_width * min(max(percent, 0), 100) / 100
+        text_y = y + CHART_BAR_HEIGHT / 2
+        elements.append(f'<text x="{CHART_LABEL_WIDTH - 10}" y="{text_y:.1f}" text-anchor="end" '
+                        f'dominant-baseline="middle">{html.escape(label)}</text>')
+        elements.append(f'<rect x="{CHART_LABEL_WIDTH}" y="{y + 4}" width="{width:.1f}" '
+                        f'height="{CHART_BAR_HEIGHT - 8}" fill="rgb({color[0]},{color[1]},{color[2]})" '
+                        f'stroke="grey"><title>{html.escape(label)}: {percent}%</title></rect>')
+        elements.append(f'<text x="{CHART_LABEL_WIDTH + width + 6:.1f}" y="{text_y:.1f}" fill="grey" '
+                        f'font-weight="bold" dominant-baseline="middle">{percent}%</text>')
+
+    elements.append('</svg>')
+
+    return ''.join(elements)
+
+
+@timed('svg_labels_confidence')
+def svg_labels_confidence(labels_percentages, labels_coloring):
+    r"""
+    Confidence of each label as an SVG bar chart. Does not need matplotlib or any lock, so sessions render at
+    the same time.
+
+    Arguments:
+
+        labels_percentages (:obj:`dict`):
+            Label name and its percentage.
+
+        labels_coloring (:obj:`dict`):
+            Label name and its RGB color.
+
+    Returns:
+
+        :obj:`str`: SVG code that can be shown with `st.markdown(..., unsafe_allow_html=True)`.
+    """
+
+    # Charts are cached on rounded percentages, the only precision shown.
+    bars = tuple((label, round(float(percent), 2), tuple(int(value) for value in labels_coloring[label]))
+                 for label, percent in labels_percentages.items())
+
+    return bar_chart_svg(bars)
+
+
+@timed('plot_labels_confidence')
 def plot_labels_confidence(labels_percentages, labels_coloring):
+    r"""
+    Confidence of each label as a matplotlib figure. Slower fallback of `svg_labels_confidence`.
+    """
+
+    # Matplotlib is imported on first plot so the app shows up before it is loaded.
+    import matplotlib.pyplot as plt
+    from matplotlib.backends.backend_agg import RendererAgg
+
     # Figure Size
-    with _lock:
+    # Added fix from https://docs.streamlit.io/en/stable/deploy_streamlit_app.html
+    with RendererAgg.lock:
         plt.rcParams.update({'font.size': 22})
         fig, ax = plt.subplots(figsize=(16, 9))
 
@@ -0,0 +1,536 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Re-classify only documents of a new corpus dump that are new, changed or were classified by another model.
+
+A SQLite manifest keeps the content hash, fingerprint of the model and options, and output record of each
+document id. Each dump is compared against it, only documents that need a prediction are classified, and the merged
+output is written from records kept in the manifest without classifying or encoding them again.
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import itertools
+import configparser
+from classify_corpus import CORPUS_FORMATS, read_corpus, classify_texts, result_record
+from early_exit import heads_path
+from inference_pool import InferencePool
+from model_registry import model_pickle_path_from_config
+from prediction_cache import normalize_text, model_fingerprint
+from settings import CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS, PREFILTER_THRESHOLD
+
+# Number of ids looked up in manifest with one query. SQLite allows 999 variables in a query.
+LOOKUP_SIZE = 900
+
+# Bytes of a model artifact read at once when hashing it.
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def content_hash(text):
+    r"""
+    Hash of normalized text, so whitespace and unicode form changes of a dump don't re-classify a document.
+    """
+
+    return hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+
+
+def artifact_hash(path):
+    r"""
+    Hash of content of a model artifact. Unlike `prediction_cache.model_fingerprint` it doesn't change when the
+    artifact is moved or written again with the same content.
+
+    Arguments:
+
+        path (:obj:`str`):
+            Path of a file, or a folder like a memory mapped model.
+
+    Returns:
+
+        :obj:`str`: SHA-256 of content.
+    """
+
+    hashed = hashlib.sha256()
+    paths = sorted(os.path.join(path, name) for name in os.listdir(path)) if os.path.isdir(path) else [path]
+
+    for file_path in paths:
+        # File names inside folders are part of content, name of a single file is not.
+        if os.path.isdir(path):
+            hashed.update(os.path.basename(file_path).encode('utf-8') + b'\0')
+        with open(file_path, 'rb') as artifact_file:
+            for block in iter(lambda: artifact_file.read(HASH_BLOCK_SIZE), b''):
+                hashed.update(block)
+
+    return hashed.hexdigest()
+
+
+def run_fingerprint(model_pickle_path, ids_labels=IDS_LABELS, return_attentions=False, path_prefilter=None,
+                    prefilter_threshold=PREFILTER_THRESHOLD, early_exit=False, hash_artifact=artifact_hash):
+    r"""
+    Fingerprint of everything that changes output records: model artifact, labels, attentions, cascade and early
+    exit heads. Artifacts are identified by content, so moving them doesn't re-classify documents.
+
+    `hash_artifact` gets path of an artifact and returns hash of its content, like `Manifest.artifact_hash` that
+    only reads artifacts that changed since an earlier run.
+
+    Returns:
+
+        :obj:`str`: Fingerprint of run.
+    """
+
+    prefilter = None if path_prefilter is None else [hash_artifact(path_prefilter), prefilter_threshold]
+    # Early exit heads are only used if they exist and attentions are not needed.
+    path_heads = heads_path(model_pickle_path)
+    heads = hash_artifact(path_heads) if early_exit and not return_attentions and os.path.isfile(path_heads) \
+        else None
+    key = json.dumps([hash_artifact(model_pickle_path), sorted(ids_labels.items()), bool(return_attentions),
+                      prefilter, heads])
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class Manifest(object):
+    r"""
+    SQLite file with content hash, run fingerprint, output record and position in last dump of each document, and
+    content hash of model artifacts used.
+
+    Arguments:
+
+        path_manifest (:obj:`str`):
+            Path of SQLite file. Created if it doesn't exist.
+    """
+
+    def __init__(self, path_manifest):
+        self.path_manifest = path_manifest
+        self._connection = sqlite3.connect(path_manifest)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS documents (key TEXT PRIMARY KEY, content_hash TEXT, '
+                                 'fingerprint TEXT, result TEXT, run INTEGER, position INTEGER)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS documents_run_position ON documents (run, position)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS runs (run INTEGER PRIMARY KEY, path_corpus TEXT, '
+                                 'fingerprint TEXT, started REAL, stats TEXT)')
+        self._connection.execute('CREATE TABLE IF NOT EXISTS artifacts (fingerprint TEXT PRIMARY KEY, '
+                                 'content_hash TEXT)')
+        self._connection.commit()
+
+    def artifact_hash(self, path):
+        r"""
+        Content hash of a model artifact. Artifact is only read if its path, size or modification time changed
+        since it was last hashed.
+        """
+
+        fingerprint = model_fingerprint(path)
+        row = self._connection.execute('SELECT content_hash FROM artifacts WHERE fingerprint = ?',
+                                       (fingerprint,)).fetchone()
+        if row is not None:
+            return row[0]
+
+        hashed = artifact_hash(path)
+        self._connection.execute('INSERT OR REPLACE INTO artifacts VALUES (?, ?)', (fingerprint, hashed))
+        self._connection.commit()
+
+        return hashed
+
+    def start_run(self, path_corpus, fingerprint):
+        r"""
+        Add a new run and return its number.
+        """
+
+        cursor = self._connection.execute('INSERT INTO runs (path_corpus, fingerprint, started) VALUES (?, ?, ?)',
+                                          (os.path.abspath(path_corpus), fingerprint, time.time()))
+        self._connection.commit()
+
+        return cursor.lastrowid
+
+    def finish_run(self, run, stats):
+        r"""
+        Save counts of a finished run.
+        """
+
+        self._connection.execute('UPDATE runs SET stats = ? WHERE run = ?', (json.dumps(stats), run))
+        self._connection.commit()
+
+        return
+
+    def lookup(self, keys):
+        r"""
+        Content hash, fingerprint and last run of documents already in manifest.
+
+        Returns:
+
+            :obj:`dict`: Key and tuple of content hash, fingerprint and run.
+        """
+
+        found = {}
+        keys = list(keys)
+        for start in range(0, len(keys), LOOKUP_SIZE):
+            batch = keys[start:start + LOOKUP_SIZE]
+            rows = self._connection.execute(f'SELECT key, content_hash, fingerprint, run FROM documents WHERE key '
+                                            f'IN ({",".join("?" * len(batch))})', batch)
+            found.update((key, (hashed, fingerprint, run)) for key, hashed, fingerprint, run in rows)
+
+        return found
+
+    def mark_seen(self, run, keys_positions):
+        r"""
+        Move unchanged documents to current run and position without touching their records.
+        """
+
+        self._connection.executemany('UPDATE documents SET run = ?, position = ? WHERE key = ?',
+                                     [(run, position, key) for key, position in keys_positions])
+        self._connection.commit()
+
+        return
+
+    def put(self, run, rows):
+        r"""
+        Add or replace documents from tuples of key, content hash, fingerprint, output record and position.
+        """
+
+        self._connection.executemany('INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?)',
+                                     [(key, hashed, fingerprint, result, run, position)
+                                      for key, hashed, fingerprint, result, position in rows])
+        self._connection.commit()
+
+        return
+
+    def remove_missing(self, run):
+        r"""
+        Delete documents that were not in dump of run. Returns number of documents deleted.
+        """
+
+        cursor = self._connection.execute('DELETE FROM documents WHERE run != ?', (run,))
+        self._connection.commit()
+
+        return cursor.rowcount
+
+    def results(self, run=None):
+        r"""
+        Output records of a run in dump order, as JSON lines stored in manifest. All documents if run is not used.
+
+        Returns:
+
+            :obj:`generator`: JSON string of each record.
+        """
+
+        if run is None:
+            rows = self._connection.execute('SELECT result FROM documents ORDER BY run, position')
+        else:
+            rows = self._connection.execute('SELECT result FROM documents WHERE run = ? ORDER BY position', (run,))
+
+        for row in rows:
+            yield row[0]
+
+    def close(self):
+        self._connection.close()
+
+        return
+
+
+def write_merged_output(manifest, run, path_output):
+    r"""
+    Write output records of a run in dump order. File is replaced at once so readers never see it half written.
+
+    Returns:
+
+        :obj:`int`: Number of records written.
+    """
+
+    path_temporary = f'{path_output}.tmp'
+    n_written = 0
+
+    with open(path_temporary, 'w', encoding='utf-8') as output_file:
+        for result in manifest.results(run=run):
+            output_file.write(result + '\n')
+            n_written += 1
+
+    os.replace(path_temporary, path_output)
+
+    return n_written
+
+
+def classify_incremental(model_pickle_path, path_corpus, path_manifest, path_output=None, path_delta=None,
+                         text_field='abstract', id_field='id', corpus_format=None, chunk_size=1024,
+                         max_batch_tokens=MAX_BATCH_TOKENS, return_attentions=False, n_workers=1,
+                         ids_labels=IDS_LABELS, path_prefilter=None, prefilter_threshold=PREFILTER_THRESHOLD,
+                         keep_missing=False, early_exit=False):
+    r"""
+    Classify documents of a corpus dump that changed since the manifest was last updated.
+
+    A document is classified when its id is not in the manifest, its content hash changed or it was classified
+    with another run fingerprint. Other documents keep their output record. Manifest is saved after each chunk,
+    so running again after a crash only classifies documents that are still left.
+
+    Ids must be unique in a dump. Only the first document with an id is kept, later ones are counted as
+    duplicates and skipped.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of pickled model and tokenizer.
+
+        path_corpus (:obj:`str`):
+            Path of corpus dump.
+
+        path_manifest (:obj:`str`):
+            Path of SQLite manifest. Created on first run.
+
+        path_output (:obj:`str`, `optional`):
+            Path of JSONL file where merged records of all documents of dump are written in dump order.
+
+        path_delta (:obj:`str`, `optional`):
+            Path of JSONL file where only records classified in this run are written.
+
+        text_field (:obj:`str`, `optional`, defaults to :obj:`abstract`):
+            Name of field with text to classify.
+
+        id_field (:obj:`str`, `optional`, defaults to :obj:`id`):
+            Name of field with document id. Content hash is used as id when field is missing, since row numbers
+            change between dumps.
+
+        corpus_format (:obj:`str`, `optional`):
+            One of `jsonl`, `csv` or `parquet`. If not used it is found from file extension.
+
+        chunk_size (:obj:`int`, `optional`, defaults to :obj:`1024`):
+            Number of documents that need a prediction classified and saved at once.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        return_attentions (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Keep attentions and tokens of each document.
+
+        n_workers (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Number of worker processes. More than one uses `inference_pool.InferencePool`.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        path_prefilter (:obj:`str`, `optional`):
+            First stage saved by `prefilter_cascade.py`.
+
+        prefilter_threshold (:obj:`float`, `optional`, defaults to :obj:`settings.PREFILTER_THRESHOLD`):
+            Probability of `non-fintech` needed to settle a document in first stage.
+
+        keep_missing (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Keep documents of earlier dumps that are not in this dump. They are deleted from manifest if not used.
+
+        early_exit (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Stop each document at the first confident layer if the model has heads trained by `early_exit.py`.
+
+    Returns:
+
+        :obj:`dict`: Number of documents in dump, new, changed, classified with another model, unchanged,
+        removed and skipped duplicates, and seconds of run.
+    """
+
+    manifest = Manifest(path_manifest)
+    # Pool and first stage are only loaded if a document needs a prediction.
+    pool, prefilter = None, None
+    delta_file = None
+
+    try:
+        fingerprint = run_fingerprint(model_pickle_path=model_pickle_path, ids_labels=ids_labels,
+                                      return_attentions=return_attentions, path_prefilter=path_prefilter,
+                                      prefilter_threshold=prefilter_threshold, early_exit=early_exit,
+                                      hash_artifact=manifest.artifact_hash)
+        run = manifest.start_run(path_corpus=path_corpus, fingerprint=fingerprint)
+
+        stats = {'documents': 0, 'new': 0, 'changed': 0, 'model_changed': 0, 'unchanged': 0, 'removed': 0,
+                 'duplicates': 0}
+        start_time = time.time()
+        # Documents waiting for a prediction.
+        pending = []
+        delta_file = open(path_delta, 'w', encoding='utf-8') if path_delta is not None else None
+
+        def classify_pending():
+            nonlocal pool, prefilter
+
+            if n_workers > 1 and pool is None:
+                pool = InferencePool(model_pickle_path=model_pickle_path, n_workers=n_workers,
+                                     max_batch_tokens=max_batch_tokens)
+            if path_prefilter is not None and prefilter is None:
+                from prefilter_cascade import HashedNgramModel
+                prefilter = HashedNgramModel.load(path_prefilter)
+
+            predictions, settled = classify_texts(texts=[text for _, _, _, _, text in pending],
+                                                  model_pickle_path=model_pickle_path, ids_labels=ids_labels,
+                                                  max_batch_tokens=max_batch_tokens,
+                                                  return_attentions=return_attentions, pool=pool,
+                                                  prefilter=prefilter, prefilter_threshold=prefilter_threshold,
+                                                  early_exit=early_exit)
+            rows = []
+            for row, ((key, record_id, hashed, position, _), prediction) in enumerate(zip(pending, predictions)):
+                result = json.dumps(result_record(record_id=record_id, prediction=prediction,
+                                                  return_attentions=return_attentions,
+                                                  settled=None if settled is None else bool(settled[row])))
+                rows.append((key, hashed, fingerprint, result, position))
+                if delta_file is not None:
+                    delta_file.write(result + '\n')
+
+            manifest.put(run=run, rows=rows)
+            pending.clear()
+
+            return
+
+        records = read_corpus(path_corpus=path_corpus, corpus_format=corpus_format)
+        position = 0
+
+        while True:
+            chunk = list(itertools.islice(records, chunk_size))
+            if not chunk:
+                break
+
+            documents = []
+            for record in chunk:
+                text = record.get(text_field) or ''
+                hashed = content_hash(text)
+                record_id = record.get(id_field, hashed)
+                # Ids of different types from JSON, CSV and Parquet are compared by their JSON.
+                documents.append((json.dumps(record_id), record_id, hashed, position, text))
+                position += 1
+
+            known = manifest.lookup(key for key, _, _, _, _ in documents)
+            unchanged = []
+            # Keys of this run not saved in manifest yet.
+            run_keys = set(key for key, _, _, _, _ in pending)
+            for document in documents:
+                key, record_id, hashed, document_position, _ = document
+                # A second copy would replace first one in manifest.
+                if key in run_keys or (key in known and known[key][2] == run):
+                    if not stats['duplicates']:
+                        print(f'Document id {record_id} is in dump more than once! Only first copy is kept.')
+                        sys.stdout.flush()
+                    stats['duplicates'] += 1
+                    continue
+                run_keys.add(key)
+                stats['documents'] += 1
+
+                if key not in known:
+                    stats['new'] += 1
+                elif known[key][0] != hashed:
+                    stats['changed'] += 1
+                elif known[key][1] != fingerprint:
+                    stats['model_changed'] += 1
+                else:
+                    stats['unchanged'] += 1
+                    unchanged.append((key, document_position))
+                    continue
+                pending.append(document)
+
+            manifest.mark_seen(run=run, keys_positions=unchanged)
+
+            if len(pending) >= chunk_size:
+                classify_pending()
+
+            elapsed_time = time.time() - start_time
+            need_prediction = stats['new'] + stats['changed'] + stats['model_changed']
+            print(f'Checked {stats["documents"]} documents | {need_prediction} need prediction | '
+                  f'{stats["documents"] / elapsed_time:.2f} docs/sec')
+            sys.stdout.flush()
+
+        if pending:
+            classify_pending()
+
+        if not keep_missing:
+            stats['removed'] = manifest.remove_missing(run=run)
+
+        if path_output is not None:
+            write_merged_output(manifest=manifest, run=None if keep_missing else run, path_output=path_output)
+
+        stats['seconds'] = round(time.time() - start_time, 2)
+        manifest.finish_run(run=run, stats=stats)
+
+    finally:
+        # Stop workers and close files even if a chunk failed. Manifest keeps chunks already saved.
+        if delta_file is not None:
+            delta_file.close()
+        if pool is not None:
+            pool.close()
+        manifest.close()
+
+    return stats
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Classify only new or changed documents of a corpus dump.')
+
+    # Corpus and manifest
+    parser.add_argument('--path_corpus', help='Path of JSONL, CSV or Parquet corpus dump.', type=str, required=True)
+    parser.add_argument('--path_manifest', help='Path of SQLite manifest of earlier runs.', type=str,
+                        default='manifest.sqlite')
+    parser.add_argument('--path_output', help='JSONL file where merged predictions of whole dump are written.',
+                        type=str, default='predictions.jsonl')
+    parser.add_argument('--path_delta', help='JSONL file where only predictions made in this run are written.',
+                        type=str, default=None)
+    parser.add_argument('--corpus_format', help='Corpus format. Found from file extension if not used.',
+                        type=str, default=None, choices=sorted(set(CORPUS_FORMATS.values())))
+    parser.add_argument('--text_field', help='Name of field with text to classify.', type=str, default='abstract')
+    parser.add_argument('--id_field', help='Name of field with document id.', type=str, default='id')
+    parser.add_argument('--keep_missing', help='Keep documents of earlier dumps missing from this dump.',
+                        action='store_true')
+
+    # Model
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Inference
+    parser.add_argument('--chunk_size', help='Number of documents classified and saved at once.',
+                        type=int, default=1024)
+    parser.add_argument('--max_batch_tokens', help='Maximum number of tokens in a forward pass.',
+                        type=int, default=MAX_BATCH_TOKENS)
+    parser.add_argument('--return_attentions', help='Keep attentions and tokens of each document.',
+                        action='store_true')
+    parser.add_argument('--n_workers', help='Number of worker processes sharing the model.', type=int, default=1)
+    parser.add_argument('--path_prefilter', help='First stage saved by `prefilter_cascade.py`.', type=str,
+                        default=None)
+    parser.add_argument('--prefilter_threshold', help='Probability of non-fintech needed to skip the model.',
+                        type=float, default=PREFILTER_THRESHOLD)
+    parser.add_argument('--early_exit', help='Stop documents at first confident layer if model has early exit heads.',
+                        action='store_true')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    run_stats = classify_incremental(model_pickle_path=model_pickle_path_from_config(config, args.model),
+                                     path_corpus=args.path_corpus, path_manifest=args.path_manifest,
+                                     path_output=args.path_output, path_delta=args.path_delta,
+                                     text_field=args.text_field, id_field=args.id_field,
+                                     corpus_format=args.corpus_format, chunk_size=args.chunk_size,
+                                     max_batch_tokens=args.max_batch_tokens,
+                                     return_attentions=args.return_attentions, n_workers=args.n_workers,
+                                     path_prefilter=args.path_prefilter,
+                                     prefilter_threshold=args.prefilter_threshold, keep_missing=args.keep_missing,
+                                     early_exit=args.early_exit)
+
+    print(f'{run_stats["documents"]} documents | {run_stats["new"]} new | {run_stats["changed"]} changed | '
+          f'{run_stats["model_changed"]} classified with another model | {run_stats["unchanged"]} unchanged | '
+          f'{run_stats["removed"]} removed | {run_stats["duplicates"]} duplicates | {run_stats["seconds"]} seconds')
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
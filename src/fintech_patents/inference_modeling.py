@@ -14,38 +14,73 @@
 # limitations under the License.
 """Deal with model inference."""
 
-import pickle
-import torch
 import gc
 import sys
 import numpy as np
+from model_registry import get_model_tokenizer
+from prediction_cache import cache_key, model_fingerprint
+from attention_extraction import forward_with_attention
+from metrics import TOKENS_BUCKETS, increment, observe, timer
+from tokenization import encode_batch, display_tokens
+from settings import MAX_BATCH_TOKENS
 
 
-def softmax(vector):
+def softmax(vector, axis=-1):
     r"""
     calculate the softmax of a vector
 
     Used fom: https://machinelearningmastery.com/softmax-activation-function-with-python/
+
+    Softmax is calculated on last axis so it works on a batch of logits too.
     '"""
 
-    e = np.exp(vector)
+    e = np.exp(vector - np.max(vector, axis=axis, keepdims=True))
+
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def attention_key(attention_mode, attention_layer, attention_head):
+    r"""
+    Attention settings added to cache keys, so predictions with different attentions are cached apart.
+    """
 
-    return e / e.sum()
+    return f'{attention_mode}:{attention_layer}:{attention_head}'
 
 
-def inference_transformer(model_pickle_path, text_input, ids_labels):
+def inference_transformer(model_pickle_path, text_input, ids_labels, cache=None, attention_mode='cls_head',
+                          attention_layer=-1, attention_head=0):
     r"""
-    Load model and tokenizer form .pickle and perform prediction using text input.
+    Get model and tokenizer from the models registry and perform prediction using text input.
 
+    Model is unpickled only the first time it is used in the process. If a `prediction_cache.PredictionCache` is
+    used, predictions of texts already seen are returned without a forward pass.
+
+    Only the attention of first token from `attention_head` of `attention_layer` is kept, or the average of all
+    heads with `cls_mean` mode. Mode `none` skips attentions. See `attention_extraction.py`.
 
     """
 
-    with open(model_pickle_path, 'rb') as handle:
-        tokenizer, model = pickle.load(handle)
-    inputs = tokenizer(text=text_input, add_special_tokens=True, truncation=True, padding=True, return_tensors='pt')
+    increment('documents_total', labels={'path': 'single'})
+
+    # Return cached prediction if text was already seen by this model.
+    if cache is not None:
+        fingerprint = cache.fingerprint(model_pickle_path)
+        key = cache_key(text=text_input,
+                        fingerprint=f'{fingerprint}/{attention_key(attention_mode, attention_layer, attention_head)}',
+                        ids_labels=ids_labels)
+        prediction = cache.get(key)
+        if prediction is not None:
+            return prediction
 
-    tokens = [tokenizer.decode([token_id]) for token_id in inputs['input_ids'][0]]
+    tokenizer, model = get_model_tokenizer(model_pickle_path)
+    # Same batched encode as bulk predictions. Tokens are taken from text offsets when tokenizer is fast.
+    encodings, offsets = encode_batch(tokenizer=tokenizer, texts=[text_input])
+    inputs = tokenizer.pad(encodings, padding=True, return_tensors='pt')
+
+    tokens = display_tokens(tokenizer=tokenizer, text=text_input, input_ids=encodings['input_ids'][0],
+                            offsets=None if offsets is None else offsets[0])
     n_tokens = len(inputs['input_ids'][0])
+    observe('request_tokens', n_tokens, buckets=TOKENS_BUCKETS)
 
     # Forward pass, calculate logit predictions.
     # This will return the logits rather than the loss because we have
@@ -55,8 +90,10 @@ def inference_transformer(model_pickle_path, text_input, ids_labels):
     # The documentation for this `model` function is here:
     # https://huggingface.co/transformers/v2.2.0/model_doc/bert.html#transformers.BertForSequenceClassification
     # outputs = model(**inputs)
-    with torch.no_grad():
-        outputs = model.forward(**inputs, output_attentions=True, return_dict=True)
+    with timer('forward'):
+        logits, attentions = forward_with_attention(model=model, inputs=inputs, attention_mode=attention_mode,
+                                                    attention_layer=attention_layer, attention_head=attention_head)
+    increment('forward_passes_total')
 
     # Try to free up any memory.
     try:
@@ -68,18 +105,8 @@ def inference_transformer(model_pickle_path, text_input, ids_labels):
         sys.stdout.flush()
     gc.collect()
 
-    logits = outputs['logits'].detach().cpu().numpy()
-    attentions = outputs['attentions']
-
-    # Make sure attentions scores are good format in order to get attentions.
-    try:
-        # Attention is correct format.
-        attentions = attentions[-1].squeeze()[0][0]
-        # Dobule check it has same length. If not just use None values.
-        attentions = attentions.detach().numpy() if len(attentions) == n_tokens else [None] * n_tokens
-    except:
-        # If something goes wrong add None values.
-        attentions = [None] * n_tokens
+    # Attentions of the only document. Dobule check it has same length. If not just use None values.
+    attentions = attentions[0] if attentions is not None and len(attentions[0]) == n_tokens else [None] * n_tokens
     # The call to `model` always returns a tuple, so we need to pull the
     # loss value out of the tuple along with the logits. We will use logits
     # later to to calculate training accuracy.
@@ -89,21 +116,372 @@ def inference_transformer(model_pickle_path, text_input, ids_labels):
     # Move logits and labels to CPU
     # logits = logits.detach().cpu().numpy()
 
-    # Get probabilities from logits
-    # probs = torch.softmax(logits, dim=-1) # using pytroch
-    probs = softmax(vector=logits)[0]  # Using custom function. No need to load torch.
-    # Make probabilities % 0-100
-    probs *= 100
-    # Round to 2 decimal places.
-    probs = np.around(probs, 2)
+    with timer('postprocess'):
+        # Get probabilities from logits
+        # probs = torch.softmax(logits, dim=-1) # using pytroch
+        probs = softmax(vector=logits)[0]  # Using custom function. No need to load torch.
+        # Make probabilities % 0-100
+        probs *= 100
+        # Round to 2 decimal places.
+        probs = np.around(probs, 2)
+
+        # get predicitons to list
+        predict_content = logits.argmax(axis=-1).flatten().tolist()[0]
 
-    # get predicitons to list
-    predict_content = logits.argmax(axis=-1).flatten().tolist()[0]
+        # Predicted label
+        label = ids_labels.get(predict_content, 'Unknown')
 
-    # Predicted label
-    label = ids_labels.get(predict_content, 'Unknown')
+        labels_percents = {lab: prob for lab, prob in zip(ids_labels.values(), probs)}
 
-    labels_percents = {lab: prob for lab, prob in zip(ids_labels.values(), probs)}
+    # Save prediction for next time.
+    if cache is not None:
+        cache.put(key=key, prediction=(label, labels_percents, attentions, tokens), model_path=model_pickle_path,
+                  fingerprint=fingerprint)
 
     return label, labels_percents, attentions, tokens
 
+
+def length_buckets(lengths, max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Group documents of similar length in batches so padding is minimal.
+
+    Documents are sorted by length and added to a batch as long as the padded batch has no more than
+    `max_batch_tokens` tokens. A document longer than `max_batch_tokens` gets a batch of its own.
+
+    Arguments:
+
+        lengths (:obj:`list`):
+            Number of tokens of each document.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a batch.
+
+    Returns:
+
+        :obj:`list`: List of batches. Each batch is a list of documents indexes.
+    """
+
+    batches = []
+    batch = []
+
+    # Sort documents indexes by their length.
+    for index in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        # Documents are sorted so current document sets the padded length of batch.
+        if batch and (len(batch) + 1) * lengths[index] > max_batch_tokens:
+            batches.append(batch)
+            batch = []
+        batch.append(index)
+
+    # Add last batch.
+    if batch:
+        batches.append(batch)
+
+    return batches
+
+
+def predictions_from_logits(logits, ids_labels):
+    r"""
+    Get predicted label and labels percentages for each row of logits.
+
+    Arguments:
+
+        logits (:obj:`np.ndarray`):
+            Logits of shape [batch size, number of labels].
+
+        ids_labels (:obj:`dict`):
+            Dictionary of label id and label name.
+
+    Returns:
+
+        :obj:`list`: List of tuples of label and dictionary of labels percentages.
+    """
+
+    # Make probabilities % 0-100 rounded to 2 decimal places.
+    probs = np.around(softmax(vector=logits) * 100, 2)
+
+    # Get predictions to list.
+    predict_contents = logits.argmax(axis=-1).flatten().tolist()
+
+    return [(ids_labels.get(predict_content, 'Unknown'),
+             {lab: prob for lab, prob in zip(ids_labels.values(), doc_probs)})
+            for predict_content, doc_probs in zip(predict_contents, probs)]
+
+
+def predict_batch(tokenizer, model, texts, ids_labels, max_batch_tokens=MAX_BATCH_TOKENS, return_attentions=False,
+                  attention_mode='cls_head', attention_layer=-1, attention_head=0):
+    r"""
+    Perform prediction on multiple documents with a loaded tokenizer and model using length bucketed batches.
+
+    Documents are tokenized once, grouped by length with `length_buckets` and each batch is padded only to its
+    longest document.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model.
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model used for prediction.
+
+        texts (:obj:`iterable`):
+            Text of each document.
+
+        ids_labels (:obj:`dict`):
+            Dictionary of label id and label name.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        return_attentions (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Return attentions and tokens of each document.
+
+        attention_mode (:obj:`str`, `optional`, defaults to :obj:`cls_head`):
+            Attention kept when `return_attentions` is True. See `attention_extraction.ATTENTION_MODES`.
+
+        attention_layer (:obj:`int`, `optional`, defaults to :obj:`-1`):
+            Layer of attention kept.
+
+        attention_head (:obj:`int`, `optional`, defaults to :obj:`0`):
+            Head of attention kept in `cls_head` mode.
+
+    Returns:
+
+        :obj:`list`: Tuples of label, labels percentages, attentions and tokens in same order as `texts`.
+        Attentions and tokens are None if `return_attentions` is False.
+    """
+
+    # Skip attentions for bulk scoring.
+    attention_mode = attention_mode if return_attentions else 'none'
+
+    # Tokenize all documents without padding.
+    texts = list(texts)
+    encodings, offsets = encode_batch(tokenizer=tokenizer, texts=texts)
+    lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+    increment('documents_total', len(lengths), labels={'path': 'batch'})
+    for length in lengths:
+        observe('request_tokens', length, buckets=TOKENS_BUCKETS)
+
+    # Store prediction of each document at its index.
+    results = [None] * len(lengths)
+
+    for batch in length_buckets(lengths=lengths, max_batch_tokens=max_batch_tokens):
+        # Pad batch to its longest document.
+        inputs = tokenizer.pad({key: [values[index] for index in batch] for key, values in encodings.items()},
+                               padding=True, return_tensors='pt')
+
+        # Forward pass.
+        with timer('forward'):
+            logits, batch_attentions = forward_with_attention(model=model, inputs=inputs,
+                                                              attention_mode=attention_mode,
+                                                              attention_layer=attention_layer,
+                                                              attention_head=attention_head)
+        increment('forward_passes_total')
+
+        for row, (index, (label, labels_percents)) in enumerate(zip(batch,
+                                                                    predictions_from_logits(logits, ids_labels))):
+            attentions, tokens = None, None
+
+            if return_attentions:
+                n_tokens = lengths[index]
+                tokens = display_tokens(tokenizer=tokenizer, text=texts[index],
+                                        input_ids=encodings['input_ids'][index],
+                                        offsets=None if offsets is None else offsets[index])
+                # Attention of first token over the document tokens without padding.
+                # Models that do not return attentions get None values.
+                attentions = batch_attentions[row][:n_tokens] if batch_attentions is not None else [None] * n_tokens
+
+            results[index] = (label, labels_percents, attentions, tokens)
+
+    return results
+
+
+def inference_batch(model_pickle_path, texts, ids_labels, max_batch_tokens=MAX_BATCH_TOKENS,
+                    return_attentions=False, cache=None, attention_mode='cls_head', attention_layer=-1,
+                    attention_head=0, early_exit=False):
+    r"""
+    Get model and tokenizer from the models registry and perform prediction on multiple documents.
+
+    See `predict_batch` for arguments. If a `prediction_cache.PredictionCache` is used, only documents not
+    already cached go through the model.
+
+    With `early_exit`, documents stop at the first layer whose head is confident, if heads were trained for the
+    model with `early_exit.py`. Early exit has no attentions, so the full model is used when `return_attentions`
+    is True or the model has no heads.
+
+    Returns:
+
+        :obj:`list`: Tuples of label, labels percentages, attentions and tokens in same order as `texts`.
+        Attentions and tokens are None if `return_attentions` is False.
+    """
+
+    tokenizer, model = get_model_tokenizer(model_pickle_path)
+
+    heads = None
+    if early_exit and not return_attentions:
+        from early_exit import early_exit_batch, heads_path, load_model_heads
+        heads = load_model_heads(model_pickle_path)
+
+    def predict(batch_texts):
+        if heads is not None:
+            return early_exit_batch(tokenizer=tokenizer, model=model, texts=batch_texts, heads=heads,
+                                    ids_labels=ids_labels, max_batch_tokens=max_batch_tokens)[0]
+        return predict_batch(tokenizer=tokenizer, model=model, texts=batch_texts, ids_labels=ids_labels,
+                             max_batch_tokens=max_batch_tokens, return_attentions=return_attentions,
+                             attention_mode=attention_mode, attention_layer=attention_layer,
+                             attention_head=attention_head)
+
+    if cache is None:
+        return predict(texts)
+
+    texts = list(texts)
+    fingerprint = cache.fingerprint(model_pickle_path)
+    # Predictions without attentions are cached apart from predictions with attentions.
+    attention_fingerprint = attention_key(attention_mode if return_attentions else 'none', attention_layer,
+                                          attention_head)
+    # Early exit predictions are cached apart from full model predictions.
+    if heads is not None:
+        attention_fingerprint = f'{attention_fingerprint}/early_exit:{model_fingerprint(heads_path(model_pickle_path))}'
+    keys = [cache_key(text=text, fingerprint=f'{fingerprint}/{attention_fingerprint}', ids_labels=ids_labels)
+            for text in texts]
+    results = [cache.get(key) for key in keys]
+
+    missing = [index for index, result in enumerate(results) if result is None]
+
+    predictions = predict([texts[index] for index in missing]) if missing else []
+
+    for index, prediction in zip(missing, predictions):
+        cache.put(key=keys[index], prediction=prediction, model_path=model_pickle_path, fingerprint=fingerprint)
+        results[index] = prediction
+
+    return results
+
+
+def pool_windows_logits(logits, pooling='mean'):
+    r"""
+    Combine logits of all windows of a document in one row of logits.
+
+    Arguments:
+
+        logits (:obj:`np.ndarray`):
+            Logits of shape [number of windows, number of labels].
+
+        pooling (:obj:`str`, `optional`, defaults to :obj:`mean`):
+            `mean` averages windows, `max` keeps largest logit of each label and `attention` averages windows
+            weighted by softmax of their largest logit, so confident windows count more.
+
+    Returns:
+
+        :obj:`np.ndarray`: Logits of shape [1, number of labels].
+    """
+
+    if pooling == 'mean':
+        return logits.mean(axis=0, keepdims=True)
+
+    if pooling == 'max':
+        return logits.max(axis=0, keepdims=True)
+
+    if pooling == 'attention':
+        windows_weights = softmax(vector=logits.max(axis=-1))
+        return (windows_weights[:, None] * logits).sum(axis=0, keepdims=True)
+
+    raise ValueError(f'Unknown pooling `{pooling}`! Use one of: mean, max, attention')
+
+
+def inference_long_document(model_pickle_path, text_input, ids_labels, window_size=None, overlap=None,
+                            pooling='mean'):
+    r"""
+    Perform prediction on text longer than model's maximum length using overlapping windows of tokens.
+
+    All windows go through the model in one forward pass. Window logits are pooled in one prediction and the
+    attention of each window is placed back on the document tokens, averaging tokens seen by more windows, so
+    the output can be used with `graphics.html_highlight_text`.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of pickled model and tokenizer.
+
+        text_input (:obj:`str`):
+            Text of document.
+
+        ids_labels (:obj:`dict`):
+            Dictionary of label id and label name.
+
+        window_size (:obj:`int`, `optional`):
+            Number of tokens of each window, special tokens included. Defaults to model's maximum length.
+
+        overlap (:obj:`int`, `optional`):
+            Number of tokens shared by consecutive windows. Defaults to a quarter of a window.
+
+        pooling (:obj:`str`, `optional`, defaults to :obj:`mean`):
+            How windows logits are combined. See `pool_windows_logits`.
+
+    Returns:
+
+        :obj:`tuple`: Label, labels percentages, attentions and tokens of whole document.
+    """
+
+    tokenizer, model = get_model_tokenizer(model_pickle_path)
+
+    # Tokens of each window without special tokens.
+    window_size = window_size or min(tokenizer.model_max_length, 512)
+    content_size = window_size - tokenizer.num_special_tokens_to_add(pair=False)
+    overlap = content_size // 4 if overlap is None else overlap
+    step = max(content_size - overlap, 1)
+
+    # Document is longer than maximum length on purpose.
+    encodings, offsets = encode_batch(tokenizer=tokenizer, texts=[text_input], add_special_tokens=False,
+                                      truncation=False)
+    token_ids = encodings['input_ids'][0]
+    increment('documents_total', labels={'path': 'long_document'})
+    observe('request_tokens', len(token_ids), buckets=TOKENS_BUCKETS)
+
+    # Start of each window. Last window ends at the end of document.
+    windows_starts = [0]
+    while windows_starts[-1] + content_size < len(token_ids):
+        windows_starts.append(windows_starts[-1] + step)
+
+    windows_ids = [tokenizer.build_inputs_with_special_tokens(token_ids[start:start + content_size])
+                   for start in windows_starts]
+
+    # Pad all windows and run them in one forward pass.
+    inputs = tokenizer.pad({'input_ids': windows_ids,
+                            'attention_mask': [[1] * len(window_ids) for window_ids in windows_ids]},
+                           padding=True, return_tensors='pt')
+
+    with timer('forward'):
+        logits, windows_attentions = forward_with_attention(model=model, inputs=inputs, attention_mode='cls_head')
+    increment('forward_passes_total')
+
+    logits = pool_windows_logits(logits=logits, pooling=pooling)
+    label, labels_percents = predictions_from_logits(logits, ids_labels)[0]
+
+    # Find how many special tokens are added before the content using a placeholder id.
+    placeholder_ids = tokenizer.build_inputs_with_special_tokens([-1])
+    n_prefix = placeholder_ids.index(-1)
+    n_suffix = len(placeholder_ids) - n_prefix - 1
+
+    # Whole document with special tokens, used for highlight. Special tokens have empty offsets.
+    document_ids = tokenizer.build_inputs_with_special_tokens(token_ids)
+    document_offsets = None if offsets is None else [(0, 0)] * n_prefix + list(offsets[0]) + [(0, 0)] * n_suffix
+    tokens = display_tokens(tokenizer=tokenizer, text=text_input, input_ids=document_ids, offsets=document_offsets)
+
+    # Models that do not return attentions get None values.
+    if windows_attentions is None:
+        return label, labels_percents, [None] * len(document_ids), tokens
+
+    weights_sum = np.zeros(len(document_ids))
+    weights_count = np.zeros(len(document_ids))
+
+    for start, window_ids, window_attentions in zip(windows_starts, windows_ids, windows_attentions):
+        n_content = len(window_ids) - n_prefix - n_suffix
+        # Special tokens map to document special tokens, content tokens to their document position.
+        document_positions = list(range(n_prefix)) + \
+            list(range(n_prefix + start, n_prefix + start + n_content)) + \
+            list(range(len(document_ids) - n_suffix, len(document_ids)))
+        weights_sum[document_positions] += window_attentions[:len(window_ids)]
+        weights_count[document_positions] += 1
+
+    attentions = weights_sum / np.maximum(weights_count, 1)
+
+    return label, labels_percents, attentions, tokens
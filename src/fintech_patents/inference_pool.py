@@ -0,0 +1,235 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Run inference on multiple processes that share one copy of the model weights."""
+
+import io
+import os
+import sys
+import time
+import argparse
+import configparser
+from inference_modeling import inference_batch
+from model_registry import MODEL_REGISTRY, get_model_tokenizer, model_pickle_path_from_config
+from settings import CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS, SAMPLE_ABSTRACT
+
+
+def set_torch_threads(intra_op_threads, inter_op_threads):
+    r"""
+    Set number of threads torch uses inside one operation and across operations.
+
+    Inter-op threads can only be set before torch runs any parallel work in a process, so a failure there is
+    only printed.
+    """
+
+    import torch
+
+    torch.set_num_threads(intra_op_threads)
+
+    # Nothing to do if inter-op threads are already set.
+    if torch.get_num_interop_threads() == inter_op_threads:
+        return
+
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError as e:
+        print(f'Not able to set inter-op threads in process {os.getpid()}: {e}')
+        sys.stdout.flush()
+
+    return
+
+
+def _init_worker(model_pickle_path, tokenizer, model, intra_op_threads, inter_op_threads):
+    # Model weights are in shared memory. Register them so no worker loads the model again.
+    MODEL_REGISTRY.add(model_pickle_path, tokenizer, model)
+    set_torch_threads(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+    return
+
+
+def _worker_inference(arguments):
+    return inference_batch(**arguments)
+
+
+class InferencePool(object):
+    r"""
+    Pool of worker processes that classify batches of documents with one model.
+
+    The model is loaded once in the main process and its weights are moved to shared memory before workers
+    start, so all workers use the same copy of the weights. Workers are forked when possible.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of pickled model and tokenizer.
+
+        n_workers (:obj:`int`, `optional`, defaults to number of CPUs):
+            Number of worker processes.
+
+        intra_op_threads (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Threads each worker uses inside one torch operation.
+
+        inter_op_threads (:obj:`int`, `optional`, defaults to :obj:`1`):
+            Threads each worker uses to run independent torch operations.
+
+        chunk_size (:obj:`int`, `optional`, defaults to :obj:`256`):
+            Number of documents sent to a worker at once.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+    """
+
+    def __init__(self, model_pickle_path, n_workers=None, intra_op_threads=1, inter_op_threads=1, chunk_size=256,
+                 max_batch_tokens=MAX_BATCH_TOKENS):
+
+        self.model_pickle_path = model_pickle_path
+        self.n_workers = n_workers or os.cpu_count()
+        self.chunk_size = chunk_size
+        self.max_batch_tokens = max_batch_tokens
+
+        # Load model once and move weights to shared memory.
+        tokenizer, model = get_model_tokenizer(model_pickle_path)
+        import torch
+        # ONNX variants are not torch modules and have no weights to share.
+        if isinstance(model, torch.nn.Module):
+            model.share_memory()
+
+        # Forked workers inherit the model without copying it. Other start methods get shared memory handles.
+        import torch.multiprocessing as mp
+        context = mp.get_context('fork' if 'fork' in mp.get_all_start_methods() else 'spawn')
+        self._pool = context.Pool(processes=self.n_workers, initializer=_init_worker,
+                                  initargs=(model_pickle_path, tokenizer, model, intra_op_threads, inter_op_threads))
+
+    def map(self, texts, ids_labels=IDS_LABELS, return_attentions=False, early_exit=False):
+        r"""
+        Classify documents on all workers. See `inference_modeling.inference_batch` for `early_exit`.
+
+        Returns:
+
+            :obj:`list`: Tuples of label, labels percentages, attentions and tokens in same order as `texts`.
+        """
+
+        texts = list(texts)
+        chunks = [dict(model_pickle_path=self.model_pickle_path, texts=texts[i:i + self.chunk_size],
+                       ids_labels=ids_labels, max_batch_tokens=self.max_batch_tokens,
+                       return_attentions=return_attentions, early_exit=early_exit)
+                  for i in range(0, len(texts), self.chunk_size)]
+
+        # `imap` keeps the order of chunks.
+        return [result for chunk_results in self._pool.imap(_worker_inference, chunks)
+                for result in chunk_results]
+
+    def close(self):
+        r"""
+        Stop all workers.
+        """
+
+        self._pool.close()
+        self._pool.join()
+
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def benchmark_scaling(model_pickle_path, texts, n_workers, intra_op_threads=1, inter_op_threads=1, chunk_size=256,
+                      max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Compare throughput of the worker pool against the single process path using same threads per process.
+
+    Returns:
+
+        :obj:`dict`: Documents per second of each path, speedup and scaling efficiency (speedup / workers).
+    """
+
+    texts = list(texts)
+
+    # Make sure model loading is not timed.
+    get_model_tokenizer(model_pickle_path)
+    set_torch_threads(intra_op_threads=intra_op_threads, inter_op_threads=inter_op_threads)
+
+    # Single process path.
+    start_time = time.time()
+    inference_batch(model_pickle_path=model_pickle_path, texts=texts, ids_labels=IDS_LABELS,
+                    max_batch_tokens=max_batch_tokens)
+    single_time = time.time() - start_time
+
+    with InferencePool(model_pickle_path=model_pickle_path, n_workers=n_workers, intra_op_threads=intra_op_threads,
+                       inter_op_threads=inter_op_threads, chunk_size=chunk_size,
+                       max_batch_tokens=max_batch_tokens) as pool:
+        # Time only the inference, not starting workers.
+        pool.map(texts[:1])
+        start_time = time.time()
+        pool.map(texts)
+        pool_time = time.time() - start_time
+
+    speedup = single_time / pool_time
+
+    return {'documents': len(texts),
+            'workers': n_workers,
+            'single_docs_per_sec': round(len(texts) / single_time, 2),
+            'pool_docs_per_sec': round(len(texts) / pool_time, 2),
+            'speedup': round(speedup, 2),
+            'scaling_efficiency': round(speedup / n_workers, 2)}
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Report scaling of multi process inference.')
+
+    # Model used
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+
+    # Path of config file with pickled models
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Number of documents
+    parser.add_argument('--n_documents', help='Number of copies of sample abstract to classify.',
+                        type=int, default=512)
+
+    # Number of workers
+    parser.add_argument('--n_workers', help='Number of worker processes.', type=int, default=os.cpu_count())
+
+    # Threads
+    parser.add_argument('--intra_op_threads', help='Threads used inside one torch operation.', type=int, default=1)
+    parser.add_argument('--inter_op_threads', help='Threads used across torch operations.', type=int, default=1)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    sample_abstract = io.open(SAMPLE_ABSTRACT, mode='r', encoding='utf-8').read()
+
+    report = benchmark_scaling(model_pickle_path=model_pickle_path_from_config(config, args.model),
+                               texts=[sample_abstract] * args.n_documents, n_workers=args.n_workers,
+                               intra_op_threads=args.intra_op_threads, inter_op_threads=args.inter_op_threads)
+
+    for key, value in report.items():
+        print(f'{key}: {value}')
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
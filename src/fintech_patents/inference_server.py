@@ -0,0 +1,375 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""HTTP/JSON inference server that groups concurrent requests in micro-batches.
+
+Endpoints:
+    POST /classify          {"text": "..."}           -> {"label": "...", "labels_percents": {...}}
+    POST /batch_classify    {"texts": ["...", ...]}   -> {"predictions": [{"label": ..., "labels_percents": ...}]}
+    GET  /health            200 while server is running.
+    GET  /ready             200 once model is loaded, 503 before.
+    GET  /metrics           Metrics in Prometheus text format.
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import configparser
+from inference_modeling import inference_batch
+from metrics import get_sink, increment, observe, record_rss, set_gauge
+from model_registry import get_model_tokenizer, model_pickle_path_from_config
+from prediction_cache import PREDICTION_CACHE
+from settings import (CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS, SERVER_MAX_BATCH_SIZE, SERVER_MAX_WAIT_MS,
+                      SERVER_MAX_QUEUE_SIZE)
+
+# Text of HTTP status codes used.
+HTTP_STATUS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+               413: 'Payload Too Large', 500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+class QueueFullError(Exception):
+    r"""
+    Raised when the micro-batch queue has no room for a request.
+    """
+
+
+class RequestTooLargeError(Exception):
+    r"""
+    Raised when a request has more documents than the micro-batch queue can ever hold.
+    """
+
+
+class MicroBatcher(object):
+    r"""
+    Collect documents from concurrent requests and classify them together.
+
+    A batch is run when it has `max_batch_size` documents or when `max_wait` seconds passed since its first
+    document arrived. Documents wait in a bounded queue, requests that don't fit are rejected. Requests with more
+    documents than the whole queue are always rejected.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of pickled model and tokenizer.
+
+        max_batch_size (:obj:`int`, `optional`, defaults to :obj:`settings.SERVER_MAX_BATCH_SIZE`):
+            Maximum number of documents in a batch.
+
+        max_wait (:obj:`float`, `optional`, defaults to :obj:`settings.SERVER_MAX_WAIT_MS` / 1000):
+            Maximum seconds the first document of a batch waits for other documents.
+
+        max_queue_size (:obj:`int`, `optional`, defaults to :obj:`settings.SERVER_MAX_QUEUE_SIZE`):
+            Maximum number of documents waiting.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        cache (:obj:`prediction_cache.PredictionCache`, `optional`):
+            Cache of predictions. Cached documents don't go through the model.
+
+        early_exit (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Stop each document at the first confident layer if the model has heads trained by `early_exit.py`.
+    """
+
+    def __init__(self, model_pickle_path, max_batch_size=SERVER_MAX_BATCH_SIZE, max_wait=SERVER_MAX_WAIT_MS / 1000,
+                 max_queue_size=SERVER_MAX_QUEUE_SIZE, max_batch_tokens=MAX_BATCH_TOKENS, cache=None,
+                 early_exit=False):
+
+        self.model_pickle_path = model_pickle_path
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_batch_tokens = max_batch_tokens
+        self.cache = cache
+        self.early_exit = early_exit
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+
+        # Counters.
+        self.batches = 0
+        self.documents = 0
+
+    async def classify(self, texts):
+        r"""
+        Queue documents and wait for their predictions.
+        """
+
+        # Waiting would never help a request larger than the whole queue.
+        if 0 < self.queue.maxsize < len(texts):
+            raise RequestTooLargeError()
+
+        # Reject whole request if it does not fit, so no request is half queued.
+        if self.queue.maxsize and self.queue.maxsize - self.queue.qsize() < len(texts):
+            raise QueueFullError()
+
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in texts]
+
+        for text, future in zip(texts, futures):
+            self.queue.put_nowait((text, future))
+
+        return await asyncio.gather(*futures)
+
+    async def run(self):
+        r"""
+        Run batches forever. Model runs on a worker thread so the server keeps accepting requests.
+        """
+
+        loop = asyncio.get_running_loop()
+
+        while True:
+            # Wait for first document of batch.
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            # Add documents until batch is full or time is up.
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout=timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            texts = [text for text, _ in batch]
+
+            try:
+                predictions = await loop.run_in_executor(None, lambda: inference_batch(
+                    model_pickle_path=self.model_pickle_path, texts=texts, ids_labels=IDS_LABELS,
+                    max_batch_tokens=self.max_batch_tokens, cache=self.cache, early_exit=self.early_exit))
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.documents += len(batch)
+            observe('server_batch_size', len(batch), buckets=[1, 2, 4, 8, 16, 32, 64, 128, 256])
+
+            for (_, future), (label, labels_percents, _, _) in zip(batch, predictions):
+                # Request can be gone if client disconnected.
+                if not future.done():
+                    future.set_result({'label': label,
+                                       'labels_percents': {lab: round(float(percent), 2)
+                                                           for lab, percent in labels_percents.items()}})
+
+
+class InferenceServer(object):
+    r"""
+    Minimal HTTP/1.1 server on asyncio streams that serves `MicroBatcher` predictions as JSON.
+
+    Arguments:
+
+        batcher (:obj:`MicroBatcher`):
+            Micro-batcher used for predictions.
+
+        max_body_size (:obj:`int`, `optional`, defaults to 10MB):
+            Maximum size of request body in bytes.
+    """
+
+    def __init__(self, batcher, max_body_size=10 * 1024 * 1024):
+
+        self.batcher = batcher
+        self.max_body_size = max_body_size
+        self.ready = False
+        self.start_time = time.time()
+
+    async def load_model(self):
+        r"""
+        Load model in the registry on a worker thread, then mark server ready.
+        """
+
+        await asyncio.get_running_loop().run_in_executor(None, get_model_tokenizer, self.batcher.model_pickle_path)
+        self.ready = True
+
+        return
+
+    async def handle_request(self, method, path, body):
+        r"""
+        Route request and return status code and JSON response, or text response for metrics.
+        """
+
+        if path == '/metrics':
+            record_rss()
+            set_gauge('server_queue_size', self.batcher.queue.qsize())
+            return 200, get_sink().prometheus_text()
+
+        if path == '/health':
+            return 200, {'status': 'ok', 'uptime_seconds': round(time.time() - self.start_time, 2)}
+
+        if path == '/ready':
+            return (200, {'status': 'ready'}) if self.ready else (503, {'status': 'loading model'})
+
+        if path not in ['/classify', '/batch_classify']:
+            return 404, {'error': f'Unknown path {path}'}
+
+        if method != 'POST':
+            return 405, {'error': 'Use POST'}
+
+        if not self.ready:
+            return 503, {'error': 'Model is not loaded yet'}
+
+        try:
+            request = json.loads(body.decode('utf-8'))
+            texts = [request['text']] if path == '/classify' else list(request['texts'])
+            if not all(isinstance(text, str) for text in texts):
+                raise ValueError('Texts need to be strings')
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': f'Bad request: {e}'}
+
+        try:
+            predictions = await self.batcher.classify(texts)
+        except RequestTooLargeError:
+            return 413, {'error': f'Request has more than {self.batcher.queue.maxsize} texts, split it'}
+        except QueueFullError:
+            increment('server_rejected_total')
+            return 503, {'error': 'Server is busy, try again later'}
+
+        return 200, predictions[0] if path == '/classify' else {'predictions': predictions}
+
+    async def handle_connection(self, reader, writer):
+        r"""
+        Serve requests of one connection. Connections are kept alive unless client asks to close them.
+        """
+
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+
+                method, path, version = request_line.decode('latin-1').split()
+
+                # Read headers.
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in [b'\r\n', b'\n', b'']:
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                content_length = int(headers.get('content-length', 0))
+                if content_length > self.max_body_size:
+                    status, response = 413, {'error': 'Request body too large'}
+                    keep_alive = False
+                else:
+                    body = await reader.readexactly(content_length) if content_length else b''
+                    try:
+                        status, response = await self.handle_request(method, path.split('?')[0], body)
+                    except Exception as e:
+                        status, response = 500, {'error': str(e)}
+                    keep_alive = headers.get('connection', '').lower() != 'close' and version == 'HTTP/1.1'
+
+                increment('server_responses_total', labels={'status': status})
+                text = isinstance(response, str)
+                payload = (response if text else json.dumps(response)).encode('utf-8')
+                writer.write(f'HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n'
+                             f'Content-Type: {"text/plain; version=0.0.4" if text else "application/json"}\r\n'
+                             f'Content-Length: {len(payload)}\r\n'
+                             f'Connection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'.encode('latin-1')
+                             + payload)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            # Client went away or sent something that is not HTTP.
+            pass
+
+        finally:
+            writer.close()
+
+        return
+
+    async def serve(self, host, port):
+        r"""
+        Start batcher, load model and serve until cancelled.
+        """
+
+        server = await asyncio.start_server(self.handle_connection, host=host, port=port)
+        batcher_task = asyncio.ensure_future(self.batcher.run())
+        await self.load_model()
+
+        print(f'Serving on http://{host}:{port}')
+        sys.stdout.flush()
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher_task.cancel()
+
+        return
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Serve predictions over HTTP/JSON.')
+
+    # Model used
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+
+    # Path of config file with pickled models
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # Address
+    parser.add_argument('--host', help='Host to listen on.', type=str, default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on.', type=int, default=8000)
+
+    # Micro-batching
+    parser.add_argument('--max_batch_size', help='Maximum number of documents in a batch.',
+                        type=int, default=SERVER_MAX_BATCH_SIZE)
+    parser.add_argument('--max_wait_ms', help='Maximum milliseconds a document waits for a batch to fill.',
+                        type=float, default=SERVER_MAX_WAIT_MS)
+    parser.add_argument('--max_queue_size', help='Maximum number of documents waiting. More are rejected.',
+                        type=int, default=SERVER_MAX_QUEUE_SIZE)
+
+    # Cache of predictions on disk
+    parser.add_argument('--path_prediction_cache', help='SQLite file where predictions are cached.',
+                        type=str, default=None)
+
+    # Early exit heads trained by `early_exit.py`
+    parser.add_argument('--early_exit', help='Stop documents at first confident layer if model has early exit heads.',
+                        action='store_true')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    # Predictions cached on disk survive restarts.
+    if args.path_prediction_cache is not None:
+        PREDICTION_CACHE.open_disk(args.path_prediction_cache)
+
+    async def main():
+        # Queue needs to be created inside the running event loop.
+        batcher = MicroBatcher(model_pickle_path=model_pickle_path_from_config(config, args.model),
+                               max_batch_size=args.max_batch_size, max_wait=args.max_wait_ms / 1000,
+                               max_queue_size=args.max_queue_size, cache=PREDICTION_CACHE,
+                               early_exit=args.early_exit)
+        await InferenceServer(batcher=batcher).serve(host=args.host, port=args.port)
+
+    asyncio.run(main())
@@ -0,0 +1,300 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Counters, histograms and gauges of each stage with a Prometheus text exporter and per-request traces."""
+
+import time
+import bisect
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+import psutil
+
+# Prefix of all exported metric names.
+METRICS_PREFIX = 'fintech_patents_'
+
+# Upper bounds of histogram buckets in seconds.
+LATENCY_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+# Upper bounds of histogram buckets in tokens.
+TOKENS_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096]
+
+# Spans of the trace of current request. None when no trace is recorded.
+_TRACE = contextvars.ContextVar('trace', default=None)
+
+
+class MetricsSink(object):
+    r"""
+    Where metrics go. Subclass it to send metrics to another system, and use it with `set_sink`.
+
+    This sink drops all metrics.
+    """
+
+    def increment(self, name, value=1, labels=None):
+        r"""
+        Add value to a counter.
+        """
+
+        return
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        r"""
+        Add value to a histogram.
+        """
+
+        return
+
+    def set_gauge(self, name, value, labels=None):
+        r"""
+        Set current value of a gauge.
+        """
+
+        return
+
+    def prometheus_text(self):
+        r"""
+        Export metrics in Prometheus text format. Sinks that don't keep metrics have nothing to export.
+        """
+
+        return ''
+
+
+class InMemorySink(MetricsSink):
+    r"""
+    Keep metrics in memory so they can be exported. Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+
+        # (name, labels) -> value.
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) -> [bucket upper bounds, bucket counts, sum, count].
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, value=1, labels=None):
+        key = (name, _labels_key(labels))
+
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+        return
+
+    def observe(self, name, value, labels=None, buckets=LATENCY_BUCKETS):
+        key = (name, _labels_key(labels))
+
+        with self._lock:
+            if key not in self.histograms:
+                self.histograms[key] = [list(buckets), [0] * (len(buckets) + 1), 0.0, 0]
+            histogram = self.histograms[key]
+            # Last count is for values over all bounds.
+            histogram[1][bisect.bisect_left(histogram[0], value)] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+        return
+
+    def set_gauge(self, name, value, labels=None):
+        with self._lock:
+            self.gauges[(name, _labels_key(labels))] = value
+
+        return
+
+    def clear(self):
+        r"""
+        Remove all metrics.
+        """
+
+        with self._lock:
+            self.counters.clear()
+            self.gauges.clear()
+            self.histograms.clear()
+
+        return
+
+    def prometheus_text(self):
+        r"""
+        Export all metrics in Prometheus text format.
+
+        Returns:
+
+            :obj:`str`: Metrics, one sample on each line.
+        """
+
+        lines = []
+
+        with self._lock:
+            for metric_type, values in [('counter', self.counters), ('gauge', self.gauges)]:
+                for name in sorted(set(name for name, _ in values)):
+                    lines.append(f'# TYPE {METRICS_PREFIX}{name} {metric_type}')
+                    for (sample_name, labels), value in sorted(values.items()):
+                        if sample_name == name:
+                            lines.append(f'{METRICS_PREFIX}{name}{_format_labels(labels)} {value}')
+
+            for name in sorted(set(name for name, _ in self.histograms)):
+                lines.append(f'# TYPE {METRICS_PREFIX}{name} histogram')
+                for (sample_name, labels), (bounds, counts, total, count) in sorted(self.histograms.items()):
+                    if sample_name != name:
+                        continue
+                    # Prometheus buckets are cumulative.
+                    cumulative = 0
+                    for bound, bucket_count in zip(bounds + ['+Inf'], counts):
+                        cumulative += bucket_count
+                        bucket_labels = labels + (('le', str(bound)),)
+                        lines.append(f'{METRICS_PREFIX}{name}_bucket{_format_labels(bucket_labels)} {cumulative}')
+                    lines.append(f'{METRICS_PREFIX}{name}_sum{_format_labels(labels)} {total}')
+                    lines.append(f'{METRICS_PREFIX}{name}_count{_format_labels(labels)} {count}')
+
+        return '\n'.join(lines) + '\n'
+
+
+def _labels_key(labels):
+    # Labels as sorted tuple so they can be used in dictionary keys.
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    # Escape characters Prometheus does not allow inside label values.
+    values = [str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels]
+
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(labels, values)) + '}'
+
+
+# Sink used by the whole process.
+_SINK = InMemorySink()
+
+
+def get_sink():
+    r"""
+    Sink where metrics currently go.
+    """
+
+    return _SINK
+
+
+def set_sink(sink):
+    r"""
+    Send all metrics to another sink, like `MetricsSink()` to turn metrics off.
+    """
+
+    global _SINK
+    _SINK = sink
+
+    return
+
+
+def increment(name, value=1, labels=None):
+    r"""
+    Add value to a counter of the current sink.
+    """
+
+    _SINK.increment(name, value=value, labels=labels)
+
+    return
+
+
+def observe(name, value, labels=None, buckets=LATENCY_BUCKETS):
+    r"""
+    Add value to a histogram of the current sink.
+    """
+
+    _SINK.observe(name, value, labels=labels, buckets=buckets)
+
+    return
+
+
+def set_gauge(name, value, labels=None):
+    r"""
+    Set gauge of the current sink.
+    """
+
+    _SINK.set_gauge(name, value, labels=labels)
+
+    return
+
+
+@contextmanager
+def timer(stage):
+    r"""
+    Time a stage. Adds seconds to `stage_seconds` histogram and a span to the trace of current request, if one is
+    recorded.
+
+    Arguments:
+
+        stage (:obj:`str`):
+            Name of stage, like `tokenize` or `forward`.
+    """
+
+    start_time = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start_time
+        _SINK.observe('stage_seconds', seconds, labels={'stage': stage})
+        spans = _TRACE.get()
+        if spans is not None:
+            spans.append((stage, round(1000 * seconds, 3)))
+
+
+def timed(stage):
+    r"""
+    Decorator that times each call of a function with `timer`.
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with timer(stage):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def trace():
+    r"""
+    Record a trace of all stages timed inside this block. Traces are opt-in, nothing is recorded outside of it.
+
+    Yields:
+
+        :obj:`list`: Tuples of stage name and milliseconds, in the order stages finished.
+    """
+
+    spans = []
+    token = _TRACE.set(spans)
+    try:
+        yield spans
+    finally:
+        _TRACE.reset(token)
+
+
+def record_rss():
+    r"""
+    Set `process_rss_bytes` gauge to resident memory of this process.
+
+    Returns:
+
+        :obj:`int`: Resident memory in bytes.
+    """
+
+    rss = psutil.Process().memory_info().rss
+    _SINK.set_gauge('process_rss_bytes', rss)
+
+    return rss
@@ -0,0 +1,206 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Save and load models with weights in a memory mapped file.
+
+A model folder has the model `config.json`, the tokenizer files, `weights.bin` with all tensors stored one after
+the other and `weights.json` with the name, dtype, shape and offset of each tensor. Loading maps `weights.bin` in
+memory so tensors are read from disk only when used and processes on the same host share the same pages.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# Name of file with all tensors.
+WEIGHTS_FILE = 'weights.bin'
+
+# Name of file with tensors index.
+WEIGHTS_INDEX_FILE = 'weights.json'
+
+# Each tensor starts at an offset multiple of this value.
+WEIGHTS_ALIGNMENT = 64
+
+
+def save_mmap_model(tokenizer, model, export_path):
+    r"""
+    Save tokenizer, model config and model weights in a folder that can be loaded with `load_mmap_model`.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model.
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model to save.
+
+        export_path (:obj:`str`):
+            Folder where model is saved.
+
+    Returns:
+
+        :obj:`str`: Path of model folder.
+    """
+
+    # Create folder if doesn't exists
+    os.makedirs(export_path, exist_ok=True)
+
+    # Save config and tokenizer files.
+    model.config.save_pretrained(export_path)
+    tokenizer.save_pretrained(export_path)
+
+    index = {}
+    offset = 0
+
+    with open(os.path.join(export_path, WEIGHTS_FILE), 'wb') as weights_file:
+        for name, tensor in model.state_dict().items():
+            array = tensor.detach().cpu().contiguous().numpy()
+
+            # Pad so each tensor starts aligned.
+            padding = -offset % WEIGHTS_ALIGNMENT
+            weights_file.write(b'\0' * padding)
+            offset += padding
+
+            index[name] = {'dtype': array.dtype.str, 'shape': list(array.shape), 'offset': offset}
+            weights_file.write(array.tobytes())
+            offset += array.nbytes
+
+    with open(os.path.join(export_path, WEIGHTS_INDEX_FILE), 'w') as index_file:
+        json.dump(index, index_file)
+
+    return export_path
+
+
+def load_mmap_weights(export_path):
+    r"""
+    Map `weights.bin` in memory and return a dictionary of tensor name and tensor.
+
+    Weights are mapped copy on write so tensors are writable, but pages are shared until written.
+    """
+
+    with open(os.path.join(export_path, WEIGHTS_INDEX_FILE), 'r') as index_file:
+        index = json.load(index_file)
+
+    # PyTorch is imported only when a model is loaded, so importing this module is fast.
+    import torch
+
+    weights = np.memmap(os.path.join(export_path, WEIGHTS_FILE), dtype=np.uint8, mode='c')
+
+    return {name: torch.from_numpy(np.ndarray(shape=info['shape'], dtype=np.dtype(info['dtype']),
+                                              buffer=weights, offset=info['offset']))
+            for name, info in index.items()}
+
+
+def load_mmap_model(export_path):
+    r"""
+    Load tokenizer and model saved with `save_mmap_model`.
+
+    The model is built from its config without initializing weights, and then each parameter and buffer is
+    pointed to the memory mapped tensor, so weights are never computed or copied.
+
+    Arguments:
+
+        export_path (:obj:`str`):
+            Model folder.
+
+    Returns:
+
+        :obj:`tuple`: tokenizer and model.
+    """
+
+    import torch
+    from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer
+    from transformers.modeling_utils import no_init_weights
+
+    tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=export_path, use_fast=True)
+    model_config = AutoConfig.from_pretrained(pretrained_model_name_or_path=export_path)
+    # Random initialization would be thrown away. Tensors are allocated but their pages are never touched.
+    with no_init_weights():
+        model = AutoModelForSequenceClassification.from_config(model_config)
+
+    modules = dict(model.named_modules())
+
+    for name, tensor in load_mmap_weights(export_path).items():
+        module_name, _, tensor_name = name.rpartition('.')
+        module = modules[module_name]
+        # Replace tensor without copying mapped memory.
+        if tensor_name in module._parameters:
+            module._parameters[tensor_name] = torch.nn.Parameter(tensor, requires_grad=False)
+        else:
+            module._buffers[tensor_name] = tensor
+
+    # Model built from config is in train mode.
+    model.eval()
+
+    return tokenizer, model
+
+
+def measure_load(model_path):
+    r"""
+    Load model in a new process and measure load time and resident memory. PyTorch and transformers are imported
+    before timing starts, so only the load itself is measured.
+
+    Arguments:
+
+        model_path (:obj:`str`):
+            Path of pickled model or folder of memory mapped model.
+
+    Returns:
+
+        :obj:`dict`: Load time in seconds, resident memory in MB after load and resident memory in MB added by
+        the load.
+    """
+
+    # Fresh process so nothing is cached by a previous load.
+    code = ('import sys, time, json, psutil, torch, transformers; '
+            'from transformers import AutoModelForSequenceClassification; '
+            'from model_registry import load_model_tokenizer; '
+            'rss = psutil.Process().memory_info().rss; start = time.time(); '
+            'loaded = load_model_tokenizer(sys.argv[1]); '
+            'seconds = time.time() - start; loaded_rss = psutil.Process().memory_info().rss; '
+            'print(json.dumps({"load_seconds": round(seconds, 4), "rss_mb": round(loaded_rss / 1024 / 1024, 2), '
+            '"load_rss_mb": round((loaded_rss - rss) / 1024 / 1024, 2)}))')
+    output = subprocess.check_output([sys.executable, '-c', code, os.path.abspath(model_path)],
+                                     cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Compare load time and memory of pickled and mapped models.')
+
+    # Path of pickled model
+    parser.add_argument('--model_tokenizer_pickle_path', help='Path of pickled model and tokenizer.',
+                        type=str, required=True)
+
+    # Path of memory mapped model
+    parser.add_argument('--model_tokenizer_mmap_path', help='Folder of memory mapped model and tokenizer.',
+                        type=str, required=True)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    for model_format, path in [('pickle', args.model_tokenizer_pickle_path),
+                               ('mmap', args.model_tokenizer_mmap_path)]:
+        print(f'{model_format}: {measure_load(path)}')
+        sys.stdout.flush()
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
@@ -0,0 +1,215 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Make faster CPU variants of models: dynamic int8 quantization and ONNX export."""
+
+import os
+import sys
+import time
+import numpy as np
+from inference_modeling import predict_batch
+from settings import IDS_LABELS, MAX_BATCH_TOKENS
+
+
+def quantize_model(model):
+    r"""
+    Quantize weights of all linear layers to int8. Activations are quantized on the fly at inference.
+
+    Arguments:
+
+        model (:obj:`torch.nn.Module`):
+            Model with float32 weights.
+
+    Returns:
+
+        :obj:`torch.nn.Module`: New quantized model.
+    """
+
+    # PyTorch is imported only when a model is optimized.
+    import torch
+
+    return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class OnnxModel(object):
+    r"""
+    Run an ONNX exported model with `onnxruntime` using the same `forward` call as a transformers model.
+
+    Only the path of the .onnx file is pickled. The `onnxruntime` session is created the first time the model is
+    used. ONNX models only return logits, so no attentions are available for highlight.
+
+    Arguments:
+
+        onnx_path (:obj:`str`):
+            Path of .onnx file.
+    """
+
+    def __init__(self, onnx_path):
+        self.onnx_path = onnx_path
+        self._session = None
+
+    def session(self):
+        r"""
+        Create `onnxruntime` session first time it is needed.
+        """
+
+        if self._session is None:
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError('Running ONNX models needs `onnxruntime`. Install it with `pip install onnxruntime`.')
+            self._session = onnxruntime.InferenceSession(self.onnx_path)
+
+        return self._session
+
+    def forward(self, output_attentions=False, return_dict=True, **inputs):
+        import torch
+
+        session = self.session()
+        # Use only inputs the exported graph has.
+        feed = {model_input.name: inputs[model_input.name].cpu().numpy() for model_input in session.get_inputs()}
+        logits = session.run(['logits'], feed)[0]
+
+        return {'logits': torch.from_numpy(logits), 'attentions': None}
+
+    def __call__(self, **inputs):
+        return self.forward(**inputs)
+
+    def eval(self):
+        return self
+
+    def memory_size(self):
+        return os.path.getsize(self.onnx_path)
+
+    def __getstate__(self):
+        # Session can't be pickled.
+        return {'onnx_path': self.onnx_path, '_session': None}
+
+
+def export_onnx(tokenizer, model, onnx_path, opset_version=11):
+    r"""
+    Export model to ONNX with dynamic batch size and sequence length.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model used to make example inputs.
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model to export.
+
+        onnx_path (:obj:`str`):
+            Path of .onnx file.
+
+        opset_version (:obj:`int`, `optional`, defaults to :obj:`11`):
+            ONNX opset used.
+
+    Returns:
+
+        :obj:`OnnxModel`: Exported model.
+    """
+
+    import torch
+
+    inputs = tokenizer(text=['Example of a patent abstract.'], return_tensors='pt')
+    input_names = ['input_ids', 'attention_mask']
+
+    # Exported graph returns a tuple with logits.
+    return_dict = model.config.return_dict
+    model.config.return_dict = False
+
+    try:
+        torch.onnx.export(model, tuple(inputs[name] for name in input_names), onnx_path,
+                          input_names=input_names, output_names=['logits'],
+                          dynamic_axes={'input_ids': {0: 'batch', 1: 'sequence'},
+                                        'attention_mask': {0: 'batch', 1: 'sequence'},
+                                        'logits': {0: 'batch'}},
+                          opset_version=opset_version)
+    finally:
+        # Model can be shared, so config is restored even if export failed.
+        model.config.return_dict = return_dict
+
+    return OnnxModel(onnx_path=onnx_path)
+
+
+def accuracy_drift(tokenizer, reference_model, model, texts, ids_labels=IDS_LABELS,
+                   max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Compare predictions and speed of a model variant against the float32 model on held-out texts.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer used by both models.
+
+        reference_model (:obj:`transformers.PreTrainedModel`):
+            Original float32 model.
+
+        model (:obj:`object`):
+            Model variant.
+
+        texts (:obj:`list`):
+            Held-out texts.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+    Returns:
+
+        :obj:`dict`: Label agreement, differences of labels percentages and speedup.
+    """
+
+    timings = []
+    predictions = []
+
+    for current_model in [reference_model, model]:
+        start_time = time.time()
+        predictions.append(predict_batch(tokenizer=tokenizer, model=current_model, texts=texts,
+                                         ids_labels=ids_labels, max_batch_tokens=max_batch_tokens))
+        timings.append(time.time() - start_time)
+
+    reference_predictions, model_predictions = predictions
+
+    # Percentages of each label for all documents.
+    reference_percents = np.array([list(labels_percents.values()) for _, labels_percents, _, _ in
+                                   reference_predictions])
+    model_percents = np.array([list(labels_percents.values()) for _, labels_percents, _, _ in model_predictions])
+    percents_difference = np.abs(reference_percents - model_percents)
+
+    agreement = np.mean([reference_label == model_label for (reference_label, _, _, _), (model_label, _, _, _) in
+                         zip(reference_predictions, model_predictions)])
+
+    return {'documents': len(texts),
+            'label_agreement': round(float(agreement), 4),
+            'mean_percent_difference': round(float(percents_difference.mean()), 4),
+            'max_percent_difference': round(float(percents_difference.max()), 4),
+            'reference_seconds': round(timings[0], 4),
+            'variant_seconds': round(timings[1], 4),
+            'speedup': round(timings[0] / timings[1], 2)}
+
+
+def print_drift_report(name, report):
+    r"""
+    Print accuracy drift report of a model variant.
+    """
+
+    print(f'Accuracy drift of `{name}` against float32:')
+    for key, value in report.items():
+        print(f'  {key}: {value}')
+    sys.stdout.flush()
+
+    return
@@ -0,0 +1,481 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Make smaller CPU variants of models by pruning attention heads and layers.
+
+Importance of each attention head is the gradient of the loss with respect to a mask on the head, normalized in
+each layer. Importance of each layer is how much the loss grows when the layer is skipped. Both are scored on a
+calibration sample. The least important layers and heads are removed until the model fits a size or latency budget.
+"""
+
+import sys
+import time
+import copy
+import numpy as np
+from inference_modeling import length_buckets, predict_batch
+from tokenization import encode_batch
+from settings import IDS_LABELS, MAX_BATCH_TOKENS
+
+# Module with the list of encoder layers and config field with number of layers for each `model_type`.
+MODEL_LAYERS = {'distilbert': ('distilbert.transformer', 'n_layers'),
+                'roberta': ('roberta.encoder', 'num_hidden_layers'),
+                'bert': ('bert.encoder', 'num_hidden_layers')}
+
+# Shares of heads of remaining layers tried for each number of removed layers.
+HEADS_SHARES = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7]
+
+
+def model_layers(model):
+    r"""
+    Module that holds the encoder layers of a model and config field with their number.
+
+    Returns:
+
+        :obj:`tuple`: Module with `layer` list and name of config field.
+    """
+
+    model_type = getattr(getattr(model, 'config', None), 'model_type', None)
+    if model_type not in MODEL_LAYERS:
+        raise ValueError(f'Pruning does not support model type `{model_type}`! Use one of: {list(MODEL_LAYERS)}')
+
+    module_path, config_field = MODEL_LAYERS[model_type]
+    module = model
+    for name in module_path.split('.'):
+        module = getattr(module, name)
+
+    return module, config_field
+
+
+def count_parameters(model):
+    r"""
+    Number of parameters of a model.
+    """
+
+    return int(sum(parameter.numel() for parameter in model.parameters()))
+
+
+def calibration_batches(tokenizer, texts, max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Tokenize calibration texts once in length bucketed batches.
+
+    Returns:
+
+        :obj:`list`: Tuples of documents indexes and padded inputs of each batch.
+    """
+
+    encodings, _ = encode_batch(tokenizer=tokenizer, texts=texts)
+    lengths = [len(input_ids) for input_ids in encodings['input_ids']]
+
+    return [(batch, tokenizer.pad({key: [values[index] for index in batch] for key, values in encodings.items()},
+                                  padding=True, return_tensors='pt'))
+            for batch in length_buckets(lengths=lengths, max_batch_tokens=max_batch_tokens)]
+
+
+def calibration_logits(model, batches, n_documents):
+    r"""
+    Logits of all calibration documents in their original order.
+
+    Returns:
+
+        :obj:`np.ndarray`: Logits of shape [number of documents, number of labels].
+    """
+
+    import torch
+
+    logits = None
+    with torch.no_grad():
+        for batch, inputs in batches:
+            # First output is logits for both tuple and dictionary outputs.
+            batch_logits = model(**inputs)[0].numpy()
+            if logits is None:
+                logits = np.zeros((n_documents, batch_logits.shape[1]), dtype=np.float32)
+            logits[batch] = batch_logits
+
+    return logits
+
+
+def calibration_loss(logits, references):
+    r"""
+    Average cross entropy of logits against reference label ids.
+    """
+
+    shifted = logits - logits.max(axis=-1, keepdims=True)
+    log_probabilities = shifted - np.log(np.exp(shifted).sum(axis=-1, keepdims=True))
+
+    return float(-log_probabilities[np.arange(len(references)), references].mean())
+
+
+def head_importance(model, batches, references):
+    r"""
+    Score each attention head by the gradient of the loss with respect to a mask on its output.
+
+    Arguments:
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Model scored. Its weights are not changed.
+
+        batches (:obj:`list`):
+            Calibration batches from `calibration_batches`.
+
+        references (:obj:`np.ndarray`):
+            Reference label id of each calibration document.
+
+    Returns:
+
+        :obj:`np.ndarray`: Importance of shape [number of layers, number of heads]. Scores of each layer have unit
+        L2 norm so heads of different layers can be ranked together.
+    """
+
+    import torch
+
+    module, config_field = model_layers(model)
+    head_mask = torch.ones(getattr(model.config, config_field), model.config.num_attention_heads,
+                           requires_grad=True)
+    scores = torch.zeros_like(head_mask)
+
+    for batch, inputs in batches:
+        logits = model(**inputs, head_mask=head_mask)[0]
+        loss = torch.nn.functional.cross_entropy(logits, torch.from_numpy(references[batch]).long(), reduction='sum')
+        gradient, = torch.autograd.grad(loss, head_mask)
+        scores += gradient.abs()
+
+    scores = scores.numpy()
+    norms = np.linalg.norm(scores, axis=-1, keepdims=True)
+
+    return scores / np.where(norms > 0, norms, 1)
+
+
+def layer_importance(model, batches, references):
+    r"""
+    Score each layer by how much the calibration loss grows when the layer is skipped.
+
+    See `head_importance` for arguments.
+
+    Returns:
+
+        :obj:`np.ndarray`: Loss increase of each layer.
+    """
+
+    import torch
+
+    module, _ = model_layers(model)
+    layers = module.layer
+    n_documents = len(references)
+    base_loss = calibration_loss(calibration_logits(model=model, batches=batches, n_documents=n_documents),
+                                 references)
+
+    scores = []
+    try:
+        for index in range(len(layers)):
+            module.layer = torch.nn.ModuleList([layer for i, layer in enumerate(layers) if i != index])
+            loss = calibration_loss(calibration_logits(model=model, batches=batches, n_documents=n_documents),
+                                    references)
+            scores.append(loss - base_loss)
+    finally:
+        # Put back all layers.
+        module.layer = layers
+
+    return np.array(scores)
+
+
+def pruning_plan(head_scores, layer_scores, n_layers_removed, heads_share):
+    r"""
+    Least important layers and heads to remove.
+
+    Arguments:
+
+        head_scores (:obj:`np.ndarray`):
+            Importance of each head from `head_importance`.
+
+        layer_scores (:obj:`np.ndarray`):
+            Importance of each layer from `layer_importance`.
+
+        n_layers_removed (:obj:`int`):
+            Number of layers removed.
+
+        heads_share (:obj:`float`):
+            Share of heads of remaining layers removed. Each layer keeps at least one head.
+
+    Returns:
+
+        :obj:`tuple`: Dictionary of layer index and heads removed in it, and sorted indexes of layers kept. Layer
+        indexes are the ones of the original model.
+    """
+
+    layers_kept = sorted(int(index) for index in np.argsort(layer_scores, kind='stable')[n_layers_removed:])
+    n_heads = head_scores.shape[1]
+    n_removed = int(round(heads_share * len(layers_kept) * n_heads))
+
+    heads_to_prune = {}
+    # Heads of kept layers from least to most important.
+    candidates = sorted(((head_scores[layer, head], layer, head) for layer in layers_kept for head in range(n_heads)))
+    for _, layer, head in candidates:
+        if n_removed == 0:
+            break
+        if len(heads_to_prune.get(layer, [])) < n_heads - 1:
+            heads_to_prune.setdefault(layer, []).append(head)
+            n_removed -= 1
+
+    return {layer: sorted(heads) for layer, heads in heads_to_prune.items()}, layers_kept
+
+
+def prune_model(model, heads_to_prune, layers_kept):
+    r"""
+    Copy of model without pruned heads and removed layers.
+
+    The config of the copy has the new number of layers and pruned heads of kept layers, so it can be saved and
+    loaded with `from_pretrained` or memory mapped like any other model.
+
+    Arguments:
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Original model. It is not changed.
+
+        heads_to_prune (:obj:`dict`):
+            Layer index and list of heads removed in it.
+
+        layers_kept (:obj:`list`):
+            Indexes of layers kept.
+
+    Returns:
+
+        :obj:`transformers.PreTrainedModel`: Pruned model.
+    """
+
+    import torch
+
+    pruned = copy.deepcopy(model)
+    if heads_to_prune:
+        pruned.prune_heads(heads_to_prune)
+
+    module, config_field = model_layers(pruned)
+    module.layer = torch.nn.ModuleList([module.layer[index] for index in layers_kept])
+    setattr(pruned.config, config_field, len(layers_kept))
+    # DistilBERT transformer keeps its own number of layers.
+    if hasattr(module, 'n_layers'):
+        module.n_layers = len(layers_kept)
+
+    # Pruned heads use indexes of kept layers.
+    pruned_heads = {int(layer): heads for layer, heads in pruned.config.pruned_heads.items()}
+    pruned.config.pruned_heads = {new_index: pruned_heads[index] for new_index, index in enumerate(layers_kept)
+                                  if pruned_heads.get(index)}
+
+    return pruned.eval()
+
+
+def seconds_per_document(tokenizer, model, texts, ids_labels=IDS_LABELS, max_batch_tokens=MAX_BATCH_TOKENS,
+                         n_runs=2):
+    r"""
+    Best time of predicting texts over a few runs, divided by number of texts.
+    """
+
+    # Run once first so only predictions are timed.
+    predict_batch(tokenizer=tokenizer, model=model, texts=texts[:1], ids_labels=ids_labels)
+
+    timings = []
+    for _ in range(n_runs):
+        start_time = time.time()
+        predict_batch(tokenizer=tokenizer, model=model, texts=texts, ids_labels=ids_labels,
+                      max_batch_tokens=max_batch_tokens)
+        timings.append(time.time() - start_time)
+
+    return min(timings) / len(texts)
+
+
+def search_pruning(tokenizer, model, texts, label_ids=None, target_size=None, target_latency=None,
+                   heads_shares=HEADS_SHARES, max_batch_tokens=MAX_BATCH_TOKENS, n_latency_texts=64):
+    r"""
+    Prune a model to a size or latency budget with the least loss of accuracy on a calibration sample.
+
+    For each number of removed layers, the smallest share of heads that meets the budget is removed. Of those
+    candidates, the one with best calibration accuracy is kept.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model.
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Original model. It is not changed.
+
+        texts (:obj:`list`):
+            Calibration texts.
+
+        label_ids (:obj:`list`, `optional`):
+            Label id of each calibration text. Labels of the original model are used if not given, so the pruned
+            model learns to agree with it.
+
+        target_size (:obj:`float`, `optional`):
+            Largest share of parameters of the original model the pruned model can have.
+
+        target_latency (:obj:`float`, `optional`):
+            Largest share of time per document of the original model the pruned model can take.
+
+        heads_shares (:obj:`list`, `optional`, defaults to :obj:`HEADS_SHARES`):
+            Shares of heads tried in increasing order.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+        n_latency_texts (:obj:`int`, `optional`, defaults to :obj:`64`):
+            Number of calibration texts timed to check latency budget.
+
+    Returns:
+
+        :obj:`tuple`: Pruned model and dictionary with layers kept, heads removed and calibration accuracy.
+    """
+
+    if target_size is None and target_latency is None:
+        raise ValueError('Set `target_size` or `target_latency` to prune a model!')
+
+    texts = list(texts)
+    model.eval()
+    batches = calibration_batches(tokenizer=tokenizer, texts=texts, max_batch_tokens=max_batch_tokens)
+    original_logits = calibration_logits(model=model, batches=batches, n_documents=len(texts))
+    references = original_logits.argmax(axis=-1) if label_ids is None else np.asarray(label_ids)
+
+    head_scores = head_importance(model=model, batches=batches, references=references)
+    layer_scores = layer_importance(model=model, batches=batches, references=references)
+
+    original_parameters = count_parameters(model)
+    latency_texts = texts[:n_latency_texts]
+    original_latency = None
+    if target_latency is not None:
+        original_latency = seconds_per_document(tokenizer=tokenizer, model=model, texts=latency_texts,
+                                                max_batch_tokens=max_batch_tokens)
+
+    best_model, best_plan = None, None
+    for n_layers_removed in range(len(layer_scores)):
+        for heads_share in heads_shares:
+            heads_to_prune, layers_kept = pruning_plan(head_scores=head_scores, layer_scores=layer_scores,
+                                                       n_layers_removed=n_layers_removed, heads_share=heads_share)
+            candidate = prune_model(model=model, heads_to_prune=heads_to_prune, layers_kept=layers_kept)
+
+            if target_size is not None and count_parameters(candidate) > target_size * original_parameters:
+                continue
+            if target_latency is not None and seconds_per_document(
+                    tokenizer=tokenizer, model=candidate, texts=latency_texts,
+                    max_batch_tokens=max_batch_tokens) > target_latency * original_latency:
+                continue
+
+            logits = calibration_logits(model=candidate, batches=batches, n_documents=len(texts))
+            accuracy = float(np.mean(logits.argmax(axis=-1) == references))
+            print(f'Removing {n_layers_removed} layers and {int(heads_share * 100)}% of heads meets budget with '
+                  f'calibration accuracy {accuracy:.4f}')
+            sys.stdout.flush()
+
+            if best_plan is None or accuracy > best_plan['calibration_accuracy']:
+                best_model = candidate
+                best_plan = {'layers_kept': layers_kept,
+                             'heads_pruned': heads_to_prune,
+                             'calibration_accuracy': round(accuracy, 4)}
+            # Removing more heads with the same layers only loses accuracy.
+            break
+
+    if best_model is None:
+        raise ValueError(f'No pruning meets target size {target_size} and target latency {target_latency}!')
+
+    return best_model, best_plan
+
+
+def pruning_report(tokenizer, reference_model, model, texts, label_ids=None, ids_labels=IDS_LABELS,
+                   max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Compare parameters, latency and accuracy of each label of a pruned model against the original model.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer used by both models.
+
+        reference_model (:obj:`transformers.PreTrainedModel`):
+            Original model.
+
+        model (:obj:`transformers.PreTrainedModel`):
+            Pruned model.
+
+        texts (:obj:`list`):
+            Held-out texts.
+
+        label_ids (:obj:`list`, `optional`):
+            Label id of each text. Labels of the original model are used if not given, so accuracy of the
+            original model is 1.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        max_batch_tokens (:obj:`int`, `optional`, defaults to :obj:`settings.MAX_BATCH_TOKENS`):
+            Maximum number of tokens, padding included, in a forward pass.
+
+    Returns:
+
+        :obj:`dict`: Parameters, milliseconds per document, speedup, label agreement, accuracy of both models and
+        number of documents, accuracy of both models for each label.
+    """
+
+    texts = list(texts)
+    labels_ids = {label: label_id for label_id, label in ids_labels.items()}
+
+    latencies = []
+    predictions = []
+    for current_model in [reference_model, model]:
+        latencies.append(seconds_per_document(tokenizer=tokenizer, model=current_model, texts=texts,
+                                              ids_labels=ids_labels, max_batch_tokens=max_batch_tokens, n_runs=1))
+        predictions.append(np.array([labels_ids.get(label, -1) for label, _, _, _ in
+                                     predict_batch(tokenizer=tokenizer, model=current_model, texts=texts,
+                                                   ids_labels=ids_labels, max_batch_tokens=max_batch_tokens)]))
+
+    reference_predictions, model_predictions = predictions
+    references = reference_predictions if label_ids is None else np.asarray(label_ids)
+
+    labels = {}
+    for label_id, label in ids_labels.items():
+        rows = references == label_id
+        labels[label] = {'documents': int(rows.sum()),
+                         'original_accuracy': round(float(np.mean(reference_predictions[rows] == label_id)), 4)
+                         if rows.any() else None,
+                         'pruned_accuracy': round(float(np.mean(model_predictions[rows] == label_id)), 4)
+                         if rows.any() else None}
+
+    original_parameters, pruned_parameters = count_parameters(reference_model), count_parameters(model)
+
+    return {'documents': len(texts),
+            'original_parameters': original_parameters,
+            'pruned_parameters': pruned_parameters,
+            'parameters_share': round(pruned_parameters / original_parameters, 4),
+            'original_ms_per_document': round(latencies[0] * 1000, 2),
+            'pruned_ms_per_document': round(latencies[1] * 1000, 2),
+            'speedup': round(latencies[0] / latencies[1], 2),
+            'label_agreement': round(float(np.mean(reference_predictions == model_predictions)), 4),
+            'original_accuracy': round(float(np.mean(reference_predictions == references)), 4),
+            'pruned_accuracy': round(float(np.mean(model_predictions == references)), 4),
+            'labels': labels}
+
+
+def print_pruning_report(name, report):
+    r"""
+    Print pruning report of a model variant.
+    """
+
+    print(f'Pruning report of `{name}` against original:')
+    for key, value in report.items():
+        if key == 'labels':
+            continue
+        print(f'  {key}: {value}')
+    for label, label_report in report['labels'].items():
+        print(f'  {label}: {label_report["documents"]} documents | accuracy {label_report["original_accuracy"]} -> '
+              f'{label_report["pruned_accuracy"]}')
+    sys.stdout.flush()
+
+    return
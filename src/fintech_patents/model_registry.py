@@ -0,0 +1,292 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Keep loaded models in memory so each model is unpickled only once per process."""
+
+import os
+import sys
+import time
+import pickle
+import threading
+from collections import OrderedDict
+from mmap_models import load_mmap_model
+from metrics import increment, set_gauge, timer
+from settings import MODELS_MEMORY_BUDGET_MB
+
+
+def load_model_tokenizer(model_pickle_path):
+    r"""
+    Load tokenizer and model from .pickle created by `pickle_models.pickle_pytorch_models` or from folder created
+    by `mmap_models.save_mmap_model`.
+
+    Arguments:
+
+        model_pickle_path (:obj:`str`):
+            Path of the pickled [tokenizer, model] list or folder of memory mapped model.
+
+    Returns:
+
+        :obj:`tuple`: tokenizer and model.
+    """
+
+    # Memory mapped models are saved in a folder.
+    if os.path.isdir(model_pickle_path):
+        return load_mmap_model(export_path=model_pickle_path)
+
+    with open(model_pickle_path, 'rb') as handle:
+        tokenizer, model = pickle.load(handle)
+
+    return tokenizer, model
+
+
+def tensors_memory_size(value):
+    r"""
+    Number of bytes used by a tensor or a tuple of tensors, like packed parameters of quantized layers.
+    """
+
+    if hasattr(value, 'element_size'):
+        return value.numel() * value.element_size()
+
+    if isinstance(value, (tuple, list)):
+        return sum(tensors_memory_size(item) for item in value)
+
+    return 0
+
+
+def model_memory_size(model):
+    r"""
+    Number of bytes used by the model's parameters and buffers.
+
+    Arguments:
+
+        model (:obj:`torch.nn.Module`):
+            Loaded PyTorch model. Models that are not PyTorch modules can have a `memory_size` method.
+
+    Returns:
+
+        :obj:`int`: Size in bytes.
+    """
+
+    if hasattr(model, 'memory_size'):
+        return model.memory_size()
+
+    # Parameters and buffers hold almost all the memory of a model. Quantized layers keep their weights in
+    # packed parameters that are only found in the state dict.
+    return sum(tensors_memory_size(value) for value in model.state_dict().values())
+
+
+class ModelRegistry(object):
+    r"""
+    Process wide registry of loaded models keyed by their `model_tokenizer_pickle_path`.
+
+    Each model is loaded once and kept in memory. When the models loaded go over the memory budget the least
+    recently used models are evicted. A model larger than the whole budget is still kept since it is the one
+    in use.
+
+    Arguments:
+
+        memory_budget_mb (:obj:`int`, `optional`, defaults to :obj:`settings.MODELS_MEMORY_BUDGET_MB`):
+            Maximum memory in MB that all loaded models can use together.
+
+        loader (:obj:`callable`, `optional`, defaults to :obj:`load_model_tokenizer`):
+            Function that takes a model path and returns tokenizer and model.
+    """
+
+    def __init__(self, memory_budget_mb=MODELS_MEMORY_BUDGET_MB, loader=load_model_tokenizer):
+
+        self.memory_budget = int(memory_budget_mb * 1024 * 1024)
+        self.loader = loader
+
+        # Keep models in least recently used order: path -> (tokenizer, model, size in bytes).
+        self._models = OrderedDict()
+        # Streamlit runs each session in its own thread.
+        self._lock = threading.RLock()
+
+        # Counters.
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_time = 0.0
+
+    def get(self, model_pickle_path):
+        r"""
+        Return tokenizer and model for path. Load them if they are not in memory yet.
+        """
+
+        key = os.path.abspath(model_pickle_path)
+
+        with self._lock:
+            if key in self._models:
+                # Mark as most recently used.
+                self._models.move_to_end(key)
+                self.hits += 1
+                increment('model_registry_requests_total', labels={'result': 'hit'})
+                tokenizer, model, _ = self._models[key]
+                return tokenizer, model
+
+            self.misses += 1
+            increment('model_registry_requests_total', labels={'result': 'miss'})
+
+            # Time how long it takes to load model.
+            start_time = time.time()
+            with timer('load'):
+                tokenizer, model = self.loader(key)
+            self.load_time += time.time() - start_time
+
+            self._models[key] = (tokenizer, model, model_memory_size(model))
+            self._evict_over_budget()
+
+            return tokenizer, model
+
+    def add(self, model_pickle_path, tokenizer, model):
+        r"""
+        Add tokenizer and model already loaded somewhere else, like a model shared with a worker process.
+        """
+
+        with self._lock:
+            self._models[os.path.abspath(model_pickle_path)] = (tokenizer, model, model_memory_size(model))
+            self._models.move_to_end(os.path.abspath(model_pickle_path))
+            self._evict_over_budget()
+
+        return
+
+    def warm_up(self, model_pickle_paths):
+        r"""
+        Load all models from a list of paths ahead of the first prediction.
+        """
+
+        for model_pickle_path in model_pickle_paths:
+            print(f'Warm up model: `{model_pickle_path}`')
+            sys.stdout.flush()
+            self.get(model_pickle_path)
+
+        return
+
+    def evict(self, model_pickle_path):
+        r"""
+        Remove model from memory. Return True if the model was loaded.
+        """
+
+        with self._lock:
+            return self._models.pop(os.path.abspath(model_pickle_path), None) is not None
+
+    def clear(self):
+        r"""
+        Remove all models from memory.
+        """
+
+        with self._lock:
+            self._models.clear()
+
+        return
+
+    def memory_used(self):
+        r"""
+        Number of bytes used by all loaded models.
+        """
+
+        with self._lock:
+            return sum(size for _, _, size in self._models.values())
+
+    def stats(self):
+        r"""
+        Dictionary with registry counters.
+        """
+
+        with self._lock:
+            return {'models_loaded': len(self._models),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'load_time_seconds': round(self.load_time, 4),
+                    'memory_used_mb': round(self.memory_used() / 1024 / 1024, 2),
+                    'memory_budget_mb': round(self.memory_budget / 1024 / 1024, 2)}
+
+    def _evict_over_budget(self):
+        # Never evict the most recently used model.
+        while len(self._models) > 1 and self.memory_used() > self.memory_budget:
+            evicted_path, _ = self._models.popitem(last=False)
+            self.evictions += 1
+            increment('model_registry_evictions_total')
+            print(f'Evicted model from memory: `{evicted_path}`')
+            sys.stdout.flush()
+
+        set_gauge('model_registry_memory_bytes', self.memory_used())
+        set_gauge('model_registry_models_loaded', len(self._models))
+
+        return
+
+
+# Registry shared by the whole process.
+MODEL_REGISTRY = ModelRegistry()
+
+
+def get_model_tokenizer(model_pickle_path):
+    r"""
+    Return tokenizer and model from the process registry.
+    """
+
+    return MODEL_REGISTRY.get(model_pickle_path)
+
+
+def model_path_from_section(config_file, section):
+    r"""
+    Path used to load model of a config section: `model_tokenizer_mmap_path` if the model was exported memory
+    mapped, else `model_tokenizer_pickle_path`. Return None if section has none of them.
+    """
+
+    return config_file.get(section, 'model_tokenizer_mmap_path',
+                           fallback=config_file.get(section, 'model_tokenizer_pickle_path', fallback=None))
+
+
+def warm_up_from_config(config_file):
+    r"""
+    Load all models that have `model_tokenizer_pickle_path` in config file.
+
+    Arguments:
+
+        config_file (:obj:`configparser.ConfigParser`):
+            Config file already read.
+    """
+
+    model_pickle_paths = [model_path_from_section(config_file, section) for section in config_file.sections()
+                          if model_path_from_section(config_file, section) is not None]
+
+    MODEL_REGISTRY.warm_up(model_pickle_paths)
+
+    return
+
+
+def model_pickle_path_from_config(config_file, model_name):
+    r"""
+    Find path used to load a model using its section name or display name.
+
+    Arguments:
+
+        config_file (:obj:`configparser.ConfigParser`):
+            Config file already read.
+
+        model_name (:obj:`str`):
+            Section name or `display_name` of model.
+
+    Returns:
+
+        :obj:`str`: Path of pickled model and tokenizer or folder of memory mapped model.
+    """
+
+    for section in config_file.sections():
+        if model_name in [section, config_file.get(section, 'display_name', fallback=None)]:
+            return model_path_from_section(config_file, section)
+
+    raise ValueError(f'Model `{model_name}` not found in config file! Models: {config_file.sections()}')
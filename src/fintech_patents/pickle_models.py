@@ -15,21 +15,34 @@
 """Run this script to load model and pickle them for faster inference."""
 
 
+import io
+import json
 import pickle
 import shutil
 import os
 import sys
 import argparse
+import itertools
 import configparser
-from transformers import (AutoConfig,
-                          AutoModelForSequenceClassification,
-                          AutoTokenizer,
-                          set_seed)
-from settings import CONFIG_FILE
+from mmap_models import save_mmap_model
+from model_registry import load_model_tokenizer, model_path_from_section
+from model_optimization import quantize_model, export_onnx, accuracy_drift, print_drift_report
+from model_pruning import search_pruning, pruning_report, print_pruning_report
+from classify_corpus import read_corpus
+from settings import CONFIG_FILE, IDS_LABELS, SAMPLE_ABSTRACT
 
 
+def load_pretrained(model_path_, use_fast=True):
+    r"""
+    Load tokenizer and model from a pretrained model folder.
+
+    Fast tokenizers are used by default so predictions get token offsets. Models without a fast tokenizer fall back
+    to the Python one.
+    """
+
+    # Transformers takes seconds to import, so it is loaded only when a pretrained model is.
+    from transformers import AutoConfig, AutoModelForSequenceClassification, AutoTokenizer, set_seed
 
-def pickle_pytorch_models(model_path_, pickled_path):
     print(f'Loading configuration, tokenizer and model from: `{model_path_}`')
     sys.stdout.flush()
     # Set seed for reproducibility,
@@ -44,7 +57,7 @@ def pickle_pytorch_models(model_path_, pickled_path):
     # Get model's tokenizer.
     print('Loading tokenizer...')
     sys.stdout.flush()
-    tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=model_path_)
+    tokenizer = AutoTokenizer.from_pretrained(pretrained_model_name_or_path=model_path_, use_fast=use_fast)
 
     # Get the actual model.
     print('Loading model...')
@@ -52,6 +65,26 @@ def pickle_pytorch_models(model_path_, pickled_path):
     model = AutoModelForSequenceClassification.from_pretrained(pretrained_model_name_or_path=model_path_,
                                                                config=model_config)
 
+    return tokenizer, model
+
+
+def remove_pretrained(model_path_):
+    r"""
+    Remove pretrained model folder once it was saved in the format used for inference.
+    """
+
+    try:
+        shutil.rmtree(model_path_)
+    except OSError as e:
+        print("Error: %s : %s" % (model_path_, e.strerror))
+        sys.stdout.flush()
+
+    return
+
+
+def pickle_pytorch_models(model_path_, pickled_path, remove_pretrained_=True):
+    tokenizer, model = load_pretrained(model_path_)
+
     model_tokenizer_pickle_name_ = os.path.join(pickled_path, f'{os.path.basename(model_path_)}.pickle')
 
     with open(model_tokenizer_pickle_name_, 'wb') as handle:
@@ -61,15 +94,137 @@ def pickle_pytorch_models(model_path_, pickled_path):
     sys.stdout.flush()
 
     # Remove pretrained
-    try:
-        shutil.rmtree(model_path_)
-    except OSError as e:
-        print("Error: %s : %s" % (model_path_, e.strerror))
-        sys.stdout.flush()
+    if remove_pretrained_:
+        remove_pretrained(model_path_)
 
     return model_tokenizer_pickle_name_
 
 
+def export_mmap_models(model_path_, export_path, remove_pretrained_=True):
+    r"""
+    Save model in a folder with memory mapped weights, fast tokenizer and config.
+
+    Loading it does not deserialize the model in new memory and processes on the same host share its weights.
+    See `mmap_models.py`.
+    """
+
+    tokenizer, model = load_pretrained(model_path_, use_fast=True)
+
+    model_tokenizer_mmap_name_ = save_mmap_model(tokenizer=tokenizer, model=model,
+                                                 export_path=os.path.join(export_path,
+                                                                          os.path.basename(model_path_)))
+
+    print(f'Model and Tokenizer exported memory mapped at:   `{model_tokenizer_mmap_name_}`\n')
+    sys.stdout.flush()
+
+    # Remove pretrained
+    if remove_pretrained_:
+        remove_pretrained(model_path_)
+
+    return model_tokenizer_mmap_name_
+
+
+def optimize_pytorch_models(model_tokenizer_path, pickled_path, quantize=True, onnx=False, drift_texts=None,
+                            prune=False, prune_target_size=None, prune_target_latency=None, calibration_texts=None,
+                            calibration_label_ids=None, drift_label_ids=None):
+    r"""
+    Make faster CPU variants of a model and pickle each of them with the tokenizer.
+
+    Arguments:
+
+        model_tokenizer_path (:obj:`str`):
+            Path of pickled model or folder of memory mapped model.
+
+        pickled_path (:obj:`str`):
+            Folder where variants are pickled.
+
+        quantize (:obj:`bool`, `optional`, defaults to :obj:`True`):
+            Make dynamic int8 quantized variant.
+
+        onnx (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Make ONNX exported variant. Running it needs `onnxruntime`.
+
+        drift_texts (:obj:`list`, `optional`):
+            Held-out texts used to print accuracy drift of each variant against the float32 model.
+
+        prune (:obj:`bool`, `optional`, defaults to :obj:`False`):
+            Make variant with least important attention heads and layers removed. See `model_pruning.py`.
+
+        prune_target_size (:obj:`float`, `optional`):
+            Largest share of parameters of the original model the pruned variant can have.
+
+        prune_target_latency (:obj:`float`, `optional`):
+            Largest share of time per document of the original model the pruned variant can take.
+
+        calibration_texts (:obj:`list`, `optional`):
+            Texts used to score heads and layers. Needed when `prune` is True.
+
+        calibration_label_ids (:obj:`list`, `optional`):
+            Label id of each calibration text. Labels of the original model are used if not given.
+
+        drift_label_ids (:obj:`list`, `optional`):
+            Label id of each held-out text used in pruning report.
+
+    Returns:
+
+        :obj:`dict`: Variant name and path of pickled variant.
+    """
+
+    tokenizer, model = load_model_tokenizer(model_tokenizer_path)
+    name = os.path.splitext(os.path.basename(os.path.normpath(model_tokenizer_path)))[0]
+
+    variants = {}
+
+    if quantize:
+        print(f'Quantizing `{name}` to int8...')
+        sys.stdout.flush()
+        variants['int8'] = quantize_model(model)
+
+    if onnx:
+        print(f'Exporting `{name}` to ONNX...')
+        sys.stdout.flush()
+        variants['onnx'] = export_onnx(tokenizer=tokenizer, model=model,
+                                       onnx_path=os.path.join(pickled_path, f'{name}.onnx'))
+
+    if prune:
+        if not calibration_texts:
+            raise ValueError('Pruning needs calibration texts!')
+        print(f'Pruning `{name}`...')
+        sys.stdout.flush()
+        variants['pruned'], plan = search_pruning(tokenizer=tokenizer, model=model, texts=calibration_texts,
+                                                  label_ids=calibration_label_ids, target_size=prune_target_size,
+                                                  target_latency=prune_target_latency)
+        print(f'Kept layers {plan["layers_kept"]} and removed heads {plan["heads_pruned"]}')
+        sys.stdout.flush()
+
+    variants_paths = {}
+
+    for variant, variant_model in variants.items():
+        variants_paths[variant] = os.path.join(pickled_path, f'{name}-{variant}.pickle')
+
+        with open(variants_paths[variant], 'wb') as handle:
+            pickle.dump([tokenizer, variant_model], handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+        print(f'Model and Tokenizer {variant} pickled at:  `{variants_paths[variant]}`')
+        sys.stdout.flush()
+
+        # Show size, speed and accuracy of each label against original.
+        if variant == 'pruned' and drift_texts:
+            report = pruning_report(tokenizer=tokenizer, reference_model=model, model=variant_model,
+                                    texts=drift_texts, label_ids=drift_label_ids)
+            print_pruning_report(name=f'{name}-{variant}', report=report)
+            with open(os.path.join(pickled_path, f'{name}-{variant}.json'), 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+
+        # Show speed and quality trade-off.
+        elif drift_texts:
+            print_drift_report(name=f'{name}-{variant}',
+                               report=accuracy_drift(tokenizer=tokenizer, reference_model=model,
+                                                     model=variant_model, texts=drift_texts))
+
+    return variants_paths
+
+
 # Main run of the script.
 if __name__ == '__main__':
 
@@ -80,6 +235,33 @@ if __name__ == '__main__':
     parser.add_argument('--model_tokenizer_pickle_path', help='Path where all pretrained models are stored pickled.',
                         type=str, default='pickled_models')
 
+    # Format used to save models
+    parser.add_argument('--model_format', help='Save models pickled or with memory mapped weights.',
+                        type=str, default='pickle', choices=['pickle', 'mmap'])
+
+    # Optimization stage
+    parser.add_argument('--quantize', help='Add dynamic int8 quantized variant of each model.', action='store_true')
+    parser.add_argument('--onnx', help='Add ONNX exported variant of each model.', action='store_true')
+    parser.add_argument('--prune', help='Add variant of each model with least important attention heads and layers '
+                                        'removed. Needs `--path_drift_sample`.', action='store_true')
+    parser.add_argument('--prune_target_size', help='Largest share of parameters of original model kept when '
+                                                    'pruning.', type=float, default=None)
+    parser.add_argument('--prune_target_latency', help='Largest share of time per document of original model when '
+                                                       'pruning.', type=float, default=None)
+    parser.add_argument('--prune_calibration_size', help='Number of first held-out texts used to score heads and '
+                                                         'layers. Next texts are used in pruning report.',
+                        type=int, default=128)
+
+    # Held-out sample for accuracy drift
+    parser.add_argument('--path_drift_sample', help='JSONL, CSV or Parquet file of held-out texts used to check '
+                                                    'accuracy drift of variants. Uses sample abstract if not set.',
+                        type=str, default=None)
+    parser.add_argument('--drift_text_field', help='Name of field with text in held-out file.',
+                        type=str, default='abstract')
+    parser.add_argument('--drift_label_field', help='Name of field with label name in held-out file. Labels of '
+                                                    'original model are used if not set.', type=str, default=None)
+    parser.add_argument('--drift_sample_size', help='Number of held-out texts used.', type=int, default=256)
+
     # Parse arguments
     args = parser.parse_args()
 
@@ -98,12 +280,75 @@ if __name__ == '__main__':
         model_path = config.get(section, 'model_path', fallback='')
 
         # Check if file actually exists
-        if os.path.isdir(model_path):
+        if os.path.isdir(model_path) and args.model_format == 'mmap':
+            model_tokenizer_mmap_name = export_mmap_models(model_path_=model_path,
+                                                           export_path=args.model_tokenizer_pickle_path)
+            # Add memory mapped model path to section.
+            config.set(section, 'model_tokenizer_mmap_path', model_tokenizer_mmap_name)
+
+        elif os.path.isdir(model_path):
             model_tokenizer_pickle_name = pickle_pytorch_models(model_path_=model_path,
                                                                 pickled_path=args.model_tokenizer_pickle_path)
             # Add pickled model path to section.
             config.set(section, 'model_tokenizer_pickle_path', model_tokenizer_pickle_name)
 
+    if args.prune and args.path_drift_sample is None:
+        parser.error('`--prune` needs `--path_drift_sample` to score heads and layers.')
+
+    if args.prune and args.prune_target_size is None and args.prune_target_latency is None:
+        args.prune_target_size = 0.7
+
+    if args.quantize or args.onnx or args.prune:
+        # Held-out texts for accuracy drift.
+        drift_labels = None
+        if args.path_drift_sample is not None:
+            drift_records = list(itertools.islice(read_corpus(args.path_drift_sample), args.drift_sample_size))
+            drift_sample = [record.get(args.drift_text_field) or '' for record in drift_records]
+            if args.drift_label_field is not None:
+                labels_ids = {label: label_id for label_id, label in IDS_LABELS.items()}
+                drift_labels = [labels_ids[record[args.drift_label_field]] for record in drift_records]
+        else:
+            drift_sample = [io.open(SAMPLE_ABSTRACT, mode='r', encoding='utf-8').read()]
+
+        # Pruned variant is scored on first held-out texts and reported on the rest.
+        n_calibration = args.prune_calibration_size if args.prune else 0
+        calibration_sample, report_sample = drift_sample[:n_calibration], drift_sample[n_calibration:]
+        calibration_labels, report_labels = None, None
+        if drift_labels is not None:
+            calibration_labels, report_labels = drift_labels[:n_calibration], drift_labels[n_calibration:]
+        # Small samples are used for both.
+        if not report_sample:
+            report_sample, report_labels = drift_sample, drift_labels
+
+        # Sections are added while looping.
+        for section in list(config.sections()):
+            model_tokenizer_path = model_path_from_section(config, section)
+
+            # Skip sections without model and variants of other models.
+            if model_tokenizer_path is None or config.has_option(section, 'variant_of'):
+                continue
+
+            variants_paths = optimize_pytorch_models(model_tokenizer_path=model_tokenizer_path,
+                                                     pickled_path=args.model_tokenizer_pickle_path,
+                                                     quantize=args.quantize, onnx=args.onnx,
+                                                     drift_texts=report_sample, prune=args.prune,
+                                                     prune_target_size=args.prune_target_size,
+                                                     prune_target_latency=args.prune_target_latency,
+                                                     calibration_texts=calibration_sample,
+                                                     calibration_label_ids=calibration_labels,
+                                                     drift_label_ids=report_labels)
+
+            # Add each variant as a new model that can be selected.
+            for variant, variant_path in variants_paths.items():
+                variant_section = f'{section}-{variant}'
+                if not config.has_section(variant_section):
+                    config.add_section(variant_section)
+                config.set(variant_section, 'display_name',
+                           f"{config.get(section, 'display_name', fallback=section)}-{variant}")
+                config.set(variant_section, 'description', f'This is the {variant} variant of {section}.')
+                config.set(variant_section, 'model_tokenizer_pickle_path', variant_path)
+                config.set(variant_section, 'variant_of', section)
+
     # Writing updated configuration file with `model_path` added.
     with open(CONFIG_FILE, 'w') as configfile:
         config.write(configfile)
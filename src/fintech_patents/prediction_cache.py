@@ -0,0 +1,273 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache predictions by normalized text, model and labels."""
+
+import os
+import json
+import struct
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+from metrics import increment
+from settings import PREDICTION_CACHE_MAX_ENTRIES
+
+
+def normalize_text(text):
+    r"""
+    Normalize unicode and whitespace so the same abstract copied from different sources has the same key.
+    """
+
+    return ' '.join(unicodedata.normalize('NFC', text).split())
+
+
+def model_fingerprint(model_path):
+    r"""
+    Identity of a model artifact: path, size and modification time. Changes when the artifact is replaced.
+
+    Arguments:
+
+        model_path (:obj:`str`):
+            Path of pickled model or folder of memory mapped model.
+
+    Returns:
+
+        :obj:`str`: Fingerprint of model.
+    """
+
+    model_path = os.path.abspath(model_path)
+    # Folders of memory mapped models change when any of their files change.
+    paths = sorted(os.path.join(model_path, name) for name in os.listdir(model_path)) \
+        if os.path.isdir(model_path) else [model_path]
+    stats = [(os.path.basename(path), os.stat(path).st_size, os.stat(path).st_mtime_ns) for path in paths]
+
+    return hashlib.sha256(json.dumps([model_path, stats]).encode('utf-8')).hexdigest()
+
+
+def cache_key(text, fingerprint, ids_labels):
+    r"""
+    Content address of a prediction: hash of normalized text, model fingerprint and labels.
+    """
+
+    key = json.dumps([normalize_text(text), fingerprint, sorted(ids_labels.items())])
+
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def encode_prediction(prediction):
+    r"""
+    Encode a prediction in compact bytes.
+
+    Labels percentages are stored as hundredths in uint16, which keeps the 2 decimal places exactly, and
+    attentions as float16. Label names and tokens are stored in a small JSON header.
+    """
+
+    label, labels_percents, attentions, tokens = prediction
+
+    percents = np.round(np.array(list(labels_percents.values()), dtype=np.float64) * 100).astype(np.uint16)
+    # Attentions can be missing or have None values.
+    has_attentions = attentions is not None and None not in list(attentions)
+    weights = np.asarray(attentions, dtype=np.float16) if has_attentions else np.zeros(0, dtype=np.float16)
+
+    header = json.dumps({'label': label,
+                         'labels': list(labels_percents.keys()),
+                         'tokens': tokens,
+                         'n_attentions': None if attentions is None else len(attentions),
+                         'has_attentions': has_attentions}).encode('utf-8')
+
+    return struct.pack('<I', len(header)) + header + percents.tobytes() + weights.tobytes()
+
+
+def decode_prediction(value):
+    r"""
+    Decode bytes from `encode_prediction` back to label, labels percentages, attentions and tokens.
+    """
+
+    header_size = struct.unpack('<I', value[:4])[0]
+    header = json.loads(value[4:4 + header_size].decode('utf-8'))
+
+    n_labels = len(header['labels'])
+    percents_start = 4 + header_size
+    weights_start = percents_start + 2 * n_labels
+
+    percents = np.frombuffer(value[percents_start:weights_start], dtype=np.uint16).astype(np.float32) / 100
+    labels_percents = {label: percent for label, percent in zip(header['labels'], percents)}
+
+    if header['has_attentions']:
+        attentions = np.frombuffer(value[weights_start:], dtype=np.float16).astype(np.float32)
+    elif header['n_attentions'] is not None:
+        attentions = [None] * header['n_attentions']
+    else:
+        attentions = None
+
+    return header['label'], labels_percents, attentions, header['tokens']
+
+
+class PredictionCache(object):
+    r"""
+    Two tier cache of predictions: in memory least recently used entries and an optional SQLite file that
+    survives restarts.
+
+    Keys include the model fingerprint, so replacing a model artifact never returns stale predictions. When a
+    new fingerprint is seen for a model path, entries of its older fingerprints are deleted from disk.
+
+    Arguments:
+
+        max_entries (:obj:`int`, `optional`, defaults to :obj:`settings.PREDICTION_CACHE_MAX_ENTRIES`):
+            Maximum number of predictions kept in memory.
+
+        path_sqlite (:obj:`str`, `optional`):
+            Path of SQLite file used as disk tier. No disk tier if not used.
+    """
+
+    def __init__(self, max_entries=PREDICTION_CACHE_MAX_ENTRIES, path_sqlite=None):
+
+        self.max_entries = max_entries
+
+        # Key -> encoded prediction.
+        self._memory = OrderedDict()
+        # Model path -> last fingerprint seen.
+        self._fingerprints = {}
+        self._lock = threading.RLock()
+        self._connection = None
+        self.path_sqlite = None
+
+        # Counters.
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        if path_sqlite is not None:
+            self.open_disk(path_sqlite)
+
+    def open_disk(self, path_sqlite):
+        r"""
+        Use SQLite file as disk tier. Does nothing if file is already used.
+        """
+
+        with self._lock:
+            if self.path_sqlite == path_sqlite:
+                return
+
+            # Streamlit sessions run on different threads. Access is serialized with the lock.
+            self._connection = sqlite3.connect(path_sqlite, check_same_thread=False)
+            self._connection.execute('CREATE TABLE IF NOT EXISTS predictions '
+                                     '(key TEXT PRIMARY KEY, model_path TEXT, fingerprint TEXT, value BLOB)')
+            self._connection.commit()
+            self.path_sqlite = path_sqlite
+
+        return
+
+    def fingerprint(self, model_path):
+        r"""
+        Fingerprint of model. Deletes cached predictions of older versions of the model artifact.
+        """
+
+        fingerprint = model_fingerprint(model_path)
+        model_path = os.path.abspath(model_path)
+
+        with self._lock:
+            if self._fingerprints.get(model_path) != fingerprint:
+                self._fingerprints[model_path] = fingerprint
+                if self._connection is not None:
+                    self._connection.execute('DELETE FROM predictions WHERE model_path = ? AND fingerprint != ?',
+                                             (model_path, fingerprint))
+                    self._connection.commit()
+
+        return fingerprint
+
+    def get(self, key):
+        r"""
+        Return prediction or None if key is not cached.
+        """
+
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                increment('prediction_cache_requests_total', labels={'result': 'hit'})
+                return decode_prediction(self._memory[key])
+
+            if self._connection is not None:
+                row = self._connection.execute('SELECT value FROM predictions WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    self.disk_hits += 1
+                    increment('prediction_cache_requests_total', labels={'result': 'disk_hit'})
+                    self._add_memory(key, bytes(row[0]))
+                    return decode_prediction(bytes(row[0]))
+
+            self.misses += 1
+            increment('prediction_cache_requests_total', labels={'result': 'miss'})
+
+            return None
+
+    def put(self, key, prediction, model_path=None, fingerprint=None):
+        r"""
+        Cache prediction tuple of label, labels percentages, attentions and tokens.
+        """
+
+        value = encode_prediction(prediction)
+
+        with self._lock:
+            self._add_memory(key, value)
+
+            if self._connection is not None:
+                self._connection.execute('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                                         (key, None if model_path is None else os.path.abspath(model_path),
+                                          fingerprint, sqlite3.Binary(value)))
+                self._connection.commit()
+
+        return
+
+    def clear(self):
+        r"""
+        Remove all cached predictions from memory and disk.
+        """
+
+        with self._lock:
+            self._memory.clear()
+            if self._connection is not None:
+                self._connection.execute('DELETE FROM predictions')
+                self._connection.commit()
+
+        return
+
+    def stats(self):
+        r"""
+        Dictionary with cache counters.
+        """
+
+        with self._lock:
+            return {'entries_in_memory': len(self._memory),
+                    'hits': self.hits,
+                    'disk_hits': self.disk_hits,
+                    'misses': self.misses,
+                    'memory_bytes': sum(len(value) for value in self._memory.values())}
+
+    def _add_memory(self, key, value):
+        self._memory[key] = value
+        self._memory.move_to_end(key)
+
+        # Evict least recently used predictions.
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+        return
+
+
+# Cache shared by the whole process.
+PREDICTION_CACHE = PredictionCache()
@@ -0,0 +1,384 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cheap first stage that settles obvious non-fintech documents before the transformer.
+
+A logistic regression on hashed word n-grams is distilled from the transformer: it learns the transformer's own
+`non-fintech` probability. Documents it scores above a threshold are labeled `non-fintech` right away, all others
+go to the transformer.
+"""
+
+import re
+import sys
+import json
+import time
+import zlib
+import argparse
+import itertools
+import configparser
+import numpy as np
+from classify_corpus import CORPUS_FORMATS, read_corpus
+from inference_modeling import inference_batch
+from model_registry import model_pickle_path_from_config
+from settings import CONFIG_FILE, IDS_LABELS, MAX_BATCH_TOKENS, NON_FINTECH_LABEL, PREFILTER_THRESHOLD
+
+# Words are runs of letters and digits.
+_WORDS = re.compile(r'\w+')
+
+
+class HashedNgramModel(object):
+    r"""
+    Logistic regression on hashed word n-grams. Only needs NumPy.
+
+    Documents are sparse rows of hashed n-gram counts scaled to unit length. Each n-gram goes to one of
+    `n_features` weights with a sign, so collisions cancel out on average.
+
+    Arguments:
+
+        n_features (:obj:`int`, `optional`, defaults to :obj:`262144`):
+            Number of weights. Power of 2.
+
+        ngram_max (:obj:`int`, `optional`, defaults to :obj:`2`):
+            Longest n-gram used. Uses words and word pairs by default.
+    """
+
+    def __init__(self, n_features=2 ** 18, ngram_max=2):
+        self.n_features = n_features
+        self.ngram_max = ngram_max
+        self.weights = np.zeros(n_features, dtype=np.float32)
+        self.bias = 0.0
+
+    def features(self, texts):
+        r"""
+        Sparse features of texts.
+
+        Returns:
+
+            :obj:`tuple`: Arrays of row of each value, feature index of each value and values.
+        """
+
+        rows, indexes, values = [], [], []
+
+        for row, text in enumerate(texts):
+            words = _WORDS.findall(text.lower())
+            ngrams = [' '.join(words[start:start + n]) for n in range(1, self.ngram_max + 1)
+                      for start in range(len(words) - n + 1)]
+            if not ngrams:
+                continue
+            hashes = np.array([zlib.crc32(ngram.encode('utf-8')) for ngram in ngrams], dtype=np.uint32)
+            # Low bits pick the weight, top bit picks the sign.
+            rows.append(np.full(len(ngrams), row, dtype=np.int64))
+            indexes.append((hashes & np.uint32(self.n_features - 1)).astype(np.int64))
+            values.append(np.where(hashes >> np.uint32(31), 1.0, -1.0) / np.sqrt(len(ngrams)))
+
+        if not rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+
+        return np.concatenate(rows), np.concatenate(indexes), np.concatenate(values)
+
+    def _scores(self, n_texts, rows, indexes, values):
+        return np.bincount(rows, weights=self.weights[indexes] * values, minlength=n_texts) + self.bias
+
+    def predict_proba(self, texts):
+        r"""
+        Probability of each text being `non-fintech`.
+
+        Returns:
+
+            :obj:`np.ndarray`: Probabilities of shape [number of texts].
+        """
+
+        texts = list(texts)
+        scores = self._scores(len(texts), *self.features(texts))
+
+        return 1 / (1 + np.exp(-scores))
+
+    def fit(self, texts, targets, epochs=10, batch_size=256, learning_rate=2.0, l2=1e-6, seed=0):
+        r"""
+        Train with mini-batch Adagrad on log loss. Targets can be soft, like probabilities of a teacher model.
+
+        Arguments:
+
+            texts (:obj:`list`):
+                Text of each document.
+
+            targets (:obj:`list`):
+                Probability of `non-fintech` of each document, from 0 to 1.
+
+            epochs (:obj:`int`, `optional`, defaults to :obj:`10`):
+                Passes over all documents.
+
+            batch_size (:obj:`int`, `optional`, defaults to :obj:`256`):
+                Documents in each update.
+
+            learning_rate (:obj:`float`, `optional`, defaults to :obj:`2.0`):
+                Adagrad learning rate.
+
+            l2 (:obj:`float`, `optional`, defaults to :obj:`1e-6`):
+                L2 regularization of weights.
+
+            seed (:obj:`int`, `optional`, defaults to :obj:`0`):
+                Seed of shuffling.
+
+        Returns:
+
+            :obj:`HashedNgramModel`: This model.
+        """
+
+        texts = list(texts)
+        targets = np.asarray(targets, dtype=np.float64)
+        random_state = np.random.RandomState(seed)
+        # Features are hashed once for all epochs.
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            batches.append((self.features(texts[start:start + batch_size]), targets[start:start + batch_size]))
+
+        weights = self.weights.astype(np.float64)
+        squared_gradients = np.full(self.n_features, 1e-8)
+        bias_squared_gradient = 1e-8
+
+        for _ in range(epochs):
+            for batch_index in random_state.permutation(len(batches)):
+                (rows, indexes, values), batch_targets = batches[batch_index]
+                scores = np.bincount(rows, weights=weights[indexes] * values,
+                                     minlength=len(batch_targets)) + self.bias
+                residuals = (1 / (1 + np.exp(-scores)) - batch_targets) / len(batch_targets)
+
+                gradient = np.bincount(indexes, weights=values * residuals[rows], minlength=self.n_features)
+                # Only features in batch are updated and regularized.
+                used = np.unique(indexes)
+                gradient[used] += l2 * weights[used]
+                squared_gradients[used] += gradient[used] ** 2
+                weights[used] -= learning_rate * gradient[used] / np.sqrt(squared_gradients[used])
+
+                bias_gradient = residuals.sum()
+                bias_squared_gradient += bias_gradient ** 2
+                self.bias -= learning_rate * bias_gradient / np.sqrt(bias_squared_gradient)
+
+        self.weights = weights.astype(np.float32)
+
+        return self
+
+    def save(self, path):
+        r"""
+        Save model to a `.npz` file.
+        """
+
+        np.savez_compressed(path, weights=self.weights, bias=self.bias, ngram_max=self.ngram_max)
+
+        return
+
+    @classmethod
+    def load(cls, path):
+        r"""
+        Load model saved with `save`.
+        """
+
+        data = np.load(path)
+        model = cls(n_features=len(data['weights']), ngram_max=int(data['ngram_max']))
+        model.weights = data['weights']
+        model.bias = float(data['bias'])
+
+        return model
+
+
+def settled_prediction(probability, ids_labels=IDS_LABELS):
+    r"""
+    Prediction of a document settled by the first stage. The first stage only knows `non-fintech`, so the rest of
+    the percentage is split evenly between other labels.
+
+    Returns:
+
+        :obj:`tuple`: Label and labels percentages.
+    """
+
+    other_percent = round(100 * (1 - float(probability)) / (len(ids_labels) - 1), 2)
+    labels_percents = {label: round(100 * float(probability), 2) if label == NON_FINTECH_LABEL else other_percent
+                       for label in ids_labels.values()}
+
+    return NON_FINTECH_LABEL, labels_percents
+
+
+def cascade_batch(prefilter, texts, predict, ids_labels=IDS_LABELS, threshold=PREFILTER_THRESHOLD):
+    r"""
+    Settle confident `non-fintech` documents with the first stage and predict the rest with the transformer.
+
+    Arguments:
+
+        prefilter (:obj:`HashedNgramModel`):
+            First stage.
+
+        texts (:obj:`list`):
+            Text of each document.
+
+        predict (:obj:`callable`):
+            Transformer predictions of a list of texts, like `inference_batch` or `InferencePool.map`.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name.
+
+        threshold (:obj:`float`, `optional`, defaults to :obj:`settings.PREFILTER_THRESHOLD`):
+            Documents with `non-fintech` probability of first stage at least this are settled.
+
+    Returns:
+
+        :obj:`tuple`: Tuples of label, labels percentages, attentions and tokens in same order as `texts`, and
+        array that is True for documents settled by the first stage. Settled documents have no attentions and
+        tokens.
+    """
+
+    texts = list(texts)
+    probabilities = prefilter.predict_proba(texts)
+    settled = probabilities >= threshold
+
+    predictions = [settled_prediction(probability, ids_labels=ids_labels) + (None, None) if is_settled else None
+                   for probability, is_settled in zip(probabilities, settled)]
+
+    uncertain = np.flatnonzero(~settled)
+    if len(uncertain):
+        for index, prediction in zip(uncertain, predict([texts[index] for index in uncertain])):
+            predictions[index] = prediction
+
+    return predictions, settled
+
+
+def cascade_report(prefilter, model_pickle_path, texts, thresholds, ids_labels=IDS_LABELS,
+                   max_batch_tokens=MAX_BATCH_TOKENS):
+    r"""
+    Compare cascade at each threshold against transformer-only scoring of the same documents.
+
+    Returns:
+
+        :obj:`dict`: Transformer-only docs/sec, and for each threshold the share of documents settled by the first
+        stage, recall of each fintech label and of all fintech labels together (share of documents the
+        transformer labels fintech that are not settled as `non-fintech`), label agreement, docs/sec and speedup.
+    """
+
+    def predict(batch_texts):
+        return inference_batch(model_pickle_path=model_pickle_path, texts=batch_texts, ids_labels=ids_labels,
+                               max_batch_tokens=max_batch_tokens)
+
+    # Load model before timing.
+    predict(texts[:1])
+
+    start_time = time.time()
+    reference_labels = np.array([label for label, _, _, _ in predict(texts)])
+    transformer_seconds = time.time() - start_time
+    fintech = reference_labels != NON_FINTECH_LABEL
+
+    report = {'n_documents': len(texts),
+              'transformer_docs_per_sec': round(len(texts) / transformer_seconds, 2),
+              'transformer_non_fintech_share': round(100 * float(np.mean(~fintech)), 2),
+              'thresholds': []}
+
+    for threshold in thresholds:
+        start_time = time.time()
+        predictions, settled = cascade_batch(prefilter=prefilter, texts=texts, predict=predict,
+                                             ids_labels=ids_labels, threshold=threshold)
+        cascade_seconds = time.time() - start_time
+        labels = np.array([label for label, _, _, _ in predictions])
+
+        labels_recall = {label: round(100 * float(np.mean(~settled[reference_labels == label])), 2)
+                         for label in ids_labels.values() if label != NON_FINTECH_LABEL and
+                         (reference_labels == label).any()}
+        report['thresholds'].append({
+            'threshold': threshold,
+            'settled_share': round(100 * float(np.mean(settled)), 2),
+            'fintech_recall': round(100 * float(np.mean(~settled[fintech])), 2) if fintech.any() else 100.0,
+            'labels_recall': labels_recall,
+            'label_agreement': round(100 * float(np.mean(labels == reference_labels)), 2),
+            'docs_per_sec': round(len(texts) / cascade_seconds, 2),
+            'speedup': round(transformer_seconds / cascade_seconds, 2)})
+
+    return report
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Distill a first stage from a model and report cascade recall '
+                                                 'and throughput.')
+
+    # Corpus
+    parser.add_argument('--path_corpus', help='Path of JSONL, CSV or Parquet corpus file.', type=str, required=True)
+    parser.add_argument('--corpus_format', help='Corpus format. Found from file extension if not used.',
+                        type=str, default=None, choices=sorted(set(CORPUS_FORMATS.values())))
+    parser.add_argument('--text_field', help='Name of field with text.', type=str, default='abstract')
+    parser.add_argument('--n_train', help='Number of documents used to train first stage.', type=int,
+                        default=20000)
+    parser.add_argument('--n_eval', help='Number of next documents used in report.', type=int, default=2000)
+
+    # Teacher model
+    parser.add_argument('--model', help='Section name or display name of model in config file.',
+                        type=str, default='distilroberta-base')
+    parser.add_argument('--path_config_file', help='Path of config file containing all pickled models.',
+                        type=str, default=CONFIG_FILE)
+
+    # First stage
+    parser.add_argument('--n_features', help='Number of hashed features. Power of 2.', type=int, default=2 ** 18)
+    parser.add_argument('--epochs', help='Training passes over documents.', type=int, default=10)
+    parser.add_argument('--path_prefilter', help='File where first stage is saved.', type=str,
+                        default='prefilter.npz')
+    parser.add_argument('--thresholds', help='Thresholds compared in report.', type=float, nargs='+',
+                        default=[0.9, 0.95, PREFILTER_THRESHOLD, 0.99])
+    parser.add_argument('--path_output', help='JSON file where report is written.', type=str, default=None)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    # Create config parser.
+    config = configparser.ConfigParser()
+
+    # Read config file from path.
+    config.read(args.path_config_file)
+
+    teacher_path = model_pickle_path_from_config(config, args.model)
+    corpus_texts = [record.get(args.text_field) or '' for record in
+                    itertools.islice(read_corpus(path_corpus=args.path_corpus, corpus_format=args.corpus_format),
+                                     args.n_train + args.n_eval)]
+    train_texts, eval_texts = corpus_texts[:args.n_train], corpus_texts[args.n_train:]
+
+    # Teacher targets are the model's own `non-fintech` probabilities.
+    print(f'Labeling {len(train_texts)} documents with `{args.model}`...')
+    sys.stdout.flush()
+    teacher_predictions = inference_batch(model_pickle_path=teacher_path, texts=train_texts, ids_labels=IDS_LABELS,
+                                          max_batch_tokens=MAX_BATCH_TOKENS)
+    teacher_targets = [float(labels_percents[NON_FINTECH_LABEL]) / 100
+                       for _, labels_percents, _, _ in teacher_predictions]
+
+    start = time.time()
+    first_stage = HashedNgramModel(n_features=args.n_features).fit(texts=train_texts, targets=teacher_targets,
+                                                                    epochs=args.epochs)
+    first_stage.save(args.path_prefilter)
+    print(f'Trained first stage in {time.time() - start:.2f} seconds. Saved to `{args.path_prefilter}`.')
+    sys.stdout.flush()
+
+    if eval_texts:
+        cascade = cascade_report(prefilter=first_stage, model_pickle_path=teacher_path, texts=eval_texts,
+                                 thresholds=args.thresholds)
+        print(f'Transformer only: {cascade["transformer_docs_per_sec"]} docs/sec | '
+              f'{cascade["transformer_non_fintech_share"]}% non-fintech')
+        for row in cascade['thresholds']:
+            print(f'threshold {row["threshold"]}: settled {row["settled_share"]}% | fintech recall '
+                  f'{row["fintech_recall"]}% | agreement {row["label_agreement"]}% | {row["docs_per_sec"]} docs/sec '
+                  f'({row["speedup"]}x)')
+        sys.stdout.flush()
+
+        if args.path_output is not None:
+            with open(args.path_output, 'w') as output_file:
+                json.dump(cascade, output_file, indent=2)
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
@@ -0,0 +1,456 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compact columnar store of predictions, attentions and tokens of many documents.
+
+Each shard is a folder of NumPy arrays, one for each column:
+    `labels`: label of each document as uint8 code in the labels dictionary of the store.
+    `probabilities`: float16 probabilities of shape [number of documents, number of labels].
+    `ids`: UTF-8 bytes of JSON encoded ids and `ids_offsets` with start of each id.
+    `token_starts`: start of each document in the token columns.
+    `attentions`: float16 attention of each token of all documents. NaN when the model returned no attentions.
+    `tokens`: UTF-8 bytes of all tokens and `tokens_offsets` with start of each token.
+
+Arrays are memory mapped when read, so a query only reads the pages it needs and one document is loaded with a
+few slices of its shard.
+"""
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from classify_corpus import read_corpus
+from settings import IDS_LABELS
+
+# Name of file with labels dictionary and shards of store.
+STORE_META = 'meta.json'
+
+# Number of documents in each shard.
+STORE_SHARD_SIZE = 65536
+
+
+def shard_folder_name(shard_index):
+    r"""
+    Name of folder of a shard inside the store folder.
+    """
+
+    return f'shard-{shard_index:05d}'
+
+
+def ragged_strings(strings):
+    r"""
+    Encode strings as one UTF-8 bytes array and start of each string, with total length at the end.
+
+    Returns:
+
+        :obj:`tuple`: Bytes as uint8 array and int64 offsets.
+    """
+
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in encoded], out=offsets[1:])
+
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def decode_strings(data, offsets, start, end):
+    r"""
+    Decode strings from `start` to `end` of a ragged strings column.
+    """
+
+    raw = data[offsets[start]:offsets[end]].tobytes()
+    base = offsets[start]
+
+    return [raw[offsets[index] - base:offsets[index + 1] - base].decode('utf-8') for index in range(start, end)]
+
+
+class ResultStoreWriter(object):
+    r"""
+    Write predictions in shards of a result store.
+
+    A shard is written when it has `shard_size` documents and the store metadata is updated after each shard, so
+    a store is readable while it is written.
+
+    Arguments:
+
+        path_store (:obj:`str`):
+            Folder of store. Created if it doesn't exist. Shards of an existing store are replaced.
+
+        ids_labels (:obj:`dict`, `optional`, defaults to :obj:`settings.IDS_LABELS`):
+            Dictionary of label id and label name. Labels are stored as their position in it.
+
+        shard_size (:obj:`int`, `optional`, defaults to :obj:`STORE_SHARD_SIZE`):
+            Number of documents in each shard.
+    """
+
+    def __init__(self, path_store, ids_labels=IDS_LABELS, shard_size=STORE_SHARD_SIZE):
+        self.path_store = path_store
+        self.labels = list(ids_labels.values())
+        self.shard_size = shard_size
+        self.shards = []
+
+        # Label name -> code.
+        self._codes = {label: code for code, label in enumerate(self.labels)}
+        if len(self.labels) > 256:
+            raise ValueError('Labels are stored as uint8, so at most 256 labels can be used!')
+
+        self._clear()
+        os.makedirs(path_store, exist_ok=True)
+
+    def _clear(self):
+        self._ids = []
+        self._labels = []
+        self._probabilities = []
+        self._n_tokens = []
+        self._attentions = []
+        self._tokens = []
+
+        return
+
+    def add(self, record_id, prediction):
+        r"""
+        Add prediction of a document.
+
+        Arguments:
+
+            record_id (:obj:`object`):
+                Id of document. Any value that can be encoded in JSON.
+
+            prediction (:obj:`tuple`):
+                Label, labels percentages, attentions and tokens as returned by `inference_transformer`. Attentions
+                and tokens can be None.
+        """
+
+        label, labels_percents, attentions, tokens = prediction
+
+        if label not in self._codes:
+            raise ValueError(f'Unknown label `{label}`! Labels of store are: {self.labels}')
+
+        self._ids.append(json.dumps(record_id))
+        self._labels.append(self._codes[label])
+        self._probabilities.append([float(labels_percents[lab]) / 100 for lab in self.labels])
+
+        tokens = tokens or []
+        self._n_tokens.append(len(tokens))
+        self._tokens.extend(tokens)
+        if attentions is None:
+            self._attentions.append(np.full(len(tokens), np.nan, dtype=np.float16))
+        else:
+            # Models without attentions give None values.
+            self._attentions.append(np.array(attentions, dtype=np.float64).astype(np.float16))
+
+        if len(self._ids) >= self.shard_size:
+            self.flush()
+
+        return
+
+    def flush(self):
+        r"""
+        Write documents added since last shard as a new shard.
+        """
+
+        if not self._ids:
+            return
+
+        folder = os.path.join(self.path_store, shard_folder_name(len(self.shards)))
+        os.makedirs(folder, exist_ok=True)
+
+        ids, ids_offsets = ragged_strings(self._ids)
+        tokens, tokens_offsets = ragged_strings(self._tokens)
+        token_starts = np.zeros(len(self._n_tokens) + 1, dtype=np.int64)
+        np.cumsum(self._n_tokens, out=token_starts[1:])
+
+        columns = {'labels': np.array(self._labels, dtype=np.uint8),
+                   'probabilities': np.array(self._probabilities, dtype=np.float16).reshape(-1, len(self.labels)),
+                   'ids': ids,
+                   'ids_offsets': ids_offsets,
+                   'token_starts': token_starts,
+                   'attentions': np.concatenate(self._attentions) if self._attentions else
+                   np.zeros(0, dtype=np.float16),
+                   'tokens': tokens,
+                   'tokens_offsets': tokens_offsets}
+
+        for name, values in columns.items():
+            np.save(os.path.join(folder, f'{name}.npy'), values)
+
+        self.shards.append({'name': shard_folder_name(len(self.shards)), 'documents': len(self._ids)})
+        self._clear()
+        self._write_meta()
+
+        return
+
+    def close(self):
+        r"""
+        Write last shard.
+
+        Returns:
+
+            :obj:`int`: Number of documents in store.
+        """
+
+        self.flush()
+        # Store without documents still gets its metadata.
+        self._write_meta()
+
+        return sum(shard['documents'] for shard in self.shards)
+
+    def _write_meta(self):
+        path_meta = os.path.join(self.path_store, STORE_META)
+
+        with open(f'{path_meta}.tmp', 'w') as meta_file:
+            json.dump({'labels': self.labels, 'shards': self.shards}, meta_file, indent=2)
+
+        # Replaced at once so readers never see it half written.
+        os.replace(f'{path_meta}.tmp', path_meta)
+
+        return
+
+
+class ResultStore(object):
+    r"""
+    Read and query a result store written by `ResultStoreWriter`.
+
+    Documents are numbered in the order they were added. Columns of a shard are memory mapped the first time
+    the shard is used.
+
+    Arguments:
+
+        path_store (:obj:`str`):
+            Folder of store.
+    """
+
+    def __init__(self, path_store):
+        self.path_store = path_store
+
+        with open(os.path.join(path_store, STORE_META), 'r') as meta_file:
+            meta = json.load(meta_file)
+
+        self.labels = meta['labels']
+        self.shards = meta['shards']
+        # First document number of each shard, with total number of documents at the end.
+        self.shard_starts = np.concatenate([[0], np.cumsum([shard['documents'] for shard in self.shards])])
+
+        # Shard index -> dictionary of memory mapped columns.
+        self._columns = {}
+        # Id -> document number. Built the first time an id is looked up.
+        self._ids_index = None
+
+    def __len__(self):
+        return int(self.shard_starts[-1])
+
+    def shard_columns(self, shard_index):
+        r"""
+        Memory mapped columns of a shard.
+        """
+
+        if shard_index not in self._columns:
+            folder = os.path.join(self.path_store, self.shards[shard_index]['name'])
+            self._columns[shard_index] = {name[:-len('.npy')]: np.load(os.path.join(folder, name), mmap_mode='r')
+                                          for name in os.listdir(folder) if name.endswith('.npy')}
+
+        return self._columns[shard_index]
+
+    def locate(self, index):
+        r"""
+        Shard index and row in shard of a document number.
+        """
+
+        if not 0 <= index < len(self):
+            raise IndexError(f'Document {index} is not in store of {len(self)} documents!')
+
+        shard_index = int(np.searchsorted(self.shard_starts, index, side='right')) - 1
+
+        return shard_index, int(index - self.shard_starts[shard_index])
+
+    def query(self, labels=None, min_confidence=None, max_confidence=None):
+        r"""
+        Document numbers with a label and confidence in a range.
+
+        Arguments:
+
+            labels (:obj:`list`, `optional`):
+                Label names kept. All labels if not used.
+
+            min_confidence (:obj:`float`, `optional`):
+                Lowest percentage 0-100 of predicted label kept.
+
+            max_confidence (:obj:`float`, `optional`):
+                Highest percentage 0-100 of predicted label kept.
+
+            Probabilities are stored as float16, so 90.00% is read back as 89.99%. Bounds are compared with half
+            a float16 step of tolerance: a document is kept if its percentage before storing could be in range.
+
+        Returns:
+
+            :obj:`np.ndarray`: Sorted document numbers.
+        """
+
+        codes = None if labels is None else np.array([self.labels.index(label) for label in labels], dtype=np.uint8)
+        matches = []
+
+        for shard_index in range(len(self.shards)):
+            columns = self.shard_columns(shard_index)
+            shard_labels = np.asarray(columns['labels'])
+            keep = np.ones(len(shard_labels), dtype=bool) if codes is None else np.isin(shard_labels, codes)
+
+            if min_confidence is not None or max_confidence is not None:
+                # Probability of predicted label of each document.
+                probabilities = np.asarray(columns['probabilities'])[np.arange(len(shard_labels)), shard_labels]
+                confidence = probabilities.astype(np.float32) * 100
+                # Any percentage within half a float16 step was stored as same value.
+                tolerance = np.spacing(probabilities).astype(np.float32) * 100 / 2
+                if min_confidence is not None:
+                    keep &= confidence + tolerance >= min_confidence
+                if max_confidence is not None:
+                    keep &= confidence - tolerance <= max_confidence
+
+            matches.append(np.flatnonzero(keep) + self.shard_starts[shard_index])
+
+        return np.concatenate(matches).astype(np.int64) if matches else np.zeros(0, dtype=np.int64)
+
+    def document(self, index):
+        r"""
+        Id and prediction of a document.
+
+        Returns:
+
+            :obj:`tuple`: Id, label, labels percentages, attentions and tokens. Percentages are rounded to 2
+            decimals from float16. Attentions and tokens are None if they were not stored.
+        """
+
+        shard_index, row = self.locate(index)
+        columns = self.shard_columns(shard_index)
+
+        record_id = json.loads(decode_strings(columns['ids'], columns['ids_offsets'], row, row + 1)[0])
+        label = self.labels[int(columns['labels'][row])]
+        percents = np.around(np.asarray(columns['probabilities'][row], dtype=np.float32) * 100, 2)
+        attentions, tokens = self.highlight(index)
+
+        return record_id, label, dict(zip(self.labels, percents)), attentions, tokens
+
+    def highlight(self, index):
+        r"""
+        Attentions and tokens of a document, as used by `graphics.html_highlight_words`.
+
+        Returns:
+
+            :obj:`tuple`: Float32 attentions and list of tokens, or None and None if document has no tokens.
+        """
+
+        shard_index, row = self.locate(index)
+        columns = self.shard_columns(shard_index)
+        start, end = int(columns['token_starts'][row]), int(columns['token_starts'][row + 1])
+
+        if start == end:
+            return None, None
+
+        attentions = np.asarray(columns['attentions'][start:end], dtype=np.float32)
+        tokens = decode_strings(columns['tokens'], columns['tokens_offsets'], start, end)
+
+        return attentions, tokens
+
+    def index_of(self, record_id):
+        r"""
+        Document number of an id. All ids are read the first time this is used.
+        """
+
+        if self._ids_index is None:
+            self._ids_index = {}
+            for shard_index in range(len(self.shards)):
+                columns = self.shard_columns(shard_index)
+                ids = decode_strings(columns['ids'], columns['ids_offsets'], 0, len(columns['labels']))
+                self._ids_index.update((value, self.shard_starts[shard_index] + row) for row, value in
+                                       enumerate(ids))
+
+        return int(self._ids_index[json.dumps(record_id)])
+
+    def counts(self):
+        r"""
+        Number of documents of each label.
+        """
+
+        counts = np.zeros(len(self.labels), dtype=np.int64)
+        for shard_index in range(len(self.shards)):
+            counts += np.bincount(np.asarray(self.shard_columns(shard_index)['labels']), minlength=len(self.labels))
+
+        return dict(zip(self.labels, counts.tolist()))
+
+
+def store_predictions(path_predictions, path_store, ids_labels=IDS_LABELS, shard_size=STORE_SHARD_SIZE):
+    r"""
+    Write JSONL predictions of `classify_corpus.py` in a result store.
+
+    Returns:
+
+        :obj:`int`: Number of documents in store.
+    """
+
+    writer = ResultStoreWriter(path_store=path_store, ids_labels=ids_labels, shard_size=shard_size)
+
+    for record in read_corpus(path_corpus=path_predictions, corpus_format='jsonl'):
+        writer.add(record_id=record['id'],
+                   prediction=(record['label'], record['labels_percents'], record.get('attentions'),
+                               record.get('tokens')))
+
+    return writer.close()
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Write predictions in a result store and query it.')
+
+    # Store
+    parser.add_argument('--path_store', help='Folder of result store.', type=str, required=True)
+    parser.add_argument('--path_predictions', help='Path of JSONL predictions written by `classify_corpus.py` '
+                                                   'to add to store. Only queries the store if not used.',
+                        type=str, default=None)
+    parser.add_argument('--shard_size', help='Number of documents in each shard.', type=int,
+                        default=STORE_SHARD_SIZE)
+
+    # Query
+    parser.add_argument('--labels', help='Labels of documents listed.', type=str, nargs='+', default=None)
+    parser.add_argument('--min_confidence', help='Lowest percentage of predicted label.', type=float, default=None)
+    parser.add_argument('--max_confidence', help='Highest percentage of predicted label.', type=float,
+                        default=None)
+    parser.add_argument('--n_documents', help='Number of matching documents printed.', type=int, default=10)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.path_predictions is not None:
+        n_stored = store_predictions(path_predictions=args.path_predictions, path_store=args.path_store,
+                                     shard_size=args.shard_size)
+        size = sum(os.path.getsize(os.path.join(folder, name)) for folder, _, names in os.walk(args.path_store)
+                   for name in names)
+        print(f'Stored {n_stored} documents in `{args.path_store}` | {size / 2 ** 20:.2f} MB, '
+              f'{os.path.getsize(args.path_predictions) / 2 ** 20:.2f} MB as JSONL')
+        sys.stdout.flush()
+
+    store = ResultStore(args.path_store)
+    print(f'{len(store)} documents: {store.counts()}')
+
+    matching = store.query(labels=args.labels, min_confidence=args.min_confidence,
+                           max_confidence=args.max_confidence)
+    print(f'{len(matching)} documents match.')
+    for document_index in matching[:args.n_documents]:
+        document_id, document_label, document_percents, _, document_tokens = store.document(int(document_index))
+        print(f'  {document_id}: {document_label} {document_percents[document_label]:.2f}% | '
+              f'{0 if document_tokens is None else len(document_tokens)} tokens')
+    sys.stdout.flush()
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
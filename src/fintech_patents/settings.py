@@ -31,3 +31,23 @@ SAMPLE_ABSTRACT = 'sample_patent_abstract.txt'
 
 # Default config file.
 CONFIG_FILE = 'config.ini'
+
+# Memory in MB that all models loaded in one process can use together.
+MODELS_MEMORY_BUDGET_MB = 4096
+
+# Maximum number of tokens, padding included, in one batched forward pass.
+MAX_BATCH_TOKENS = 8192
+
+# Maximum number of predictions kept in memory by the prediction cache.
+PREDICTION_CACHE_MAX_ENTRIES = 10000
+
+# Defaults of inference server micro-batching.
+SERVER_MAX_BATCH_SIZE = 32
+SERVER_MAX_WAIT_MS = 10
+SERVER_MAX_QUEUE_SIZE = 1024
+
+# Label settled by the cascade first stage.
+NON_FINTECH_LABEL = 'non-fintech'
+
+# Documents the first stage scores `non-fintech` with at least this probability skip the transformer.
+PREFILTER_THRESHOLD = 0.98
@@ -0,0 +1,156 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measure cold start: how long importing each module takes and which heavy packages it loads."""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+import numpy as np
+
+# Packages that should only be imported when they are needed.
+HEAVY_PACKAGES = ['torch', 'transformers', 'matplotlib', 'pandas', 'streamlit', 'onnxruntime', 'pyarrow']
+
+# Modules of the app and scripts measured by default.
+STARTUP_MODULES = ['web_app', 'inference_modeling', 'graphics', 'pickle_models', 'downloads_models',
+                   'classify_corpus', 'inference_server']
+
+# Code run in a new interpreter for each measure.
+_IMPORT_CODE = '''
+import sys, json, time
+start_time = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start_time
+print(json.dumps({{'seconds': seconds, 'loaded': [name for name in {heavy} if name in sys.modules]}}))
+'''
+
+
+def parse_importtime(stderr):
+    r"""
+    Parse output of `python -X importtime`.
+
+    Returns:
+
+        :obj:`list`: Tuples of module name, nesting level, self microseconds and cumulative microseconds.
+    """
+
+    imports = []
+
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        fields = line.split(':', 1)[1].split('|')
+        self_us, cumulative_us, raw_name = int(fields[0]), int(fields[1]), fields[2]
+        # Nested imports are indented with 2 spaces for each level.
+        level = (len(raw_name) - len(raw_name.lstrip()) - 1) // 2
+        imports.append((raw_name.strip(), level, self_us, cumulative_us))
+
+    return imports
+
+
+def import_profile(module, n_runs=3, path=None):
+    r"""
+    Import a module in new interpreters and time it.
+
+    Arguments:
+
+        module (:obj:`str`):
+            Name of module.
+
+        n_runs (:obj:`int`, `optional`, defaults to :obj:`3`):
+            Number of new interpreters. Median time is reported.
+
+        path (:obj:`str`, `optional`):
+            Folder the module is imported from. Folder of this file if not used.
+
+    Returns:
+
+        :obj:`dict`: Median seconds, heavy packages loaded with their import milliseconds, and imports done by the
+        module sorted by cumulative milliseconds, from last run.
+    """
+
+    path = path or os.path.dirname(os.path.abspath(__file__))
+    code = _IMPORT_CODE.format(module=module, heavy=HEAVY_PACKAGES)
+    timings = []
+
+    for _ in range(n_runs):
+        process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=path,
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        if process.returncode != 0:
+            return {'module': module, 'error': process.stderr.strip().splitlines()[-1]}
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        timings.append(result['seconds'])
+
+    imports = parse_importtime(process.stderr)
+    # Imports done by the module itself.
+    direct_imports = [(name, cumulative_us) for name, level, _, cumulative_us in imports if level == 1]
+
+    return {'module': module,
+            'seconds': round(float(np.median(timings)), 4),
+            'heavy_packages_loaded': result['loaded'],
+            'heavy_packages_ms': {name: round(cumulative_us / 1000, 2) for name, _, _, cumulative_us in imports
+                                  if name in HEAVY_PACKAGES},
+            'slowest_imports': [{'name': name, 'ms': round(cumulative_us / 1000, 2)} for name, cumulative_us in
+                                sorted(direct_imports, key=lambda item: -item[1])[:10]]}
+
+
+# Main run of the script.
+if __name__ == '__main__':
+
+    # Parse any input arguments
+    parser = argparse.ArgumentParser(description='Profile import time of modules.')
+
+    # Modules
+    parser.add_argument('--modules', help='Modules imported.', type=str, nargs='+', default=STARTUP_MODULES)
+    parser.add_argument('--n_runs', help='Number of new interpreters for each module.', type=int, default=3)
+
+    # Results
+    parser.add_argument('--path_output', help='JSON file where results are written.', type=str,
+                        default='startup_profile.json')
+    parser.add_argument('--path_baseline', help='JSON file of earlier results to compare against.', type=str,
+                        default=None)
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.path_baseline is not None:
+        with open(args.path_baseline, 'r') as baseline_file:
+            baseline = {profile['module']: profile for profile in json.load(baseline_file)}
+
+    profiles = []
+    for module_name in args.modules:
+        profile = import_profile(module=module_name, n_runs=args.n_runs)
+        profiles.append(profile)
+
+        if 'error' in profile:
+            print(f'{module_name}: could not be imported: {profile["error"]}')
+            continue
+
+        compare = ''
+        if 'seconds' in baseline.get(module_name, {}):
+            compare = f' (baseline {baseline[module_name]["seconds"]:.3f} seconds)'
+        print(f'{module_name}: {profile["seconds"]:.3f} seconds{compare} | heavy packages loaded: '
+              f'{profile["heavy_packages_loaded"]}')
+        for slow_import in profile['slowest_imports'][:5]:
+            print(f'    {slow_import["name"]}: {slow_import["ms"]} ms')
+        sys.stdout.flush()
+
+    with open(args.path_output, 'w') as output_file:
+        json.dump(profiles, output_file, indent=2)
+
+    print(f'\nFinished running `{__file__}`!')
+    sys.stdout.flush()
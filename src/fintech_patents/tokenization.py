@@ -0,0 +1,97 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Batched tokenization with character offsets, used by single document and bulk predictions."""
+
+from metrics import timer
+
+
+def is_fast(tokenizer):
+    r"""
+    True if tokenizer is a Rust tokenizer that can return character offsets of tokens.
+    """
+
+    return getattr(tokenizer, 'is_fast', False)
+
+
+def encode_batch(tokenizer, texts, add_special_tokens=True, truncation=True):
+    r"""
+    Tokenize all texts in one call without padding.
+
+    Fast tokenizers encode the whole batch in parallel in Rust and also return the character offsets of each
+    token. Slow tokenizers don't have offsets.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model.
+
+        texts (:obj:`list`):
+            Text of each document.
+
+        add_special_tokens (:obj:`bool`, `optional`, defaults to :obj:`True`):
+            Add special tokens of model.
+
+        truncation (:obj:`bool`, `optional`, defaults to :obj:`True`):
+            Truncate documents longer than model maximum length.
+
+    Returns:
+
+        :obj:`tuple`: Dictionary of model inputs as lists, and list of offsets of each document or None if
+        tokenizer is not fast.
+    """
+
+    with timer('tokenize'):
+        encodings = tokenizer(list(texts), add_special_tokens=add_special_tokens, truncation=truncation,
+                              padding=False, return_offsets_mapping=is_fast(tokenizer), verbose=False)
+
+    # Offsets are not model inputs.
+    offsets = encodings.pop('offset_mapping', None)
+
+    return {key: values for key, values in encodings.items()}, offsets
+
+
+def display_tokens(tokenizer, text, input_ids, offsets=None):
+    r"""
+    Tokens as shown in highlight.
+
+    With offsets each token is the exact piece of original text it comes from, so no token is decoded. Special
+    tokens have empty offsets and are shown with their name, like `[CLS]`. Without offsets each token is decoded
+    on its own.
+
+    Arguments:
+
+        tokenizer (:obj:`transformers.PreTrainedTokenizer`):
+            Tokenizer of model.
+
+        text (:obj:`str`):
+            Original text of document.
+
+        input_ids (:obj:`list`):
+            Token ids of document.
+
+        offsets (:obj:`list`, `optional`):
+            Tuples of start and end character of each token from `encode_batch`.
+
+    Returns:
+
+        :obj:`list`: Token strings, one for each token id.
+    """
+
+    if offsets is None:
+        return [tokenizer.decode([token_id]) for token_id in input_ids]
+
+    names = tokenizer.convert_ids_to_tokens(list(input_ids))
+
+    return [text[start:end] if end > start else name for name, (start, end) in zip(names, offsets)]
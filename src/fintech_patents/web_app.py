@@ -19,15 +19,23 @@ import io
 import argparse
 import configparser
 import streamlit as st
-from pickle_models import pickle_pytorch_models
-from downloads_models import download_from_config
 from inference_modeling import (inference_transformer,
+                                inference_long_document,
                                 )
-from graphics import (html_highlight_text,
+from model_registry import (MODEL_REGISTRY,
+                            model_path_from_section,
+                            warm_up_from_config,
+                            )
+from prediction_cache import PREDICTION_CACHE
+from metrics import record_rss, trace
+from embedding_index import get_embedding_index, similar_patents
+from ensemble import ENSEMBLE_METHODS, ensemble_transformer, models_from_config
+from graphics import (html_highlight_words,
                       plot_labels_confidence,
+                      svg_labels_confidence,
                       )
 from settings import (CONFIG_FILE, IDS_LABELS, LABELS_COLORS,
-                      SAMPLE_ABSTRACT,
+                      SAMPLE_ABSTRACT, MODELS_MEMORY_BUDGET_MB,
                       )
 import psutil
 import sys
@@ -47,24 +55,19 @@ def app_header():
     # st.write('More details go here...')
 
     # Check memory usage
-    # st.write('/ncheck resouces')
-    # st.write('python verison')
-    # st.write(sys.version)
-    # st.write('virtual_memory')
-    # st.write(psutil.virtual_memory())
-    # st.write('disk_partitions')
-    # st.write(psutil.disk_partitions())
-    # st.write('disk_usage')
-    # st.write(psutil.disk_usage('/'))
-    # st.write('end resouces/n')
+    st.sidebar.markdown(f'Memory used: **{round(record_rss() / 1024 / 1024, 2)} MB** of '
+                        f'{round(psutil.virtual_memory().total / 1024 / 1024 / 1024, 2)} GB')
 
     return
 
 
-def app_modeling(config_file):
+def app_modeling(config_file, show_trace=False, embedding_index=None, matplotlib_chart=False):
     r"""
     This is where the modeling of the app happens.
 
+    With `show_trace` the time of each stage of the prediction is shown under it. With an
+    `embedding_index.EmbeddingIndex` the most similar patents are shown too. Confidence chart is drawn as SVG
+    unless `matplotlib_chart` is used.
     """
 
     models_display_names = [config[sec]['display_name'] for sec in config_file.sections()]
@@ -73,7 +76,7 @@ def app_modeling(config_file):
     model_description = [config_file[sec]['description'] for sec in config_file.sections() if
                          config_file[sec]['display_name'] == model_selected][0]
 
-    model_tokenizer_pickle_path = [config_file[sec]['model_tokenizer_pickle_path'] for sec in config_file.sections() if
+    model_tokenizer_pickle_path = [model_path_from_section(config_file, sec) for sec in config_file.sections() if
                                    config_file[sec]['display_name'] == model_selected][0]
 
     st.markdown(f'Current Model Selected: **{model_selected}**')
@@ -92,24 +95,65 @@ def app_modeling(config_file):
     intensity = st.slider(label='Intensity of text color highlight in predictions:',
                           min_value=1, max_value=100, value=5)
 
+    st.markdown('### Ensemble')
+    use_ensemble = st.checkbox(label='Predict with all models at the same time and combine them.', value=False)
+    ensemble_method = st.selectbox('Combine models predictions with', ENSEMBLE_METHODS) if use_ensemble else None
+
+    st.markdown('### Long text')
+    long_text = st.checkbox(label='Score all text in overlapping windows instead of truncating it.',
+                            value=False) if not use_ensemble else False
+    pooling = st.selectbox('Combine windows predictions with', ['mean', 'max', 'attention']) if long_text else None
+
+    models_predictions = None
+
     if st.button('Get Prediction!'):
-        with st.spinner('Working some magic...'):
-            label, labels_percents, attentions, tokens = inference_transformer(
-                model_pickle_path=model_tokenizer_pickle_path,
-                text_input=user_input, ids_labels=IDS_LABELS)
-            fig = plot_labels_confidence(labels_percentages=labels_percents, labels_coloring=LABELS_COLORS)
-            html_text = html_highlight_text(weights=attentions, tokens=tokens, color=LABELS_COLORS[label],
-                                            intensity=intensity)
+        with st.spinner('Working some magic...'), trace() as spans:
+            if use_ensemble:
+                ensemble_models, ensemble_weights = models_from_config(config_file=config_file)
+                label, labels_percents, attentions, tokens, models_predictions = ensemble_transformer(
+                    models=ensemble_models, text_input=user_input, ids_labels=IDS_LABELS, weights=ensemble_weights,
+                    method=ensemble_method, cache=PREDICTION_CACHE)
+            elif long_text:
+                label, labels_percents, attentions, tokens = inference_long_document(
+                    model_pickle_path=model_tokenizer_pickle_path,
+                    text_input=user_input, ids_labels=IDS_LABELS, pooling=pooling)
+            else:
+                label, labels_percents, attentions, tokens = inference_transformer(
+                    model_pickle_path=model_tokenizer_pickle_path,
+                    text_input=user_input, ids_labels=IDS_LABELS, cache=PREDICTION_CACHE)
+            if matplotlib_chart:
+                fig = plot_labels_confidence(labels_percentages=labels_percents, labels_coloring=LABELS_COLORS)
+            else:
+                fig = svg_labels_confidence(labels_percentages=labels_percents, labels_coloring=LABELS_COLORS)
+            html_text = html_highlight_words(weights=attentions, tokens=tokens, text=user_input,
+                                             color=LABELS_COLORS[label], intensity=intensity)
 
         st.markdown(f'### **{label}**')
 
         st.markdown('### Confidence:')
 
-        st.pyplot(fig)
+        if matplotlib_chart:
+            st.pyplot(fig)
+        else:
+            st.markdown(fig, unsafe_allow_html=True)
+
+        if models_predictions is not None:
+            st.markdown('### Each model:')
+            st.table([dict(model=name, label=model_label, **{lab: float(percent) for lab, percent in
+                                                             model_percents.items()})
+                      for name, (model_label, model_percents, _, _) in models_predictions.items()])
 
         st.markdown('### **Text with attention color:**')
         st.markdown(html_text, unsafe_allow_html=True)
 
+        if embedding_index is not None:
+            st.markdown('### Similar patents:')
+            st.table(similar_patents(index=embedding_index, text=user_input, k=5))
+
+        if show_trace:
+            st.markdown('### Stages:')
+            st.table([{'stage': stage, 'milliseconds': milliseconds} for stage, milliseconds in spans])
+
         # Try to free up any memory.
         try:
             # Delete previously created object.
@@ -128,6 +172,10 @@ def preconfigure_app(arguments):
     Run preconfigure process for first time app run.
     """
 
+    # Only needed on first run. Importing them loads transformers.
+    from pickle_models import pickle_pytorch_models
+    from downloads_models import download_from_config
+
     # Create config parser.
     config_file = configparser.ConfigParser()
 
@@ -212,9 +260,38 @@ if __name__ == '__main__':
     parser.add_argument('--model_tokenizer_pickle_path', help='Path where all pretrained models are stored pickled.',
                         type=str, default='pickled_models')
 
+    # Memory budget of models kept loaded in the app process.
+    parser.add_argument('--models_memory_budget_mb', help='Memory in MB all loaded models can use together.',
+                        type=int, default=MODELS_MEMORY_BUDGET_MB)
+
+    # Path of predictions cache file
+    parser.add_argument('--path_prediction_cache', help='SQLite file where predictions are cached across restarts.',
+                        type=str, default=None)
+
+    # Load all models when app starts.
+    parser.add_argument('--warm_up', help='Load all models in memory when app starts.', action='store_true')
+
+    # Index of patents embeddings.
+    parser.add_argument('--path_embedding_index', help='Folder of index used to show similar patents.',
+                        type=str, default=None)
+
+    # Show time of each stage.
+    parser.add_argument('--trace', help='Show time of each stage of a prediction.', action='store_true')
+
+    # Draw confidence chart with matplotlib instead of SVG.
+    parser.add_argument('--matplotlib_chart', help='Draw confidence chart with matplotlib (slower).',
+                        action='store_true')
+
     # Parse arguments
     args = parser.parse_args()
 
+    # Set memory budget of models registry.
+    MODEL_REGISTRY.memory_budget = args.models_memory_budget_mb * 1024 * 1024
+
+    # Keep cached predictions on disk.
+    if args.path_prediction_cache is not None:
+        PREDICTION_CACHE.open_disk(args.path_prediction_cache)
+
     # Create config parser.
     config = configparser.ConfigParser()
 
@@ -226,5 +303,13 @@ if __name__ == '__main__':
     # Read configuration file
     config.read(args.path_config_file)
 
+    # Load models before first prediction. Models already loaded are not loaded again on app reruns.
+    if args.warm_up:
+        warm_up_from_config(config_file=config)
+
+    # Index is opened once, not on every app rerun.
+    embedding_index = None if args.path_embedding_index is None else get_embedding_index(args.path_embedding_index)
+
     # Run modeling part of the app.
-    app_modeling(config_file=config)
+    app_modeling(config_file=config, show_trace=args.trace, matplotlib_chart=args.matplotlib_chart,
+                 embedding_index=embedding_index)
@@ -0,0 +1,64 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Attention capture on a small random weights model shared by threads."""
+
+import threading
+import numpy as np
+import pytest
+from attention_extraction import forward_with_attention
+
+torch = pytest.importorskip('torch')
+transformers = pytest.importorskip('transformers')
+
+
+def make_model():
+    torch.manual_seed(0)
+    config = transformers.DistilBertConfig(vocab_size=100, dim=32, n_layers=2, n_heads=2, hidden_dim=64,
+                                           max_position_embeddings=64, num_labels=3)
+    return transformers.DistilBertForSequenceClassification(config).eval()
+
+
+def make_inputs(index):
+    # Each caller has its own length, so attention of another call can't be mistaken for its own.
+    length = 4 + index
+    return {'input_ids': torch.randint(1, 100, (1, length), generator=torch.Generator().manual_seed(index)),
+            'attention_mask': torch.ones(1, length, dtype=torch.long)}
+
+
+def test_threads_sharing_model_get_their_own_attention():
+    model = make_model()
+    n_threads, n_calls = 4, 30
+    inputs = [make_inputs(index) for index in range(n_threads)]
+    expected = [forward_with_attention(model=model, inputs=thread_inputs)[1] for thread_inputs in inputs]
+    wrong = []
+
+    def call(index):
+        for _ in range(n_calls):
+            # Fast path running at the same time must not change captures.
+            forward_with_attention(model=model, inputs=inputs[index], attention_mode='none')
+            _, weights = forward_with_attention(model=model, inputs=inputs[index])
+            if weights is None or weights.shape != expected[index].shape or \
+                    not np.allclose(weights, expected[index], atol=1e-5):
+                wrong.append(index)
+
+    threads = [threading.Thread(target=call, args=(index,)) for index in range(n_threads)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert wrong == []
+    # No hook is left on the model.
+    assert all(not module._forward_hooks for module in model.modules())
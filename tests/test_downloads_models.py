@@ -0,0 +1,168 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Downloads against a local HTTP server standing in for Google Drive."""
+
+import io
+import os
+import hashlib
+import zipfile
+import threading
+import http.server
+import pytest
+from downloads_models import download_file, download_section
+
+
+def make_archive():
+    # Zip with a model folder, large enough to be read in a few chunks.
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        archive.writestr('model/', '')
+        archive.writestr('model/config.json', '{"model_type": "distilbert"}')
+        archive.writestr('model/weights.bin', os.urandom(3 * 1024 * 1024))
+    return buffer.getvalue()
+
+
+ARCHIVE = make_archive()
+ARCHIVE_SHA256 = hashlib.sha256(ARCHIVE).hexdigest()
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # Set by `server` fixture.
+    mode = 'range'
+    ranges = []
+
+    def log_message(self, *args):
+        return
+
+    def do_GET(self):
+        range_header = self.headers.get('Range')
+        self.ranges.append(range_header)
+
+        if self.mode == 'html':
+            # Confirm page that never turns into the file.
+            body = b'<html><a href="?confirm=abc123">Download anyway</a></html>'
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Set-Cookie', 'download_warning_1=abc123')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        start = int(range_header[len('bytes='):-1]) if range_header and self.mode == 'range' else 0
+        if start >= len(ARCHIVE):
+            self.send_response(416)
+            self.send_header('Content-Range', f'bytes */{len(ARCHIVE)}')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = ARCHIVE[start:]
+        self.send_response(206 if start else 200)
+        self.send_header('Content-Type', 'application/zip')
+        if start:
+            self.send_header('Content-Range', f'bytes {start}-{len(ARCHIVE) - 1}/{len(ARCHIVE)}')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    StandInHandler.mode = 'range'
+    StandInHandler.ranges = []
+    httpd = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}/uc?id=model'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_full_download_is_extracted(server, tmp_path):
+    model_path, sha256, skipped = download_section(section='tiny', download_link=server,
+                                                   path_downloaded_models=str(tmp_path), checksum=ARCHIVE_SHA256)
+
+    assert sha256 == ARCHIVE_SHA256 and not skipped
+    assert model_path == os.path.join(str(tmp_path), 'model')
+    assert os.path.isfile(os.path.join(model_path, 'weights.bin'))
+    # Archive is removed once extracted.
+    assert not os.path.exists(os.path.join(str(tmp_path), 'tiny.zip'))
+
+    # Same archive is not downloaded again.
+    assert download_section(section='tiny', download_link=server, path_downloaded_models=str(tmp_path),
+                            checksum=ARCHIVE_SHA256)[2]
+    assert len(StandInHandler.ranges) == 1
+
+
+def test_resume_from_part_file(server, tmp_path):
+    file_name = str(tmp_path / 'tiny.zip')
+    with open(f'{file_name}.part', 'wb') as part_file:
+        part_file.write(ARCHIVE[:1000000])
+
+    assert download_file(url=server, file_name=file_name) == ARCHIVE_SHA256
+    assert StandInHandler.ranges == ['bytes=1000000-']
+    with open(file_name, 'rb') as downloaded:
+        assert downloaded.read() == ARCHIVE
+    assert not os.path.exists(f'{file_name}.part')
+
+
+def test_server_ignoring_range_starts_over(server, tmp_path):
+    StandInHandler.mode = 'ignore_range'
+    file_name = str(tmp_path / 'tiny.zip')
+    # Bytes that are not the start of the archive must not be kept.
+    with open(f'{file_name}.part', 'wb') as part_file:
+        part_file.write(b'x' * 1000)
+
+    assert download_file(url=server, file_name=file_name) == ARCHIVE_SHA256
+    with open(file_name, 'rb') as downloaded:
+        assert downloaded.read() == ARCHIVE
+
+
+def test_complete_part_file_is_finished(server, tmp_path):
+    file_name = str(tmp_path / 'tiny.zip')
+    with open(f'{file_name}.part', 'wb') as part_file:
+        part_file.write(ARCHIVE)
+
+    # Server answers 416 to a range starting at end of file.
+    assert download_file(url=server, file_name=file_name) == ARCHIVE_SHA256
+    assert StandInHandler.ranges == [f'bytes={len(ARCHIVE)}-']
+    assert os.path.isfile(file_name)
+
+
+def test_complete_part_file_is_still_checked(server, tmp_path):
+    with open(str(tmp_path / 'tiny.zip.part'), 'wb') as part_file:
+        part_file.write(b'x' + ARCHIVE[1:])
+
+    with pytest.raises(ValueError, match='Checksum'):
+        download_section(section='tiny', download_link=server, path_downloaded_models=str(tmp_path),
+                         checksum=ARCHIVE_SHA256)
+
+
+def test_checksum_mismatch_removes_archive(server, tmp_path):
+    with pytest.raises(ValueError, match='Checksum'):
+        download_section(section='tiny', download_link=server, path_downloaded_models=str(tmp_path),
+                         checksum='0' * 64)
+
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_confirm_page_is_followed_once(server, tmp_path):
+    StandInHandler.mode = 'html'
+
+    with pytest.raises(ValueError, match='web page'):
+        download_file(url=server, file_name=str(tmp_path / 'tiny.zip'))
+    # First request and one confirm.
+    assert len(StandInHandler.ranges) == 2
@@ -0,0 +1,120 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental classification with the model replaced by a stand-in."""
+
+import json
+import pytest
+import incremental_classify
+from incremental_classify import classify_incremental
+
+
+def write_dump(path, documents):
+    with open(path, 'w', encoding='utf-8') as dump_file:
+        for record_id, abstract in documents:
+            dump_file.write(json.dumps({'id': record_id, 'abstract': abstract}) + '\n')
+    return str(path)
+
+
+def stand_in_classify(classified):
+    def classify_texts(texts, **kwargs):
+        classified.extend(texts)
+        return [('fraud' if 'fraud' in text else 'payments', {'fraud': 50.0, 'payments': 50.0}, None, None)
+                for text in texts], None
+    return classify_texts
+
+
+def run(tmp_path, monkeypatch, documents, classified=None, model_name='model.pickle', **kwargs):
+    monkeypatch.setattr(incremental_classify, 'classify_texts', stand_in_classify([] if classified is None
+                                                                                  else classified))
+    model = tmp_path / model_name
+    if not model.exists():
+        model.write_bytes(b'weights')
+    return classify_incremental(model_pickle_path=str(model), path_corpus=write_dump(tmp_path / 'dump.jsonl',
+                                                                                     documents),
+                                path_manifest=str(tmp_path / 'manifest.sqlite'),
+                                path_output=str(tmp_path / 'output.jsonl'), chunk_size=2, **kwargs)
+
+
+def read_output(tmp_path):
+    with open(str(tmp_path / 'output.jsonl'), encoding='utf-8') as output_file:
+        return [json.loads(line) for line in output_file]
+
+
+def test_only_changed_documents_are_classified(tmp_path, monkeypatch):
+    stats = run(tmp_path, monkeypatch, [(1, 'card fraud'), (2, 'wallet'), (3, 'loans')])
+    assert (stats['documents'], stats['new']) == (3, 3)
+
+    classified = []
+    stats = run(tmp_path, monkeypatch, [(2, 'wallet'), (3, 'fraud in loans'), (4, 'mobile  payments')], classified)
+    assert classified == ['fraud in loans', 'mobile  payments']
+    assert (stats['unchanged'], stats['changed'], stats['new'], stats['removed']) == (1, 1, 1, 1)
+    assert [(record['id'], record['label']) for record in read_output(tmp_path)] == [(2, 'payments'),
+                                                                                     (3, 'fraud'),
+                                                                                     (4, 'payments')]
+
+
+def test_duplicate_ids_keep_first_copy(tmp_path, monkeypatch):
+    classified = []
+    # Second copies in same chunk, in a later chunk and after first copy was saved.
+    stats = run(tmp_path, monkeypatch, [(1, 'card fraud'), (1, 'wallet'), (2, 'loans'), (3, 'fraud'),
+                                        (2, 'other loans'), (1, 'again')], classified)
+
+    assert classified == ['card fraud', 'loans', 'fraud']
+    assert (stats['documents'], stats['new'], stats['duplicates']) == (3, 3, 3)
+    assert [record['id'] for record in read_output(tmp_path)] == [1, 2, 3]
+
+
+def test_failed_chunk_closes_files_and_keeps_saved_chunks(tmp_path, monkeypatch):
+    documents = [(1, 'card fraud'), (2, 'wallet'), (3, 'loans'), (4, 'fraud')]
+
+    def failing_classify(texts, **kwargs):
+        if 'loans' in texts:
+            raise RuntimeError('Model failed.')
+        return stand_in_classify([])(texts)
+
+    monkeypatch.setattr(incremental_classify, 'classify_texts', failing_classify)
+    (tmp_path / 'model.pickle').write_bytes(b'weights')
+    with pytest.raises(RuntimeError):
+        classify_incremental(model_pickle_path=str(tmp_path / 'model.pickle'),
+                             path_corpus=write_dump(tmp_path / 'dump.jsonl', documents),
+                             path_manifest=str(tmp_path / 'manifest.sqlite'),
+                             path_delta=str(tmp_path / 'delta.jsonl'), chunk_size=2)
+
+    # Delta file was closed, so first chunk is on disk.
+    with open(str(tmp_path / 'delta.jsonl'), encoding='utf-8') as delta_file:
+        assert [json.loads(line)['id'] for line in delta_file] == [1, 2]
+
+    classified = []
+    stats = run(tmp_path, monkeypatch, documents, classified)
+    assert classified == ['loans', 'fraud']
+    assert stats['unchanged'] == 2
+
+
+def test_moved_model_does_not_reclassify(tmp_path, monkeypatch):
+    run(tmp_path, monkeypatch, [(1, 'card fraud'), (2, 'wallet')])
+
+    # Same weights with a new modification time, and at a new path.
+    (tmp_path / 'model.pickle').rename(tmp_path / 'old.pickle')
+    (tmp_path / 'model.pickle').write_bytes(b'weights')
+    classified = []
+    stats = run(tmp_path, monkeypatch, [(1, 'card fraud'), (2, 'wallet')], classified)
+    assert classified == [] and stats['unchanged'] == 2
+    stats = run(tmp_path, monkeypatch, [(1, 'card fraud'), (2, 'wallet')], classified, model_name='moved.pickle')
+    assert classified == [] and stats['unchanged'] == 2
+
+    # New weights classify everything again.
+    (tmp_path / 'model.pickle').write_bytes(b'new weights')
+    stats = run(tmp_path, monkeypatch, [(1, 'card fraud'), (2, 'wallet')], classified)
+    assert classified == ['card fraud', 'wallet'] and stats['model_changed'] == 2
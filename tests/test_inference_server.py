@@ -0,0 +1,152 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Inference server with a local client. The model is replaced by a stand-in so no weights are needed."""
+
+import json
+import asyncio
+import threading
+import inference_server
+from inference_server import InferenceServer, MicroBatcher
+from settings import IDS_LABELS
+
+
+class StandInModel(object):
+    r"""
+    Predicts `fraud` for texts that mention it and `payments` otherwise. Can be paused to fill the queue.
+    """
+
+    def __init__(self):
+        self.batches = []
+        self.resume = threading.Event()
+        self.resume.set()
+
+    def inference_batch(self, model_pickle_path, texts, ids_labels, max_batch_tokens=None, cache=None,
+                        early_exit=False):
+        self.resume.wait()
+        self.batches.append(list(texts))
+        predictions = []
+        for text in texts:
+            label = 'fraud' if 'fraud' in text else 'payments'
+            predictions.append((label, {lab: 100.0 if lab == label else 0.0 for lab in ids_labels.values()},
+                                None, None))
+        return predictions
+
+
+async def request(port, method, path, payload=None):
+    # One request on its own connection.
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    body = b'' if payload is None else (payload if isinstance(payload, bytes) else json.dumps(payload).encode())
+    writer.write(f'{method} {path} HTTP/1.1\r\nHost: local\r\nContent-Length: {len(body)}\r\n'
+                 f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+
+    head, _, content = response.partition(b'\r\n\r\n')
+    status = int(head.split()[1])
+    return status, json.loads(content.decode('utf-8')) if b'application/json' in head else content.decode('utf-8')
+
+
+def run_with_server(test, monkeypatch, **batcher_args):
+    model = StandInModel()
+    monkeypatch.setattr(inference_server, 'inference_batch', model.inference_batch)
+    monkeypatch.setattr(inference_server, 'get_model_tokenizer', lambda model_pickle_path: None)
+
+    async def main():
+        batcher = MicroBatcher(model_pickle_path='stand-in.pickle', **batcher_args)
+        server = InferenceServer(batcher=batcher)
+        tcp_server = await asyncio.start_server(server.handle_connection, host='127.0.0.1', port=0)
+        batcher_task = asyncio.ensure_future(batcher.run())
+        await server.load_model()
+        try:
+            return await test(tcp_server.sockets[0].getsockname()[1], batcher, model)
+        finally:
+            model.resume.set()
+            batcher_task.cancel()
+            tcp_server.close()
+            await tcp_server.wait_closed()
+
+    return asyncio.run(main())
+
+
+def test_classify_and_health(monkeypatch):
+    async def test(port, batcher, model):
+        assert (await request(port, 'GET', '/ready'))[0] == 200
+        assert (await request(port, 'GET', '/health'))[0] == 200
+
+        status, response = await request(port, 'POST', '/classify', {'text': 'Detect fraud in card payments.'})
+        assert status == 200
+        assert response['label'] == 'fraud'
+        assert set(response['labels_percents']) == set(IDS_LABELS.values())
+
+        status, response = await request(port, 'POST', '/batch_classify', {'texts': ['fraud', 'wallet', 'fraud']})
+        assert status == 200
+        assert [prediction['label'] for prediction in response['predictions']] == ['fraud', 'payments', 'fraud']
+
+    run_with_server(test, monkeypatch)
+
+
+def test_concurrent_requests_share_batches(monkeypatch):
+    async def test(port, batcher, model):
+        responses = await asyncio.gather(*[request(port, 'POST', '/classify', {'text': f'text {index}'})
+                                           for index in range(16)])
+        assert all(status == 200 for status, _ in responses)
+        assert batcher.documents == 16
+        assert batcher.batches < 16
+        assert max(len(batch) for batch in model.batches) <= 8
+
+    run_with_server(test, monkeypatch, max_batch_size=8, max_wait=0.05)
+
+
+def test_request_larger_than_queue_is_rejected_with_413(monkeypatch):
+    async def test(port, batcher, model):
+        # Server is idle, retrying would never help.
+        status, response = await request(port, 'POST', '/batch_classify', {'texts': ['text'] * 5})
+        assert status == 413
+        assert model.batches == []
+
+        status, _ = await request(port, 'POST', '/batch_classify', {'texts': ['text'] * 4})
+        assert status == 200
+
+    run_with_server(test, monkeypatch, max_queue_size=4)
+
+
+def test_full_queue_is_rejected_with_503(monkeypatch):
+    async def test(port, batcher, model):
+        model.resume.clear()
+        # First document is taken by the paused batch, next ones fill the queue.
+        first = asyncio.ensure_future(request(port, 'POST', '/classify', {'text': 'first'}))
+        await asyncio.sleep(0.1)
+        waiting = asyncio.ensure_future(request(port, 'POST', '/batch_classify', {'texts': ['text'] * 4}))
+        await asyncio.sleep(0.1)
+
+        status, _ = await request(port, 'POST', '/classify', {'text': 'one too many'})
+        assert status == 503
+
+        model.resume.set()
+        assert (await first)[0] == 200
+        assert (await waiting)[0] == 200
+
+    run_with_server(test, monkeypatch, max_batch_size=1, max_queue_size=4)
+
+
+def test_bad_requests(monkeypatch):
+    async def test(port, batcher, model):
+        assert (await request(port, 'POST', '/classify', b'not json'))[0] == 400
+        assert (await request(port, 'POST', '/classify', {'text': 3}))[0] == 400
+        assert (await request(port, 'GET', '/classify'))[0] == 405
+        assert (await request(port, 'GET', '/unknown'))[0] == 404
+
+    run_with_server(test, monkeypatch)
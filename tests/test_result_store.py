@@ -0,0 +1,46 @@
+# coding=utf-8
+# Copyright 2020 George Mihaila.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Result store written and queried in a temporary folder."""
+
+from result_store import ResultStore, ResultStoreWriter
+from settings import IDS_LABELS
+
+
+def prediction(label, percent):
+    # Rest of percentage goes to another label.
+    other = 'payments' if label != 'payments' else 'fraud'
+    labels_percents = {name: 0.0 for name in IDS_LABELS.values()}
+    labels_percents.update({label: percent, other: 100.0 - percent})
+    return label, labels_percents, None, None
+
+
+def write_store(path, predictions):
+    writer = ResultStoreWriter(path_store=str(path), shard_size=2)
+    for record_id, document_prediction in enumerate(predictions):
+        writer.add(record_id=record_id, prediction=document_prediction)
+    writer.close()
+    return ResultStore(str(path))
+
+
+def test_query_confidence_bounds_include_float16_values(tmp_path):
+    store = write_store(tmp_path / 'store', [prediction('fraud', 90.0), prediction('fraud', 89.9),
+                                             prediction('payments', 95.5), prediction('fraud', 60.0)])
+
+    # 90.00% is stored as 89.99%.
+    assert store.document(0)[1] == 'fraud'
+    assert store.query(min_confidence=90).tolist() == [0, 2]
+    assert store.query(max_confidence=90).tolist() == [0, 1, 3]
+    assert store.query(labels=['fraud'], min_confidence=89.9, max_confidence=90).tolist() == [0, 1]
+    assert store.query(labels=['payments']).tolist() == [2]